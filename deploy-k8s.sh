@@ -3,10 +3,12 @@
 # Step 1: Apply Kubernetes Manifests
 echo "Applying Kubernetes manifests..."
 kubectl apply -f k8s/rabbitmq-deployment.yaml
+kubectl apply -f k8s/output-pvc.yaml  # Output volume shared by the data-loader and analysis pods
 kubectl apply -f k8s/data-loader-deployment.yaml
 kubectl apply -f k8s/data-processor-deployment.yaml
 kubectl apply -f k8s/analysis-deployment.yaml
 kubectl apply -f k8s/visualization-deployment.yaml
+kubectl apply -f k8s/autoscaler-deployment.yaml  # Scales data-processor with the task queue
 
 # Step 2: Verify Deployment
 echo "Waiting for pods to be in Running state..."
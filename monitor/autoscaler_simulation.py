@@ -0,0 +1,154 @@
+# autoscaler_simulation.py
+import os
+import sys
+import argparse
+
+# Make the worker modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workers'))
+from autoscaler import Autoscaler
+
+class SimulatedQueue:
+    """
+    Local stand-in for the task queue and the data-processor deployment.
+
+    Tasks take a fixed time on one replica, and replicas added by a scale-up only start
+    consuming after a startup delay. It serves the sample() method of
+    autoscaler.ManagementApiQueue and the get_replicas()/set_replicas() methods of
+    autoscaler.KubernetesScaler, so autoscaler.run() can drive it as well.
+    """
+
+    def __init__(self, task_seconds, replicas, startup_seconds=30):
+        """
+        Args:
+            task_seconds (float): The processing time of a task on one replica.
+            replicas (int): The initial replica count, all running.
+            startup_seconds (float): The time a new replica takes to start consuming.
+        """
+        self.task_seconds = task_seconds
+        self.startup_seconds = startup_seconds
+        self.now = 0.0
+        self.messages = 0.0
+        self.ack_rate = 0.0
+        self.running = replicas
+        self.starting = []  # Start times of the replicas not consuming yet
+
+    def add(self, tasks):
+        self.messages += tasks
+
+    def advance(self, seconds):
+        """
+        Let the running replicas process tasks for some time.
+
+        Args:
+            seconds (float): The simulated time.
+        """
+        self.now += seconds
+        self.running += sum(1 for started in self.starting if started + self.startup_seconds <= self.now)
+        self.starting = [started for started in self.starting if started + self.startup_seconds > self.now]
+        done = min(self.messages, self.running * seconds / self.task_seconds)
+        self.messages -= done
+        self.ack_rate = done / seconds
+
+    def sample(self):
+        return {'messages': round(self.messages), 'consumers': self.running, 'ack_rate': self.ack_rate}
+
+    def get_replicas(self):
+        return self.running + len(self.starting)
+
+    def set_replicas(self, replicas):
+        change = replicas - self.get_replicas()
+        if change > 0:
+            self.starting += [self.now] * change
+        else:
+            # Scale down the replicas still starting first
+            removed = min(-change, len(self.starting))
+            self.starting = self.starting[removed:]
+            self.running -= -change - removed
+
+# Arrivals of each scenario: the number of tasks published at a given simulated time
+SCENARIOS = {
+    # One large run published at once, then nothing
+    'burst': lambda t, interval: 400 if t == 0 else 0,
+    # A steady trickle of one task every 10 seconds
+    'steady': lambda t, interval: interval / 10,
+    # Short runs of 30 tasks every 4 minutes, closer together than the scale-down window,
+    # so the replicas should stay up between them instead of flapping
+    'spikes': lambda t, interval: 30 if t % 240 < interval else 0,
+}
+
+def simulate(scenario, autoscaler, duration=3600, interval=15, task_seconds=20, startup_seconds=30, replicas=1):
+    """
+    Run the autoscaler against a simulated queue.
+
+    Args:
+        scenario (str): The arrival scenario (a key of SCENARIOS).
+        autoscaler (Autoscaler): The controller.
+        duration (float): The simulated time in seconds.
+        interval (float): The seconds between two decisions.
+        task_seconds (float): The processing time of a task on one replica.
+        startup_seconds (float): The time a new replica takes to start consuming.
+        replicas (int): The initial replica count.
+
+    Returns:
+        list: One (time, queued tasks, replicas, recommendation) tuple per decision.
+    """
+    queue = SimulatedQueue(task_seconds, replicas, startup_seconds)
+    timeline = []
+    t = 0
+    while t < duration:
+        queue.add(SCENARIOS[scenario](t, interval))
+        current = queue.get_replicas()
+        target, recommendation = autoscaler.decide(queue.sample(), current, t)
+        if target != current:
+            queue.set_replicas(target)
+        timeline.append((t, queue.sample()['messages'], target, recommendation))
+        queue.advance(interval)
+        t += interval
+    return timeline
+
+def summarize(timeline, interval, replicas=1):
+    """
+    Summarize a simulated timeline.
+
+    Args:
+        timeline (list): The decisions returned by simulate.
+        interval (float): The seconds between two decisions.
+        replicas (int): The initial replica count.
+
+    Returns:
+        dict: The deepest queue, the number of scale-ups and scale-downs, the scale-ups
+        adding back replicas just removed by a scale-down (flaps) and the replica-seconds used.
+    """
+    replicas = [replicas] + [target for _, _, target, _ in timeline]
+    changes = [after - before for before, after in zip(replicas, replicas[1:]) if after != before]
+    return {
+        'max_queued': max(queued for _, queued, _, _ in timeline),
+        'scale_ups': sum(1 for change in changes if change > 0),
+        'scale_downs': sum(1 for change in changes if change < 0),
+        'flaps': sum(1 for before, after in zip(changes, changes[1:]) if before < 0 < after),
+        'replica_seconds': sum(replicas[1:]) * interval,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the data-processor autoscaler against a simulated task queue.")
+    parser.add_argument('--scenario', choices=list(SCENARIOS) + ['all'], default='all', help="Arrival scenario")
+    parser.add_argument('--duration', type=float, default=3600, help="Simulated seconds")
+    parser.add_argument('--interval', type=float, default=15, help="Seconds between two decisions")
+    parser.add_argument('--task-seconds', type=float, default=20, help="Processing time of a task on one replica")
+    parser.add_argument('--startup-seconds', type=float, default=30, help="Time a new replica takes to start consuming")
+    parser.add_argument('--scale-down-window', type=float, default=300, help="Hysteresis window of scale-downs")
+    parser.add_argument('--verbose', action='store_true', help="Print every decision")
+    args = parser.parse_args()
+
+    scenarios = list(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+    print(f"{'Scenario':<10} {'Max queued':<12} {'Scale-ups':<11} {'Scale-downs':<13} {'Flaps':<7} {'Replica-hours':<13}")
+    print("-" * 70)
+    for scenario in scenarios:
+        autoscaler = Autoscaler(min_replicas=1, max_replicas=8, scale_down_window=args.scale_down_window)
+        timeline = simulate(scenario, autoscaler, args.duration, args.interval, args.task_seconds, args.startup_seconds)
+        if args.verbose:
+            for t, queued, replicas, recommendation in timeline:
+                print(f"  t={t:>6.0f}s queued={queued:<5} recommend={recommendation:<3} replicas={replicas}")
+        summary = summarize(timeline, args.interval)
+        print(f"{scenario:<10} {summary['max_queued']:<12} {summary['scale_ups']:<11} {summary['scale_downs']:<13} "
+              f"{summary['flaps']:<7} {summary['replica_seconds'] / 3600:<13.2f}")
@@ -1,27 +1,196 @@
 # benchmark.py
-import time
-import subprocess
 import os
 import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import importlib
+import subprocess
+import multiprocessing
+
+# Make the worker modules and the local broker importable
+MONITOR_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKERS_DIR = os.path.join(MONITOR_DIR, '..', 'workers')
+sys.path.append(WORKERS_DIR)
+
+# Pipeline stages in execution order, with the worker module each one runs
+STAGES = [
+    ('loader', 'data_loader'),
+    ('processor', 'data_processor'),
+    ('analysis', 'analysis'),
+    ('visualization', 'visualization'),
+]
+
+# The single stage running the whole pipeline with a broker-free backend
+PIPELINE_STAGES = [('pipeline', 'pipeline')]
+
+def run_stage(stage, module_name, spool_dir, environment, reports):
+    """
+    Run the main() of one worker against the local broker and report its cost.
+
+    This runs in its own process, so the peak RSS and CPU time are those of the worker alone.
+    Worker processes it starts, such as the multiprocessing backend's pool, are reported
+    separately once they have exited.
+
+    Args:
+        stage (str): The name of the stage.
+        module_name (str): The worker module to run.
+        spool_dir (str): The spool directory of the local broker.
+        environment (dict): Environment variables configuring the worker, including
+            ATLAS_DATA_PATH pointing to the synthetic input files.
+        reports (multiprocessing.Queue): The queue receiving the stage report.
+    """
+    os.environ.update(environment)
+    sys.argv = [module_name]  # Workers read their settings from the environment, not the benchmark's arguments
+    sys.path.insert(0, MONITOR_DIR)
+    sys.path.insert(0, WORKERS_DIR)
+
+    # Point the workers at the local broker
+    import connect
+    from local_broker import LocalBroker
+    broker = LocalBroker(spool_dir)
+    connect.connect_to_rabbitmq = broker.connect
+
+    import_start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    module.connect_to_rabbitmq = broker.connect
+    import_seconds = time.perf_counter() - import_start
+
+    start_time = time.perf_counter()
+    module.main()
+    wall_seconds = time.perf_counter() - start_time
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    reports.put({
+        'stage': stage,
+        'wall_seconds': wall_seconds,
+        'import_seconds': import_seconds,
+        'cpu_seconds': usage.ru_utime + usage.ru_stime,
+        'children_cpu_seconds': children_usage.ru_utime + children_usage.ru_stime,
+        'peak_rss_bytes': usage.ru_maxrss * 1024,  # ru_maxrss is in kilobytes on Linux
+        'children_peak_rss_bytes': children_usage.ru_maxrss * 1024,  # Largest child process
+        'published': dict(broker.stats),
+    })
+
+def run_benchmark(events_per_sample, work_dir, seed=42, electron_fraction=0.5, pass_rate=0.5, backend='broker'):
+    """
+    Run the loader -> processor -> analysis -> visualization pipeline on synthetic input.
+
+    Args:
+        events_per_sample (int): The number of synthetic events per sample file.
+        work_dir (str): The directory holding the inputs, the broker spool and the outputs.
+        seed (int): The seed of the synthetic data.
+        electron_fraction (float): The probability that a synthetic lepton pair is an electron pair.
+        pass_rate (float): The share of synthetic events passing the selection.
+        backend (str): 'broker' to run each worker against the local broker, or a
+            backend of workers/pipeline.py to run the pipeline in one process.
+
+    Returns:
+        dict: The benchmark report.
+    """
+    sys.path.insert(0, MONITOR_DIR)
+    from synthetic_data import write_dataset
+
+    data_path = os.path.join(work_dir, 'data') + os.sep
+    spool_dir = os.path.join(work_dir, 'spool')
+    output_dir = os.path.join(work_dir, 'output')
+    os.makedirs(output_dir, exist_ok=True)
+
+    print(f"Writing {events_per_sample} synthetic events per sample to {data_path}...")
+    total_events = write_dataset(data_path, events_per_sample, seed, electron_fraction, pass_rate)
+    input_bytes = sum(os.path.getsize(os.path.join(directory, name))
+                      for directory, _, names in os.walk(data_path) for name in names)
+
+    # Keep every cache off, so each run does the full work, and keep outputs in the work directory
+    environment = {
+        'ATLAS_DATA_PATH': data_path,
+        'CATALOG_PATH': os.path.join(output_dir, 'catalog.json'),
+        'HISTOGRAM_STORE': os.path.join(output_dir, 'histograms.json'),
+        'TASK_STATS_PATH': os.path.join(output_dir, 'task_stats.json'),
+        'OUTPUT_DIR': output_dir,
+        'FILE_CACHE_DIR': '',
+        'SKIM_CACHE_DIR': '',
+        'BLOB_STORE_DIR': '',
+        'REWEIGHT_ONLY': '0',
+        'PIPELINE_BACKEND': backend,
+    }
+
+    context = multiprocessing.get_context('spawn')
+    reports = context.Queue()
+    stages = {}
+    pipeline_start = time.perf_counter()
+    for stage, module_name in (STAGES if backend == 'broker' else PIPELINE_STAGES):
+        print(f"Running {stage}...")
+        process = context.Process(target=run_stage,
+                                  args=(stage, module_name, spool_dir, environment, reports))
+        process.start()
+        report = reports.get()
+        process.join()
+        if process.exitcode != 0:
+            raise Exception(f"Stage {stage} failed with exit code {process.exitcode}")
+        stages[stage] = report
+    pipeline_seconds = time.perf_counter() - pipeline_start
+
+    broker_bytes = sum(queue['bytes'] for report in stages.values() for queue in report['published'].values())
+    processing_seconds = stages['processor' if backend == 'broker' else 'pipeline']['wall_seconds']
+    return {
+        'deployment_type': os.environ.get('DEPLOYMENT_TYPE', 'unknown'),
+        'backend': backend,
+        'events': total_events,
+        'input_bytes': input_bytes,
+        'pipeline_seconds': pipeline_seconds,
+        'events_per_second': total_events / processing_seconds,
+        'pipeline_events_per_second': total_events / pipeline_seconds,
+        'broker_bytes': broker_bytes,
+        'stages': stages,
+    }
 
-# Determine which environment we're running in
-deployment_type = os.environ.get('DEPLOYMENT_TYPE', 'unknown')
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the worker pipeline on synthetic data.")
+    parser.add_argument('--events', type=int, default=50000, help="Synthetic events per sample file")
+    parser.add_argument('--seed', type=int, default=42, help="Seed of the synthetic data")
+    parser.add_argument('--electron-fraction', type=float, default=0.5, help="Probability that a lepton pair is an electron pair")
+    parser.add_argument('--pass-rate', type=float, default=0.5, help="Share of events passing the lepton type and charge cuts")
+    parser.add_argument('--work-dir', default=None, help="Directory for inputs and spool (default: a temporary directory)")
+    parser.add_argument('--report', default='benchmark_report.json', help="Path of the JSON report")
+    parser.add_argument('--backend', default='broker', choices=['broker', 'inprocess', 'multiprocessing'],
+                        help="Run the workers through the local broker, or the whole pipeline in one process")
+    parser.add_argument('--cpu-monitor', action='store_true', help="Also sample host CPU usage with cpu_monitor.py")
+    args = parser.parse_args()
 
-# Start the CPU monitor
-monitor_process = subprocess.Popen(["python", "cpu_monitor.py", deployment_type])
+    # Start the CPU monitor, which samples the host for a fixed 60 seconds
+    deployment_type = os.environ.get('DEPLOYMENT_TYPE', 'unknown')
+    if args.cpu_monitor:
+        monitor_process = subprocess.Popen([sys.executable, os.path.join(MONITOR_DIR, 'cpu_monitor.py'), deployment_type])
 
-print(f"Starting benchmark in {deployment_type} environment...")
-start_time = time.time()
+    print(f"Starting benchmark in {deployment_type} environment...")
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='atlas-benchmark-')
+    try:
+        report = run_benchmark(args.events, work_dir, args.seed, args.electron_fraction, args.pass_rate, args.backend)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
 
-# Run  actual workload here - this should be identical in both environments
-# For example, process a specific dataset or run a fixed number of calculations
-# Replace this with your actual workload:
-for i in range(10000000):
-    _ = i * i * i  # CPU-intensive calculation
+    with open(args.report, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
 
-end_time = time.time()
-print(f"Benchmark completed in {end_time - start_time:.2f} seconds")
+    print(f"{'Stage':<15} {'Wall (s)':<10} {'CPU (s)':<10} {'Child CPU (s)':<15} {'Peak RSS (MB)':<15} "
+          f"{'Child RSS (MB)':<15} {'Published (MB)':<15}")
+    print("-" * 95)
+    for stage, stage_report in report['stages'].items():
+        published = sum(queue['bytes'] for queue in stage_report['published'].values())
+        print(f"{stage:<15} {stage_report['wall_seconds']:<10.2f} {stage_report['cpu_seconds']:<10.2f} "
+              f"{stage_report['children_cpu_seconds']:<15.2f} {stage_report['peak_rss_bytes'] / 1e6:<15.1f} "
+              f"{stage_report['children_peak_rss_bytes'] / 1e6:<15.1f} {published / 1e6:<15.2f}")
+    print(f"Processed {report['events']} events at {report['events_per_second']:.3e} events/s "
+          f"({report['broker_bytes'] / 1e6:.2f} MB through the broker)")
+    print(f"Report saved to {args.report}")
 
-# Wait for the monitor to finish
-monitor_process.wait()
-print("Benchmark and monitoring complete.")
+    # Wait for the monitor to finish
+    if args.cpu_monitor:
+        monitor_process.wait()
+        print("Benchmark and monitoring complete.")
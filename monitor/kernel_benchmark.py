@@ -0,0 +1,80 @@
+# kernel_benchmark.py
+import os
+import sys
+import time
+import numpy as np
+import awkward as ak
+
+# Make the worker modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workers'))
+from data_processor import cut_lep_type, cut_lep_charge, calc_mass
+from kernels import HAS_NUMBA, select_and_mass
+
+# Number of events in the benchmark chunk and number of timed repetitions
+n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+repeats = 5
+
+def make_chunk(n_events, seed=42):
+    """
+    Build a synthetic chunk of 4-lepton events with the same types as the ROOT files.
+    """
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(4, 6, n_events)
+    n_leptons = int(counts.sum())
+
+    def jagged(values):
+        return ak.unflatten(values, counts)
+
+    # Leptons are taken as massless, so E = pt * cosh(eta)
+    lep_pt = rng.uniform(7e3, 100e3, n_leptons)
+    lep_eta = rng.uniform(-2.5, 2.5, n_leptons)
+    return ak.Array({
+        'lep_pt': jagged(lep_pt.astype(np.float32)),
+        'lep_eta': jagged(lep_eta.astype(np.float32)),
+        'lep_phi': jagged(rng.uniform(-np.pi, np.pi, n_leptons).astype(np.float32)),
+        'lep_E': jagged((lep_pt * np.cosh(lep_eta)).astype(np.float32)),
+        'lep_charge': jagged(rng.choice([-1, 1], n_leptons).astype(np.int32)),
+        'lep_type': jagged(rng.choice([11, 13], n_leptons).astype(np.int32)),
+    })
+
+def awkward_path(data):
+    data = data[~cut_lep_type(data['lep_type'])]
+    data = data[~cut_lep_charge(data['lep_charge'])]
+    return ak.to_numpy(calc_mass(data['lep_pt'], data['lep_eta'], data['lep_phi'], data['lep_E']))
+
+def kernel_path(data):
+    return select_and_mass(data)[1]
+
+def best_time(function, data):
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function(data)
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+if not HAS_NUMBA:
+    print("numba is not installed, the kernel would run as plain Python. Aborting.")
+    sys.exit(1)
+
+print(f"Building a chunk of {n_events} events...")
+chunk = make_chunk(n_events)
+
+# Check that both paths agree before timing them (the first call also compiles the kernel).
+# vector sums float32 branches in float32 while the kernel accumulates in float64, so masses
+# with strong cancellation between the four momenta differ at float32 precision.
+expected = awkward_path(chunk)
+result = kernel_path(chunk)
+assert len(expected) == len(result), f"Selected {len(result)} events, expected {len(expected)}"
+assert np.allclose(expected, result, rtol=1e-4, atol=1e-3), "Invariant masses differ"
+print(f"Both paths select {len(result)} events with matching masses "
+      f"(max relative difference {np.max(np.abs(expected - result) / np.abs(expected)):.2e})")
+
+awkward_time = best_time(awkward_path, chunk)
+kernel_time = best_time(kernel_path, chunk)
+
+print(f"{'Path':<20} {'Time (s)':<12} {'Events/s':<15}")
+print("-" * 47)
+print(f"{'awkward/vector':<20} {awkward_time:<12.4f} {n_events / awkward_time:<15.3e}")
+print(f"{'numba kernel':<20} {kernel_time:<12.4f} {n_events / kernel_time:<15.3e}")
+print(f"Speed-up: {awkward_time / kernel_time:.1f}x")
@@ -0,0 +1,266 @@
+# local_broker.py
+import os
+import json
+import time
+import pickle
+import threading
+import collections
+import pika
+
+# Local stand-in for the RabbitMQ connections used by the workers.
+#
+# Queues are spooled to a directory (one file per message, removed on ack), so the
+# stages of a pipeline can run one after the other in separate processes. Consuming
+# returns as soon as the queue is drained and nothing is in flight, instead of
+# blocking forever, which lets every worker's main() run to completion.
+
+class LocalBroker:
+    """
+    A directory-backed broker serving the subset of the pika BlockingConnection API used by the workers.
+    """
+
+    def __init__(self, spool_dir):
+        """
+        Args:
+            spool_dir (str): The directory holding one subdirectory of message files per queue.
+        """
+        self.spool_dir = spool_dir
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.stats = collections.defaultdict(lambda: {'messages': 0, 'bytes': 0})
+
+    def connect(self):
+        """
+        Open a connection, in place of connect.connect_to_rabbitmq.
+
+        Returns:
+            LocalConnection: The connection.
+        """
+        return LocalConnection(self)
+
+    def declare(self, queue):
+        """
+        Load a queue from the spool directory the first time it is declared.
+
+        Args:
+            queue (str): The name of the queue.
+        """
+        with self.lock:
+            if queue in self.queues:
+                return
+            queue_dir = os.path.join(self.spool_dir, queue)
+            os.makedirs(queue_dir, exist_ok=True)
+            self.queues[queue] = collections.deque(
+                os.path.join(queue_dir, name) for name in sorted(os.listdir(queue_dir)) if name.endswith('.msg'))
+
+    def publish(self, queue, body, properties):
+        """
+        Append a message to a queue.
+
+        Args:
+            queue (str): The name of the queue.
+            body (bytes or str): The message body.
+            properties (pika.BasicProperties): The message properties, or None.
+        """
+        self.declare(queue)
+        if isinstance(body, str):
+            body = body.encode()
+        if properties is not None:
+            # Encode the properties as pika does for a real broker, so unsupported header values fail here too
+            properties.encode()
+        headers = properties.headers if properties is not None else None
+        content_type = properties.content_type if properties is not None else None
+        with self.lock:
+            path = os.path.join(self.spool_dir, queue, f"{time.time_ns():020d}-{self.stats[queue]['messages']:08d}.msg")
+            with open(path, 'wb') as message_file:
+                pickle.dump({'body': body, 'headers': headers, 'content_type': content_type}, message_file)
+            self.queues[queue].append(path)
+            self.stats[queue]['messages'] += 1
+            self.stats[queue]['bytes'] += len(body) + len(json.dumps(headers or {}, default=str))
+
+    def get(self, queue):
+        """
+        Take the next message of a queue.
+
+        Args:
+            queue (str): The name of the queue.
+
+        Returns:
+            tuple: The path of the message file and its content, or None if the queue is empty.
+        """
+        with self.lock:
+            if not self.queues[queue]:
+                return None
+            path = self.queues[queue].popleft()
+        with open(path, 'rb') as message_file:
+            return path, pickle.load(message_file)
+
+    def requeue(self, path):
+        """
+        Put a delivered message back at the head of its queue.
+
+        Args:
+            path (str): The path of the message file.
+        """
+        with self.lock:
+            self.queues[os.path.basename(os.path.dirname(path))].appendleft(path)
+
+class LocalConnection:
+    """
+    Stand-in for pika.BlockingConnection.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.threadsafe_callbacks = collections.deque()
+        self.timers = []
+        self.wakeup = threading.Event()
+
+    def channel(self):
+        return LocalChannel(self)
+
+    def add_callback_threadsafe(self, callback):
+        self.threadsafe_callbacks.append(callback)
+        self.wakeup.set()
+
+    def call_later(self, delay, callback):
+        self.timers.append((time.time() + delay, callback))
+
+    def process_data_events(self, time_limit=0):
+        self.run_callbacks()
+
+    def run_callbacks(self):
+        """
+        Run the callbacks scheduled from other threads and the timers that are due.
+        """
+        while self.threadsafe_callbacks:
+            self.threadsafe_callbacks.popleft()()
+        now = time.time()
+        due = [timer for timer in self.timers if timer[0] <= now]
+        self.timers = [timer for timer in self.timers if timer[0] > now]
+        for _, callback in due:
+            callback()
+
+    def close(self):
+        self.is_open = False
+
+class LocalChannel:
+    """
+    Stand-in for pika.adapters.blocking_connection.BlockingChannel.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_closed = False
+        self.prefetch_count = 1
+        self.consumers = []
+        self.unacked = {}
+        self.next_delivery_tag = 1
+        self.stopped = False
+        self.cancelled = False
+
+    def queue_declare(self, queue, **kwargs):
+        self.broker.declare(queue)
+
+    def basic_qos(self, prefetch_count=0, **kwargs):
+        self.prefetch_count = prefetch_count or float('inf')
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        self.broker.publish(routing_key, body, properties)
+
+    def basic_consume(self, queue, on_message_callback, **kwargs):
+        self.broker.declare(queue)
+        self.consumers.append((queue, on_message_callback))
+
+    def basic_ack(self, delivery_tag, **kwargs):
+        path = self.unacked.pop(delivery_tag)
+        os.remove(path)
+
+    def basic_nack(self, delivery_tag, requeue=True, **kwargs):
+        path = self.unacked.pop(delivery_tag)
+        if requeue:
+            self.broker.requeue(path)
+        else:
+            os.remove(path)
+
+    def deliver(self, queue, message):
+        """
+        Register a message taken from a queue as delivered.
+
+        Args:
+            queue (str): The name of the queue.
+            message (tuple): The path and content returned by LocalBroker.get.
+
+        Returns:
+            tuple: The delivery method, properties and body of the message.
+        """
+        path, content = message
+        delivery_tag = self.next_delivery_tag
+        self.next_delivery_tag += 1
+        self.unacked[delivery_tag] = path
+        properties = pika.BasicProperties(headers=content['headers'], content_type=content['content_type'])
+        return pika.spec.Basic.Deliver(delivery_tag=delivery_tag, routing_key=queue), properties, content['body']
+
+    def consume(self, queue, inactivity_timeout=None, **kwargs):
+        """
+        Yield the messages of a queue until cancel() is called, as BlockingChannel.consume.
+
+        Args:
+            queue (str): The name of the queue.
+            inactivity_timeout (float): The seconds without a message after which
+                (None, None, None) is yielded, or None to wait indefinitely.
+
+        Yields:
+            tuple: The delivery method, properties and body of each message.
+        """
+        self.broker.declare(queue)
+        self.cancelled = False
+        idle_since = time.time()
+        while not self.cancelled:
+            message = self.broker.get(queue)
+            if message is not None:
+                idle_since = time.time()
+                yield self.deliver(queue, message)
+            elif inactivity_timeout is not None and time.time() - idle_since >= inactivity_timeout:
+                idle_since = time.time()
+                yield None, None, None
+            else:
+                time.sleep(0.01)
+
+    def cancel(self):
+        self.cancelled = True
+        return 0
+
+    def stop_consuming(self):
+        self.stopped = True
+
+    def start_consuming(self):
+        """
+        Deliver messages to the consumers until stopped, or until every queue is drained
+        and every delivered message has been acknowledged.
+        """
+        while not self.stopped:
+            self.connection.run_callbacks()
+            delivered = False
+            for queue, callback in self.consumers:
+                if self.stopped or len(self.unacked) >= self.prefetch_count:
+                    break
+                message = self.broker.get(queue)
+                if message is None:
+                    continue
+                callback(self, *self.deliver(queue, message))
+                delivered = True
+            if delivered:
+                continue
+            if not self.unacked and not self.connection.threadsafe_callbacks:
+                break
+            self.connection.wakeup.wait(0.05)
+            self.connection.wakeup.clear()
+
+    def close(self):
+        self.is_closed = True
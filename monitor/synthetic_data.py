@@ -0,0 +1,158 @@
+# synthetic_data.py
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import awkward as ak
+import uproot
+
+# Make the worker modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workers'))
+import infofile
+from constants import SAMPLES, WEIGHT_VARIABLES
+
+# Number of events written per basket
+BASKET_EVENTS = 100000
+
+def make_events(n_events, rng, is_mc, electron_fraction=0.5, pass_rate=0.5):
+    """
+    Build synthetic 4-lepton events with the branch types of the open-data files.
+
+    A pass_rate share of the events have two same-flavour lepton pairs of opposite charges
+    among their first four leptons, so they pass the lepton type and charge cuts. The other
+    events have one lepton flavour or one charge flipped, so they fail one of the cuts.
+    Events carry a fifth lepton half of the time.
+
+    Args:
+        n_events (int): The number of events.
+        rng (np.random.Generator): The random generator.
+        is_mc (bool): Whether to add the MC weight branches.
+        electron_fraction (float): The probability that a lepton pair is an electron pair.
+        pass_rate (float): The share of events passing the selection.
+
+    Returns:
+        dict: The branches, jagged lepton arrays and flat weights.
+    """
+    # Flavours and charges of the first four leptons, built from two same-flavour pairs
+    electron_pairs = rng.random((n_events, 2)) < electron_fraction
+    lep_type = np.where(np.repeat(electron_pairs, 2, axis=1), 11, 13).astype(np.uint32)
+    lep_charge = rng.permuted(np.tile(np.array([1, 1, -1, -1], dtype=np.int32), (n_events, 1)), axis=1)
+
+    # Failing events get one flavour (odd flavour count) or one charge (non-zero sum) flipped
+    failing = np.nonzero(rng.random(n_events) >= pass_rate)[0]
+    flip_flavour = rng.random(len(failing)) < 0.5
+    flipped = rng.integers(0, 4, len(failing))
+    events_index, lepton_index = failing[flip_flavour], flipped[flip_flavour]
+    lep_type[events_index, lepton_index] = 24 - lep_type[events_index, lepton_index]
+    events_index, lepton_index = failing[~flip_flavour], flipped[~flip_flavour]
+    lep_charge[events_index, lepton_index] *= -1
+
+    # Extra leptons, which the cuts ignore
+    n_extra = rng.integers(0, 2, n_events)
+    n_extra_leptons = int(n_extra.sum())
+
+    def leptons(first_four, extra):
+        return ak.to_packed(ak.concatenate([ak.from_regular(ak.Array(first_four)), ak.unflatten(extra, n_extra)], axis=1))
+
+    def kinematics(low, high):
+        return rng.uniform(low, high, (n_events, 4)), rng.uniform(low, high, n_extra_leptons)
+
+    # Leptons are taken as massless, so E = pt * cosh(eta)
+    pt_first, pt_extra = kinematics(7e3, 100e3)
+    eta_first, eta_extra = kinematics(-2.5, 2.5)
+    phi_first, phi_extra = kinematics(-np.pi, np.pi)
+    events = {
+        'lep_pt': leptons(pt_first.astype(np.float32), pt_extra.astype(np.float32)),
+        'lep_eta': leptons(eta_first.astype(np.float32), eta_extra.astype(np.float32)),
+        'lep_phi': leptons(phi_first.astype(np.float32), phi_extra.astype(np.float32)),
+        'lep_E': leptons((pt_first * np.cosh(eta_first)).astype(np.float32),
+                         (pt_extra * np.cosh(eta_extra)).astype(np.float32)),
+        'lep_charge': leptons(lep_charge, rng.choice(np.array([-1, 1], dtype=np.int32), n_extra_leptons)),
+        'lep_type': leptons(lep_type, rng.choice(np.array([11, 13], dtype=np.uint32), n_extra_leptons)),
+    }
+    if is_mc:
+        for variable in WEIGHT_VARIABLES:
+            events[variable] = rng.normal(1.0, 0.05, n_events).astype(np.float32)
+    return events
+
+def write_sample(path, n_events, seed=42, is_mc=True, electron_fraction=0.5, pass_rate=0.5):
+    """
+    Write a ROOT file holding a 'mini' tree of synthetic events.
+
+    Args:
+        path (str): The path of the file.
+        n_events (int): The number of events.
+        seed (int): The seed of the random generator.
+        is_mc (bool): Whether to add the MC weight branches.
+        electron_fraction (float): The probability that a lepton pair is an electron pair.
+        pass_rate (float): The share of events passing the selection.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with uproot.recreate(path) as root_file:
+        tree = None
+        for start in range(0, n_events, BASKET_EVENTS):
+            events = make_events(min(BASKET_EVENTS, n_events - start), rng, is_mc, electron_fraction, pass_rate)
+            if tree is None:
+                branch_types = {name: str(ak.type(values).content) if isinstance(values, ak.Array) else values.dtype
+                                for name, values in events.items()}
+                tree = root_file.mktree('mini', branch_types)
+            tree.extend(events)
+
+def sample_path(base_path, sample_type, sample_name):
+    """
+    Build the path of a sample's file with the layout of the open-data server.
+
+    Args:
+        base_path (str): The base directory.
+        sample_type (str): The type of sample ('data' or an MC sample type).
+        sample_name (str): The name of the sample.
+
+    Returns:
+        str: The path of the file.
+    """
+    if sample_type == 'data':
+        prefix = "Data/"
+    else:
+        prefix = "MC/mc_" + str(infofile.infos[sample_name]["DSID"]) + "."
+    return os.path.join(base_path, prefix + sample_name + ".4lep.root")
+
+def write_dataset(base_path, events_per_sample, seed=42, electron_fraction=0.5, pass_rate=0.5):
+    """
+    Write a synthetic file for every sample of the analysis.
+
+    The files follow the Data/ and MC/mc_<DSID>. layout of the open-data server, so the
+    workers read them with ATLAS_DATA_PATH set to base_path.
+
+    Args:
+        base_path (str): The base directory.
+        events_per_sample (int): The number of events per file.
+        seed (int): The seed of the random generators (offset per sample).
+        electron_fraction (float): The probability that a lepton pair is an electron pair.
+        pass_rate (float): The share of events passing the selection.
+
+    Returns:
+        int: The total number of events written.
+    """
+    index = 0
+    for sample_type, sample_info in SAMPLES.items():
+        for sample_name in sample_info['list']:
+            write_sample(sample_path(base_path, sample_type, sample_name), events_per_sample,
+                         seed + index, sample_type != 'data', electron_fraction, pass_rate)
+            index += 1
+    return index * events_per_sample
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic 4-lepton ROOT files for every sample.")
+    parser.add_argument('base_path', help="Output directory, to be used as ATLAS_DATA_PATH")
+    parser.add_argument('--events', type=int, default=100000, help="Events per sample file")
+    parser.add_argument('--electron-fraction', type=float, default=0.5, help="Probability that a lepton pair is an electron pair")
+    parser.add_argument('--pass-rate', type=float, default=0.5, help="Share of events passing the lepton type and charge cuts")
+    parser.add_argument('--seed', type=int, default=42, help="Seed of the random generators")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    total_events = write_dataset(args.base_path, args.events, args.seed, args.electron_fraction, args.pass_rate)
+    print(f"Wrote {total_events} events in {time.time() - start_time:.1f}s to {args.base_path}")
+    print(f"Run the workers with ATLAS_DATA_PATH={os.path.join(os.path.abspath(args.base_path), '')}")
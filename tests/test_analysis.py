@@ -0,0 +1,50 @@
+# test_analysis.py
+import os
+import sys
+import unittest
+import numpy as np
+import awkward as ak
+
+# Make the worker modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workers'))
+from connect import serialize_awkward
+from constants import setup_histogram_bins
+from analysis import new_state, aggregate_result, results_complete
+
+def data_result(sample_name, shard_index, shard_count, masses):
+    body, headers = serialize_awkward(ak.Array({'mass': np.array(masses, dtype=float)}))
+    headers.update({
+        'sample_type': 'data',
+        'sample_name': sample_name,
+        'result_kind': 'events',
+        'shard_index': shard_index,
+        'shard_count': shard_count,
+    })
+    return headers, body
+
+class AggregateResultTest(unittest.TestCase):
+
+    def setUp(self):
+        bin_edges, _ = setup_histogram_bins()
+        self.state = new_state(bin_edges)
+        self.state['expected_shards'] = {'data_A': 1, 'data_B': 1}
+        self.state['received_shards'] = {}
+
+    def test_complete_once_every_shard_is_received(self):
+        aggregate_result(self.state, *data_result('data_A', 0, 1, [125.0]))
+        aggregate_result(self.state, *data_result('data_B', 0, 2, [125.0]))
+        self.assertFalse(results_complete(self.state))
+        aggregate_result(self.state, *data_result('data_B', 1, 2, [125.0]))
+        self.assertTrue(results_complete(self.state))
+
+    def test_duplicate_shard_is_ignored(self):
+        aggregate_result(self.state, *data_result('data_A', 0, 1, [125.0]))
+        aggregate_result(self.state, *data_result('data_B', 0, 2, [125.0, 126.0]))
+        aggregate_result(self.state, *data_result('data_B', 0, 2, [125.0, 126.0]))
+        # The redelivered shard must neither end the run nor be counted twice
+        self.assertFalse(results_complete(self.state))
+        self.assertEqual(self.state['sample_histograms']['data_B']['counts'].sum(), 2)
+        self.assertEqual(len(self.state['performance']), 2)
+
+if __name__ == '__main__':
+    unittest.main()
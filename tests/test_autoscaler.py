@@ -0,0 +1,49 @@
+# test_autoscaler.py
+import os
+import sys
+import unittest
+
+# Make the worker and monitor modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workers'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'monitor'))
+from autoscaler import Autoscaler
+from autoscaler_simulation import simulate, summarize
+
+INTERVAL = 15
+SCALE_UP_COOLDOWN = 30
+SCALE_DOWN_WINDOW = 300
+
+def run(scenario, scale_down_window=SCALE_DOWN_WINDOW):
+    autoscaler = Autoscaler(min_replicas=1, max_replicas=8, scale_up_cooldown=SCALE_UP_COOLDOWN,
+                            scale_down_window=scale_down_window)
+    return simulate(scenario, autoscaler, duration=3600, interval=INTERVAL)
+
+class AutoscalerSimulationTest(unittest.TestCase):
+
+    def test_spikes_do_not_flap(self):
+        summary = summarize(run('spikes'), INTERVAL)
+        self.assertGreater(summary['scale_ups'], 0)
+        self.assertEqual(summary['flaps'], 0)
+
+    def test_spikes_flap_with_a_window_shorter_than_their_period(self):
+        self.assertGreater(summarize(run('spikes', scale_down_window=60), INTERVAL)['flaps'], 0)
+
+    def test_burst_scales_up_within_one_cooldown(self):
+        timeline = run('burst')
+        first_scale_up = next(t for t, _, replicas, _ in timeline if replicas > 1)
+        self.assertLessEqual(first_scale_up, SCALE_UP_COOLDOWN)
+
+    def test_no_scale_down_before_the_window(self):
+        for scenario in ['burst', 'steady', 'spikes']:
+            timeline = run(scenario)
+            replicas = [1] + [target for _, _, target, _ in timeline]
+            scale_downs = [t for (t, _, _, _), before, after in zip(timeline, replicas, replicas[1:]) if after < before]
+            self.assertTrue(all(t >= SCALE_DOWN_WINDOW for t in scale_downs), scenario)
+
+    def test_burst_scales_back_down(self):
+        summary = summarize(run('burst'), INTERVAL)
+        self.assertGreater(summary['scale_downs'], 0)
+        self.assertEqual(run('burst')[-1][2], 1)
+
+if __name__ == '__main__':
+    unittest.main()
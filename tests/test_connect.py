@@ -0,0 +1,41 @@
+# test_connect.py
+import os
+import sys
+import unittest
+import numpy as np
+import awkward as ak
+
+# Make the worker modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workers'))
+from connect import serialize_awkward, deserialize_awkward
+
+class SerializeAwkwardTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.events = ak.Array({
+            'mass': rng.uniform(80, 250, 200000),
+            'lep_pt': ak.unflatten(rng.uniform(5, 100, 800000), 4),
+        })
+
+    def test_round_trip(self):
+        selected = self.events[self.events['mass'] < 125]
+        for codec in ['none', 'zstd', 'lz4']:
+            body, headers = serialize_awkward(selected, codec)
+            self.assertEqual(deserialize_awkward(body, headers).tolist(), selected.tolist())
+
+    def test_masked_array_ships_only_selected_events(self):
+        # A 5% selection must cost about 5% of the full payload, not the full buffers it indexes into
+        selected = self.events[self.events['mass'] < 88.5]
+        full_body, _ = serialize_awkward(self.events, 'none')
+        body, _ = serialize_awkward(selected, 'none')
+        packed_body, _ = serialize_awkward(ak.to_packed(selected), 'none')
+        self.assertEqual(len(body), len(packed_body))
+        self.assertLess(len(body), 0.1 * len(full_body))
+
+    def test_none(self):
+        self.assertEqual(serialize_awkward(None), (b'', {}))
+        self.assertIsNone(deserialize_awkward(b'', {}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# test_data_loader.py
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# Make the worker and monitor modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workers'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'monitor'))
+import data_loader
+from data_loader import describe_files
+from synthetic_data import write_sample
+
+class DescribeFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'Data', 'data_A.4lep.root')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unchanged_file_is_served_from_the_catalog(self):
+        write_sample(self.path, 2000, is_mc=False)
+        catalog = {}
+        first = describe_files([self.path], catalog, concurrency=1)[self.path]
+        second = describe_files([self.path], catalog, concurrency=1)[self.path]
+        self.assertEqual(first['num_entries'], 2000)
+        self.assertIs(second, catalog[self.path])
+
+    def test_regenerated_file_is_described_again(self):
+        write_sample(self.path, 2000, is_mc=False)
+        catalog = {}
+        describe_files([self.path], catalog, concurrency=1)
+        write_sample(self.path, 3000, is_mc=False, seed=7)
+        description = describe_files([self.path], catalog, concurrency=1)[self.path]
+        self.assertEqual(description['num_entries'], 3000)
+        self.assertEqual(catalog[self.path]['num_entries'], 3000)
+
+    def test_recent_catalog_entry_is_not_probed(self):
+        write_sample(self.path, 2000, is_mc=False)
+        catalog = {}
+        first = describe_files([self.path], catalog, concurrency=1, max_age=60)[self.path]
+        with mock.patch.object(data_loader, 'probe_file') as probe_file:
+            second = describe_files([self.path], catalog, concurrency=1, max_age=60)[self.path]
+        probe_file.assert_not_called()
+        self.assertIs(second, first)
+
+    def test_expired_catalog_entry_is_probed_again(self):
+        write_sample(self.path, 2000, is_mc=False)
+        catalog = {}
+        describe_files([self.path], catalog, concurrency=1, max_age=60)
+        catalog[self.path]['probed_at'] -= 120
+        write_sample(self.path, 3000, is_mc=False, seed=7)
+        description = describe_files([self.path], catalog, concurrency=1, max_age=60)[self.path]
+        self.assertEqual(description['num_entries'], 3000)
+
+    def test_unreadable_tree_is_not_sharded(self):
+        # Without the tree metadata the entry count is unknown, so no shard may end at a guessed count
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as root_file:
+            root_file.write(b'not a ROOT file')
+        description = describe_files([self.path], {}, concurrency=1)[self.path]
+        self.assertIsNone(description['num_entries'])
+        self.assertEqual(description['basket_offsets'], [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+# test_data_processor.py
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import pika
+import uproot
+import numpy as np
+
+# Make the worker and monitor modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workers'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'monitor'))
+import data_processor
+from data_processor import task_skim_key, handle_task, finish_task, process_chunk
+from constants import VARIABLES, WEIGHT_VARIABLES
+from profiling import TaskProfile
+from synthetic_data import write_sample
+
+def amqp_round_trip(headers):
+    # Encode the headers as the broker receives them, and decode them as a consumer does
+    properties = pika.spec.BasicProperties()
+    properties.decode(b''.join(pika.BasicProperties(headers=headers).encode()))
+    return properties.headers
+
+class TaskSkimKeyTest(unittest.TestCase):
+
+    def task(self, **fields):
+        task = {
+            'sample_type': 'data',
+            'sample_name': 'data_A',
+            'fraction': 1.0,
+            'entry_start': 0,
+            'entry_stop': 1000,
+            'file_size': 123456,
+            'file_version': 1700000000.0,
+        }
+        task.update(fields)
+        return task
+
+    def test_same_file_same_key(self):
+        self.assertEqual(task_skim_key(self.task()), task_skim_key(self.task()))
+
+    def test_regenerated_file_gets_a_new_key(self):
+        key = task_skim_key(self.task())
+        self.assertNotEqual(task_skim_key(self.task(file_version=1700000100.0)), key)
+        self.assertNotEqual(task_skim_key(self.task(file_size=654321)), key)
+
+    def test_unidentified_file_is_not_cached(self):
+        self.assertIsNone(task_skim_key(self.task(file_size=None, file_version=None)))
+
+    def test_compiled_kernel_gets_a_new_key(self):
+        key = task_skim_key(self.task())
+        with mock.patch.object(data_processor, 'USE_COMPILED_KERNEL', not data_processor.USE_COMPILED_KERNEL):
+            self.assertNotEqual(task_skim_key(self.task()), key)
+
+class CompiledKernelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'mc_A.4lep.root')
+        write_sample(self.path, 2000, is_mc=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def process(self, compiled):
+        with mock.patch.object(data_processor, 'USE_COMPILED_KERNEL', compiled):
+            tree = uproot.open(self.path + ':mini')
+            data, _ = process_chunk(tree, VARIABLES + WEIGHT_VARIABLES, True, 0, 2000, TaskProfile())
+        return data
+
+    def test_compiled_kernel_matches_the_vectorised_path(self):
+        vectorised = self.process(compiled=False)
+        compiled = self.process(compiled=True)
+        self.assertGreater(len(vectorised), 0)
+        self.assertEqual(len(compiled), len(vectorised))
+        self.assertTrue(np.allclose(np.asarray(compiled['mass']), np.asarray(vectorised['mass']), rtol=1e-5))
+        self.assertTrue(np.allclose(np.asarray(compiled['scaleFactorWeight']), np.asarray(vectorised['scaleFactorWeight'])))
+
+class HandleTaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp() + os.sep
+        write_sample(os.path.join(self.data_path, 'Data', 'data_A.4lep.root'), 2000, is_mc=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_path)
+
+    def handle(self, **fields):
+        task = {'sample_type': 'data', 'sample_name': 'data_A', 'fraction': 1.0,
+                'entry_start': 0, 'entry_stop': 2000, 'shard_index': 0, 'shard_count': 1}
+        task.update(fields)
+        with mock.patch.object(data_processor, 'PATH', self.data_path):
+            return handle_task(json.dumps(task).encode())
+
+    def test_result_headers_survive_amqp_encoding(self):
+        body, headers = self.handle()
+        self.assertNotIn('error', headers)
+        decoded = amqp_round_trip(headers)
+        self.assertEqual(decoded['entries_in'], 2000)
+        self.assertGreater(decoded['processing_us'], 0)
+        self.assertIn('read', decoded['stage_us'])
+
+    def test_error_headers_survive_amqp_encoding(self):
+        body, headers = self.handle(sample_name='data_Z')
+        self.assertEqual(body, b'')
+        self.assertIn('error', amqp_round_trip(headers))
+
+class FailingPublisher:
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.published = []
+
+    def publish(self, body, properties):
+        if self.failures:
+            self.failures -= 1
+            raise Exception("broker unavailable")
+        self.published.append(properties.headers)
+
+class FinishTaskTest(unittest.TestCase):
+
+    def finish(self, failures):
+        channel = mock.Mock()
+        publisher = FailingPublisher(failures)
+        headers = {'sample_type': 'data', 'sample_name': 'data_A', 'shard_index': 1, 'shard_count': 2, 'x-codec': 'none'}
+        finish_task(channel, 7, publisher, b'payload', headers)
+        return channel, publisher.published
+
+    def test_result_is_published_and_acknowledged(self):
+        channel, published = self.finish(failures=0)
+        self.assertEqual(published[0]['sample_name'], 'data_A')
+        channel.basic_ack.assert_called_once_with(delivery_tag=7)
+
+    def test_error_result_replaces_a_result_that_cannot_be_published(self):
+        channel, published = self.finish(failures=1)
+        self.assertEqual(published[0]['shard_index'], 1)
+        self.assertIn('error', published[0])
+        self.assertNotIn('x-codec', published[0])
+        channel.basic_ack.assert_called_once_with(delivery_tag=7)
+
+    def test_task_is_requeued_when_nothing_can_be_published(self):
+        channel, published = self.finish(failures=2)
+        self.assertEqual(published, [])
+        channel.basic_nack.assert_called_once_with(delivery_tag=7, requeue=True)
+        channel.basic_ack.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# test_file_cache.py
+import os
+import sys
+import shutil
+import tempfile
+import functools
+import threading
+import unittest
+from unittest import mock
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# Make the worker and monitor modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workers'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'monitor'))
+import file_cache
+import data_processor
+from synthetic_data import write_sample
+
+class QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+class FileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # Serve a directory over HTTP from a local server, and cache its files in another one
+        self.served_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=self.served_dir))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.served_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def serve(self, name, content):
+        with open(os.path.join(self.served_dir, name), 'wb') as served_file:
+            served_file.write(content)
+        return self.base_url + name
+
+    def test_miss_then_hit(self):
+        url = self.serve('a.root', b'a' * 1000)
+        hits = file_cache.cache_stats['hits']
+        path = file_cache.fetch(url, self.cache_dir, 10000)
+        with open(path, 'rb') as cached_file:
+            self.assertEqual(cached_file.read(), b'a' * 1000)
+        self.assertEqual(file_cache.fetch(url, self.cache_dir, 10000), path)
+        self.assertEqual(file_cache.cache_stats['hits'], hits + 1)
+
+    def test_regenerated_file_is_downloaded_again(self):
+        url = self.serve('a.root', b'a' * 1000)
+        old = file_cache.fetch(url, self.cache_dir, 10000, size=1000, version=1.0)
+        self.serve('a.root', b'b' * 2000)
+        new = file_cache.fetch(url, self.cache_dir, 10000, size=2000, version=2.0)
+        with open(new, 'rb') as cached_file:
+            self.assertEqual(cached_file.read(), b'b' * 2000)
+        self.assertNotEqual(new, old)
+
+    def test_file_changed_since_it_was_probed(self):
+        url = self.serve('a.root', b'a' * 1000)
+        with self.assertRaises(ValueError):
+            file_cache.fetch(url, self.cache_dir, 10000, size=500, version=1.0)
+        # The unexpected copy is not served for that version later
+        self.serve('a.root', b'a' * 500)
+        with open(file_cache.fetch(url, self.cache_dir, 10000, size=500, version=1.0), 'rb') as cached_file:
+            self.assertEqual(cached_file.read(), b'a' * 500)
+
+    def test_least_recently_used_file_is_evicted(self):
+        first = file_cache.fetch(self.serve('a.root', b'a' * 1000), self.cache_dir, 1500)
+        second = file_cache.fetch(self.serve('b.root', b'b' * 1000), self.cache_dir, 1500)
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+    def test_file_larger_than_the_budget(self):
+        with self.assertRaises(Exception):
+            file_cache.fetch(self.serve('a.root', b'a' * 1000), self.cache_dir, 500)
+
+    def test_load_file_fetches_again_after_an_eviction(self):
+        write_sample(os.path.join(self.served_dir, 'Data', 'data_A.4lep.root'), 2000, is_mc=False)
+        fetch = file_cache.fetch
+        paths = []
+
+        def fetch_then_evict(url, **version):
+            # Another replica evicts the first copy between the fetch and the open
+            path = fetch(url, self.cache_dir, 10 ** 9, **version)
+            if not paths:
+                os.remove(path)
+            paths.append(path)
+            return path
+
+        with mock.patch.object(data_processor, 'PATH', self.base_url), \
+             mock.patch.object(data_processor, 'FILE_CACHE_DIR', self.cache_dir), \
+             mock.patch.object(file_cache, 'fetch', fetch_then_evict):
+            tree = data_processor.load_file('data', 'data_A')
+        self.assertEqual(tree.num_entries, 2000)
+        self.assertEqual(len(paths), 2)
+        self.assertEqual(tree.file.file_path, paths[1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# test_pipeline.py
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import pika
+
+# Make the worker and monitor modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workers'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'monitor'))
+import pipeline
+from constants import TASK_QUEUE, RESULT_QUEUE
+from local_broker import LocalBroker
+
+def task_body(sample_name, shard_index, shard_count=2):
+    return json.dumps({'sample_type': 'data', 'sample_name': sample_name, 'fraction': 1.0,
+                       'entry_start': 0, 'entry_stop': 100,
+                       'shard_index': shard_index, 'shard_count': shard_count}).encode()
+
+class RabbitMQBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.broker = LocalBroker(self.spool_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def processor(self, task_count, lost):
+        # Answer each task, reporting the first one twice and never answering the lost shard
+        channel = self.broker.connect().channel()
+        answered = 0
+        for method, properties, body in channel.consume(TASK_QUEUE):
+            task = json.loads(body)
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            headers = {key: task[key] for key in ['sample_type', 'sample_name', 'shard_index', 'shard_count']}
+            if (task['sample_name'], task['shard_index']) != lost:
+                for _ in range(2 if answered == 0 else 1):
+                    channel.basic_publish(exchange='', routing_key=RESULT_QUEUE, body=b'',
+                                          properties=pika.BasicProperties(headers=headers))
+            answered += 1
+            if answered == task_count:
+                break
+        channel.cancel()
+
+    def run_backend(self, task_bodies, lost=None):
+        # Publish a result of another run first, which the backend must drop
+        self.broker.publish(RESULT_QUEUE, b'', pika.BasicProperties(headers={'sample_name': 'stale', 'shard_index': 0}))
+        thread = threading.Thread(target=self.processor, args=(len(task_bodies), lost), daemon=True)
+        thread.start()
+        with mock.patch.object(pipeline, 'connect_to_rabbitmq', self.broker.connect), \
+             mock.patch.object(pipeline, 'PIPELINE_RESULT_TIMEOUT', 0.5):
+            results = list(pipeline.run_rabbitmq(task_bodies, 1))
+        thread.join(5)
+        return [headers for _, headers in results]
+
+    def test_every_shard_is_reported_once(self):
+        results = self.run_backend([task_body('data_A', 0), task_body('data_A', 1), task_body('data_B', 0, 1)])
+        shards = sorted((headers['sample_name'], headers['shard_index']) for headers in results)
+        self.assertEqual(shards, [('data_A', 0), ('data_A', 1), ('data_B', 0)])
+        self.assertFalse(any('error' in headers for headers in results))
+
+    def test_shard_without_a_result_is_reported_as_an_error(self):
+        results = self.run_backend([task_body('data_A', 0), task_body('data_A', 1)], lost=('data_A', 1))
+        self.assertEqual(len(results), 2)
+        self.assertNotIn('error', results[0])
+        self.assertEqual((results[1]['sample_name'], results[1]['shard_index'], results[1]['shard_count']), ('data_A', 1, 2))
+        self.assertIn('No result', results[1]['error'])
+
+if __name__ == '__main__':
+    unittest.main()
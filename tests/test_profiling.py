@@ -0,0 +1,35 @@
+# test_profiling.py
+import os
+import sys
+import unittest
+import pika
+
+# Make the worker modules importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workers'))
+from profiling import TaskProfile, performance_row
+
+def amqp_round_trip(headers):
+    # Encode the headers as the broker receives them, and decode them as a consumer does
+    properties = pika.spec.BasicProperties()
+    properties.decode(b''.join(pika.BasicProperties(headers=headers).encode()))
+    return properties.headers
+
+class TaskProfileTest(unittest.TestCase):
+
+    def test_headers_survive_amqp_encoding(self):
+        profile = TaskProfile()
+        profile.add('read', 1.25)
+        profile.add('cuts', 0.5)
+        profile.count('entries_in', 1000)
+        headers = amqp_round_trip(dict(profile.headers(), published_at_us=1760000000123456))
+
+        row = performance_row(headers, 100, received_at=1760000001.123456)
+        self.assertAlmostEqual(row['read_seconds'], 1.25)
+        self.assertAlmostEqual(row['cuts_seconds'], 0.5)
+        self.assertIsNone(row['open_seconds'])
+        self.assertEqual(row['entries_in'], 1000)
+        self.assertGreaterEqual(row['cpu_seconds'], 0)
+        self.assertAlmostEqual(row['transit_seconds'], 1.0, places=5)
+
+if __name__ == '__main__':
+    unittest.main()
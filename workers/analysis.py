@@ -3,8 +3,8 @@ import sys
 import time
 import json
 import pika
+import functools
 import numpy as np
-import awkward as ak
 import matplotlib.pyplot as plt
 from matplotlib.ticker import AutoMinorLocator
 import matplotlib
@@ -12,60 +12,97 @@ matplotlib.use('Agg')
 
 # Add the common directory to the Python path to access shared modules
 sys.path.append('/app')
-from connect import connect_to_rabbitmq, deserialize_awkward
+import infofile
+from connect import connect_to_rabbitmq, deserialize_awkward, publish_message
+from metrics import BYTES_IN, MESSAGES_IN, start_metrics_server
+from blob_store import BLOB_STORE_DIR, get_blob, delete_blobs, collect_garbage
+from task_stats import update_task_stats
+from profiling import performance_row, write_performance_table, from_microseconds
 from constants import SAMPLES, RESULT_QUEUE, VISUALIZATION_QUEUE, setup_histogram_bins, GeV
+from histograms import (empty_histograms, fill_histograms, add_histograms, histograms_from_awkward,
+                        xsec_weight, scale_histograms, save_histogram_store, load_histogram_store)
 
 # Configure logging to output to the console with a basic format
 import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def calculate_histogram_data(data, bin_edges):
+# Maximum number of unacknowledged results the broker pushes to this worker
+RESULT_PREFETCH = int(os.environ.get('RESULT_PREFETCH', '4'))
+
+# Store of the un-normalised histograms per sample, written after every run
+HISTOGRAM_STORE = os.environ.get('HISTOGRAM_STORE', '/app/output/histograms.json')
+
+# Per-run table of the stage timings and resource usage reported with every result, written next to the plot
+PERFORMANCE_TABLE = os.environ.get('PERFORMANCE_TABLE', os.path.join(os.environ.get('OUTPUT_DIR', '/app/output'), 'performance.csv'))
+
+# Re-weight the stored histograms to the current LUMI and infofile instead of consuming results
+REWEIGHT_ONLY = os.environ.get('REWEIGHT_ONLY', '0') == '1'
+
+def combine_samples(sample_histograms, samples, lumi):
     """
-    Calculate histogram data and errors for the given data and bin edges.
+    Normalise the histograms of each sample and add them up per sample type.
+    
+    MC histograms hold the sums of the scale-factor weights only, so each sample is
+    scaled here by its lumi * xsec / (sumw * red_eff) from the infofile. Changing the
+    luminosity or a cross-section therefore only needs this step to be run again.
     
     Args:
-        data: The input data containing 'mass' field.
-        bin_edges: The edges of the histogram bins.
+        sample_histograms: Dictionary of un-normalised histograms per sample name.
+        samples: Dictionary containing sample information.
+        lumi (float): Integrated luminosity in fb^-1.
     
     Returns:
-        tuple: A tuple containing the histogram data and its errors.
+        dict: The normalised histograms per sample type.
     """
-    # Calculate histogram data and errors
-    data_x, _ = np.histogram(ak.to_numpy(data['mass']), bins=bin_edges)
-    data_x_errors = np.sqrt(data_x)
-    logging.debug("Histogram data and errors calculated successfully.")
-    return data_x, data_x_errors
+    all_histograms = {}
+    for sample_type, sample_info in samples.items():
+        for sample_name in sample_info['list']:
+            histograms = sample_histograms.get(sample_name)
+            if histograms is None:
+                continue
+            if sample_type != 'data':
+                histograms = scale_histograms(histograms, xsec_weight(infofile.infos[sample_name], lumi))
+            all_histograms[sample_type] = add_histograms(all_histograms.get(sample_type), histograms)
+    return all_histograms
 
-def prepare_plot_data(all_data, samples, bin_edges):
+def prepare_plot_data(all_histograms, samples, bin_edges, bin_centres):
     """
-    Prepare data for plotting by organiing it into a structured format.
+    Prepare pre-binned data for plotting from the accumulated histograms.
+    
+    Only bin contents are sent to the visualization worker: the data counts and their
+    errors, the heights of each background MC contribution and of the signal, and the
+    MC statistical uncertainty sqrt(sum w^2) per bin.
     
     Args:
-        all_data: Dictionary containing all processed data.
+        all_histograms: Dictionary of accumulated histograms per sample type.
         samples: Dictionary containing sample information.
         bin_edges: The edges of the histogram bins.
+        bin_centres: The centres of the histogram bins.
     
     Returns:
         dict: A dictionary containing data organized for plotting.
     """
+    def histograms_for(sample_type):
+        return all_histograms.get(sample_type) or empty_histograms(bin_edges)
+    
     # Extract data for plotting
-    data_x, data_x_errors = calculate_histogram_data(all_data['data'], bin_edges)
+    data_x = histograms_for('data')['counts']
+    data_x_errors = np.sqrt(data_x)
     
-    # Extract signal data
-    signal_x = ak.to_numpy(all_data[r'Signal ($m_H$ = 125 GeV)']['mass'])
-    signal_weights = ak.to_numpy(all_data[r'Signal ($m_H$ = 125 GeV)'].totalWeight)
+    # Extract signal histograms
+    signal = histograms_for(r'Signal ($m_H$ = 125 GeV)')
     signal_color = samples[r'Signal ($m_H$ = 125 GeV)']['color']
     
-    # Extract background MC data
-    mc_x = []
-    mc_weights = []
+    # Extract background MC histograms
+    mc_heights = []
     mc_colors = []
     mc_labels = []
+    mc_sumw2 = np.zeros(len(bin_centres))
     
     for s in samples:
         if s not in ['data', r'Signal ($m_H$ = 125 GeV)']:
-            mc_x.append(ak.to_numpy(all_data[s]['mass']))
-            mc_weights.append(ak.to_numpy(all_data[s].totalWeight))
+            mc_heights.append(histograms_for(s)['sumw'])
+            mc_sumw2 += histograms_for(s)['sumw2']
             mc_colors.append(samples[s]['color'])
             mc_labels.append(s)
     
@@ -73,11 +110,10 @@ def prepare_plot_data(all_data, samples, bin_edges):
     plot_data = {
         'data_x': data_x.tolist(),
         'data_x_errors': data_x_errors.tolist(),
-        'signal_x': signal_x.tolist(),
-        'signal_weights': signal_weights.tolist(),
+        'signal_heights': signal['sumw'].tolist(),
         'signal_color': signal_color,
-        'mc_x': [x.tolist() for x in mc_x],
-        'mc_weights': [w.tolist() for w in mc_weights],
+        'mc_heights': [h.tolist() for h in mc_heights],
+        'mc_x_err': np.sqrt(mc_sumw2).tolist(),
         'mc_colors': mc_colors,
         'mc_labels': mc_labels
     }
@@ -85,10 +121,204 @@ def prepare_plot_data(all_data, samples, bin_edges):
     logging.debug("Plot data prepared successfully.")
     return plot_data
 
+def results_complete(state):
+    """
+    Check whether every expected shard result has been received.
+    
+    Args:
+        state (dict): The aggregation state built by new_state.
+    
+    Returns:
+        bool: True if every sample has a result for each of its shard indices.
+    """
+    return all(state['received_shards'].get(sample_name, set()).issuperset(range(shard_count))
+               for sample_name, shard_count in state['expected_shards'].items())
+
+def new_state(bin_edges):
+    """
+    Create an empty aggregation state.
+    
+    The state holds the running histograms per sample, the number of shards expected
+    per sample (learned from the results) and the shard indices received, and the
+    performance row of every result.
+    
+    Args:
+        bin_edges (np.array): The edges of the histogram bins.
+    
+    Returns:
+        dict: The aggregation state.
+    """
+    return {
+        'bin_edges': bin_edges,
+        'sample_histograms': {},
+        'claimed_blobs': [],
+        'task_costs': {},
+        'performance': [],
+        'expected_shards': {name: 1 for sample_info in SAMPLES.values() for name in sample_info['list']},
+        'received_shards': {name: set() for sample_info in SAMPLES.values() for name in sample_info['list']},
+    }
+
+def aggregate_result(state, result, body):
+    """
+    Aggregate one result into the running histograms.
+    
+    Event results are reduced to histograms on arrival and dropped, so the aggregation
+    cost per result is linear in its own size and the accumulated state is
+    O(samples x bins) whatever the number of events. A shard already received (a
+    redelivered task or result) is ignored, so it is never counted twice.
+    
+    Args:
+        state (dict): The aggregation state built by new_state.
+        result (dict): The result metadata (the message headers).
+        body (bytes): The serialized result.
+    """
+    state['expected_shards'][result['sample_name']] = result.get('shard_count', 1)
+    received = state['received_shards'].setdefault(result['sample_name'], set())
+    shard_index = result.get('shard_index', 0)
+    if shard_index in received:
+        logging.warning(f"Ignoring duplicate result for {result['sample_type']} - {result['sample_name']} "
+                        f"(shard {shard_index + 1}/{result.get('shard_count', 1)})")
+        if 'x-blob-ref' in result:
+            state['claimed_blobs'].append(result['x-blob-ref'])
+        return
+    received.add(shard_index)
+    
+    # Claim the payload from the blob store when the message only carries a reference
+    received_at = time.time()
+    payload_bytes = result.get('x-blob-size', len(body))
+    if 'x-blob-ref' in result and not result.get('error'):
+        try:
+            body = get_blob(result)
+            state['claimed_blobs'].append(result['x-blob-ref'])
+        except Exception as e:
+            result = dict(result, error=f"Failed to claim the result payload: {e}")
+    
+    # Keep the timings and resource usage the processor reported for the task
+    state['performance'].append(performance_row(result, payload_bytes, received_at))
+    
+    if result.get('error'):
+        # Skip processing if there was an error in the result
+        logging.error(f"Error processing {result['sample_type']} - {result['sample_name']}: {result['error']}")
+        return
+    
+    # Rebuild the awkward array from the binary message body
+    data = deserialize_awkward(body, result)
+    
+    # Reduce event results to histograms straight away, so no events are kept
+    if result.get('result_kind') == 'histogram':
+        histograms = histograms_from_awkward(data)
+    elif data is None:
+        logging.warning(f"No events received for {result['sample_type']} - {result['sample_name']}")
+        histograms = empty_histograms(state['bin_edges'])
+    else:
+        is_mc = result['sample_type'] != 'data'
+        histograms = fill_histograms(data['mass'], state['bin_edges'], data['scaleFactorWeight'] if is_mc else None)
+    
+    # Add the histograms to the running totals of the sample
+    sample_histograms = state['sample_histograms']
+    sample_histograms[result['sample_name']] = add_histograms(sample_histograms.get(result['sample_name']), histograms)
+    
+    # Record the processing cost of the task for the loader's next run
+    if result.get('estimated_bytes') and 'processing_us' in result:
+        measurement = state['task_costs'].setdefault(result['sample_name'], {'seconds': 0.0, 'bytes': 0})
+        measurement['seconds'] += from_microseconds(result['processing_us'])
+        measurement['bytes'] += result['estimated_bytes']
+    
+    logging.info(f"Received result for {result['sample_type']} - {result['sample_name']} "
+                 f"(shard {result.get('shard_index', 0) + 1}/{result.get('shard_count', 1)})")
+
+def finish_run(state):
+    """
+    Record the processing costs and performance table of a completed run and remove its result payloads.
+    
+    Args:
+        state (dict): The aggregation state built by new_state.
+    """
+    # Keep the measured processing costs for the ordering of the next run
+    try:
+        update_task_stats(state['task_costs'])
+    except OSError as e:
+        logging.warning(f"Failed to update the task stats: {e}")
+    
+    # Write the per-task timings and resource usage of the run
+    try:
+        write_performance_table(PERFORMANCE_TABLE, state['performance'])
+    except OSError as e:
+        logging.warning(f"Failed to write the performance table {PERFORMANCE_TABLE}: {e}")
+    
+    # Every result has been reduced, so the payloads of this run (and stale ones) can go
+    if BLOB_STORE_DIR:
+        freed_bytes = delete_blobs(state['claimed_blobs']) + collect_garbage()
+        logging.info(f"Removed {freed_bytes} bytes of result payloads from the blob store")
+
+def callback(ch, method, properties, body, state=None):
+    """
+    Callback function to aggregate a result from the result queue.
+    
+    Results are aggregated as they arrive, and consuming stops once the expected set
+    of results has been received.
+    
+    Args:
+        ch: The RabbitMQ channel.
+        method: The delivery method.
+        properties: The message properties.
+        body: The message body.
+        state (dict): The aggregation state built by new_state.
+    """
+    MESSAGES_IN.inc(queue=RESULT_QUEUE)
+    BYTES_IN.inc(len(body), source=RESULT_QUEUE)
+    
+    # The result metadata travels in the message headers
+    aggregate_result(state, properties.headers or {}, body)
+    
+    # Acknowledge the message to remove it from the queue
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+    
+    # Stop consuming once the expected set of results is complete
+    if results_complete(state):
+        ch.stop_consuming()
+
+def collect_results(channel, bin_edges):
+    """
+    Consume the result queue until every expected shard result has been received.
+    
+    Peak memory is bounded by the RESULT_PREFETCH results the broker may push ahead of
+    their acknowledgement (each at most one shard of one sample) plus the histograms,
+    independently of the total number of events in the run.
+    
+    Args:
+        channel: The RabbitMQ channel.
+        bin_edges (np.array): The edges of the histogram bins.
+    
+    Returns:
+        dict: The un-normalised histograms per sample name.
+    """
+    expected_samples = sum(len(sample_info['list']) for sample_info in SAMPLES.values())
+    state = new_state(bin_edges)
+    
+    logging.info(f"Analysis worker started. Waiting for {expected_samples} sample results...")
+    
+    # Let the broker push up to RESULT_PREFETCH unacknowledged results at a time
+    channel.basic_qos(prefetch_count=RESULT_PREFETCH)
+    
+    # Aggregate results as they arrive until all samples are received
+    channel.basic_consume(queue=RESULT_QUEUE, on_message_callback=functools.partial(callback, state=state))
+    channel.start_consuming()
+    
+    logging.info(f"Received all {sum(len(shards) for shards in state['received_shards'].values())} results for {expected_samples} samples. Performing analysis...")
+    finish_run(state)
+    return state['sample_histograms']
+
 def main():
     """
     Main function to collect results from RabbitMQ, perform analysis, and send results for visualization.
+    
+    With REWEIGHT_ONLY=1 the results of the last run are read from HISTOGRAM_STORE
+    instead, and only normalised again with the current LUMI and infofile.
     """
+    # Serve the metrics for scraping
+    start_metrics_server()
+    
     # Connect to RabbitMQ
     connection = connect_to_rabbitmq()
     channel = connection.channel()
@@ -100,56 +330,28 @@ def main():
     # Set up histogram bins for analysis
     bin_edges, bin_centres = setup_histogram_bins()
     
-    # Dictionary to hold all processed data
-    all_data = {}
-    expected_samples = sum(len(sample_info['list']) for sample_info in SAMPLES.values())
-    received_samples = 0
-    
     # Get analysis parameters from environment variables
     lumi = float(os.environ.get('LUMI', '10'))
     fraction = float(os.environ.get('FRACTION', '1.0'))
     
-    logging.info(f"Analysis worker started. Waiting for {expected_samples} sample results...")
+    if REWEIGHT_ONLY:
+        # Reuse the histograms of the last run
+        start_time = time.time()
+        bin_edges, sample_histograms = load_histogram_store(HISTOGRAM_STORE)
+        bin_centres = (bin_edges[:-1] + bin_edges[1:]) / 2
+    else:
+        # Aggregate the results of the data processors, and keep them for re-weighting
+        sample_histograms = collect_results(channel, bin_edges)
+        try:
+            save_histogram_store(HISTOGRAM_STORE, bin_edges, sample_histograms)
+        except OSError as e:
+            logging.warning(f"Failed to save the histogram store {HISTOGRAM_STORE}: {e}")
+        start_time = time.time()
     
-    # Process results until all samples are received
-    while received_samples < expected_samples:
-        # Get a message from the result queue
-        method_frame, header_frame, body = channel.basic_get(queue=RESULT_QUEUE)
-        
-        if method_frame:
-            # Parse the result from the message body
-            result = json.loads(body.decode())
-            
-            # Skip processing if there was an error in the result
-            if result['error']:
-                logging.error(f"Error processing {result['sample_type']} - {result['sample_name']}: {result['error']}")
-                channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-                received_samples += 1
-                continue
-            
-            # Deserialize the awkward array data
-            data = deserialize_awkward(result['data'])
-            
-            # Add data to the all_data dictionary
-            if result['sample_type'] not in all_data:
-                all_data[result['sample_type']] = data
-            else:
-                all_data[result['sample_type']] = ak.concatenate([all_data[result['sample_type']], data])
-            
-            logging.info(f"Received result for {result['sample_type']} - {result['sample_name']}")
-            
-            # Acknowledge the message to remove it from the queue
-            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-            
-            received_samples += 1
-        else:
-            # No message available, wait a bit before retrying
-            time.sleep(1)
-    
-    logging.info(f"Received all {received_samples} sample results. Performing analysis...")
-    
-    # Prepare data for plotting
-    plot_data = prepare_plot_data(all_data, SAMPLES, bin_edges)
+    # Normalise the samples to the luminosity and prepare data for plotting
+    all_histograms = combine_samples(sample_histograms, SAMPLES, lumi)
+    plot_data = prepare_plot_data(all_histograms, SAMPLES, bin_edges, bin_centres)
+    logging.info(f"Normalised {len(sample_histograms)} samples to {lumi} fb^-1 in {1000 * (time.time() - start_time):.1f} ms")
     
     # Create analysis task for visualization
     analysis_task = {
@@ -165,12 +367,7 @@ def main():
         delivery_mode=2,  # Make the message persistent
     )
     
-    channel.basic_publish(
-        exchange='',
-        routing_key=VISUALIZATION_QUEUE,
-        body=json.dumps(analysis_task),
-        properties=properties
-    )
+    publish_message(channel, VISUALIZATION_QUEUE, json.dumps(analysis_task), properties)
     
     logging.info("Analysis completed and sent to visualization worker.")
     
@@ -178,4 +375,4 @@ def main():
     connection.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,289 @@
+import os
+import sys
+import math
+import time
+import collections
+import urllib.parse
+import requests
+
+# Add the common directory to the Python path to access shared modules
+sys.path.append('/app')
+from constants import TASK_QUEUE
+
+# Configure logging to output to the console with a basic format
+import logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# RabbitMQ management API polled for the depth and consumers of the task queue
+RABBITMQ_MANAGEMENT_URL = os.environ.get('RABBITMQ_MANAGEMENT_URL', f"http://{os.environ.get('RABBITMQ_HOST', 'rabbitmq')}:15672")
+
+# Deployment scaled by the autoscaler, and its namespace (default: the namespace of the pod)
+AUTOSCALER_DEPLOYMENT = os.environ.get('AUTOSCALER_DEPLOYMENT', 'data-processor')
+AUTOSCALER_NAMESPACE = os.environ.get('AUTOSCALER_NAMESPACE', '')
+
+# Seconds between two decisions
+AUTOSCALER_INTERVAL = float(os.environ.get('AUTOSCALER_INTERVAL', '15'))
+
+# Bounds of the replica count
+MIN_REPLICAS = int(os.environ.get('MIN_REPLICAS', '1'))
+MAX_REPLICAS = int(os.environ.get('MAX_REPLICAS', '8'))
+
+# Time (in seconds) the replicas should take to drain the queue; a deeper queue scales up
+TARGET_DRAIN_SECONDS = float(os.environ.get('TARGET_DRAIN_SECONDS', '120'))
+
+# Processing time (in seconds) of a task assumed until the queue reports acknowledgements
+DEFAULT_TASK_SECONDS = float(os.environ.get('DEFAULT_TASK_SECONDS', '60'))
+
+# Hysteresis: minimum time between two scale-ups, and the window whose highest
+# recommendation a scale-down goes to (so short dips in the queue do not shrink it)
+SCALE_UP_COOLDOWN = float(os.environ.get('SCALE_UP_COOLDOWN', '30'))
+SCALE_DOWN_WINDOW = float(os.environ.get('SCALE_DOWN_WINDOW', '300'))
+
+# Relative change of the replica count below which scale-ups are ignored
+SCALE_TOLERANCE = float(os.environ.get('SCALE_TOLERANCE', '0.1'))
+
+# Weight of the latest measurement in the moving average of the per-replica throughput
+THROUGHPUT_SMOOTHING = 0.3
+
+# Only log the decisions instead of applying them
+AUTOSCALER_DRY_RUN = os.environ.get('AUTOSCALER_DRY_RUN', '0') == '1'
+
+# Service account files mounted into every Kubernetes pod
+SERVICE_ACCOUNT_DIR = '/var/run/secrets/kubernetes.io/serviceaccount'
+
+class Autoscaler:
+    """
+    Replica count controller driven by the depth of the task queue.
+
+    The target is the number of replicas draining the queue (ready and unacknowledged
+    tasks) within TARGET_DRAIN_SECONDS at the observed throughput per replica. Scale-ups
+    are applied straight away, at most once per scale-up cooldown, so bursts are not
+    starved. Scale-downs go to the highest target of the scale-down window, so idle
+    replicas are removed once the queue has stayed short for the whole window.
+    """
+
+    def __init__(self, min_replicas=MIN_REPLICAS, max_replicas=MAX_REPLICAS, drain_seconds=TARGET_DRAIN_SECONDS,
+                 default_task_seconds=DEFAULT_TASK_SECONDS, scale_up_cooldown=SCALE_UP_COOLDOWN,
+                 scale_down_window=SCALE_DOWN_WINDOW, tolerance=SCALE_TOLERANCE):
+        """
+        Args:
+            min_replicas (int): The lowest replica count.
+            max_replicas (int): The highest replica count.
+            drain_seconds (float): The time the replicas should take to drain the queue.
+            default_task_seconds (float): The task time assumed before any throughput is measured.
+            scale_up_cooldown (float): The minimum time between two scale-ups.
+            scale_down_window (float): The time the target must stay lower before scaling down.
+            tolerance (float): The relative increase below which scale-ups are ignored.
+        """
+        self.min_replicas = min_replicas
+        self.max_replicas = max_replicas
+        self.drain_seconds = drain_seconds
+        self.default_task_seconds = default_task_seconds
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_window = scale_down_window
+        self.tolerance = tolerance
+        self.tasks_per_second = None
+        self.recommendations = collections.deque()
+        self.started_at = None
+        self.last_scale_up = None
+
+    def observe_throughput(self, sample):
+        """
+        Update the moving average of the tasks acknowledged per second and per replica.
+
+        Args:
+            sample (dict): The queue sample ('messages', 'consumers', 'ack_rate').
+        """
+        if sample['consumers'] and sample['ack_rate'] > 0:
+            rate = sample['ack_rate'] / sample['consumers']
+            self.tasks_per_second = rate if self.tasks_per_second is None else (
+                THROUGHPUT_SMOOTHING * rate + (1 - THROUGHPUT_SMOOTHING) * self.tasks_per_second)
+
+    def recommend(self, sample):
+        """
+        Compute the replica count draining the current queue within the drain time.
+
+        Args:
+            sample (dict): The queue sample ('messages', 'consumers', 'ack_rate').
+
+        Returns:
+            int: The recommended replica count, within the bounds.
+        """
+        tasks_per_second = self.tasks_per_second or 1 / self.default_task_seconds
+        replicas = math.ceil(sample['messages'] / (tasks_per_second * self.drain_seconds))
+        return max(self.min_replicas, min(self.max_replicas, replicas))
+
+    def decide(self, sample, current, now):
+        """
+        Decide the replica count for the next interval.
+
+        Args:
+            sample (dict): The queue sample ('messages', 'consumers', 'ack_rate').
+            current (int): The current replica count.
+            now (float): The current time in seconds.
+
+        Returns:
+            tuple: The replica count to apply and the raw recommendation.
+        """
+        if self.started_at is None:
+            self.started_at = now
+        self.observe_throughput(sample)
+        recommendation = self.recommend(sample)
+
+        # Keep the recommendations of the scale-down window
+        self.recommendations.append((now, recommendation))
+        while self.recommendations[0][0] < now - self.scale_down_window:
+            self.recommendations.popleft()
+
+        # Scale up straight away when the queue outgrows the replicas, but not again before the cooldown
+        if recommendation > current:
+            if recommendation <= current * (1 + self.tolerance):
+                return current, recommendation
+            if self.last_scale_up is not None and now - self.last_scale_up < self.scale_up_cooldown:
+                return current, recommendation
+            self.last_scale_up = now
+            return recommendation, recommendation
+
+        # Scale down only to the highest recommendation seen over a full window
+        if now - self.started_at < self.scale_down_window:
+            return current, recommendation
+        return min(current, max(target for _, target in self.recommendations)), recommendation
+
+class ManagementApiQueue:
+    """
+    Queue statistics from the RabbitMQ management API.
+    """
+
+    def __init__(self, queue=TASK_QUEUE, url=RABBITMQ_MANAGEMENT_URL, vhost='/'):
+        """
+        Args:
+            queue (str): The name of the queue.
+            url (str): The base URL of the management API.
+            vhost (str): The virtual host of the queue.
+        """
+        self.url = f"{url.rstrip('/')}/api/queues/{urllib.parse.quote(vhost, safe='')}/{urllib.parse.quote(queue, safe='')}"
+        self.auth = (os.environ.get('RABBITMQ_USER', 'atlas'), os.environ.get('RABBITMQ_PASS', 'atlas'))
+
+    def sample(self):
+        """
+        Get the depth, consumers and acknowledgement rate of the queue.
+
+        Returns:
+            dict: The ready and unacknowledged messages ('messages'), the consumer count
+            ('consumers') and the acknowledgements per second ('ack_rate').
+        """
+        response = requests.get(self.url, auth=self.auth, timeout=10)
+        response.raise_for_status()
+        queue = response.json()
+        return {
+            'messages': queue.get('messages', 0),
+            'consumers': queue.get('consumers', 0),
+            'ack_rate': queue.get('message_stats', {}).get('ack_details', {}).get('rate', 0.0),
+        }
+
+class KubernetesScaler:
+    """
+    Replica count of a deployment, read and written through the scale subresource.
+
+    It authenticates with the service account of the pod it runs in.
+    """
+
+    def __init__(self, deployment=AUTOSCALER_DEPLOYMENT, namespace=AUTOSCALER_NAMESPACE):
+        """
+        Args:
+            deployment (str): The name of the deployment.
+            namespace (str): The namespace of the deployment (default: the namespace of the pod).
+        """
+        if not namespace:
+            with open(os.path.join(SERVICE_ACCOUNT_DIR, 'namespace')) as namespace_file:
+                namespace = namespace_file.read().strip()
+        with open(os.path.join(SERVICE_ACCOUNT_DIR, 'token')) as token_file:
+            token = token_file.read().strip()
+        host = os.environ.get('KUBERNETES_SERVICE_HOST', 'kubernetes.default.svc')
+        port = os.environ.get('KUBERNETES_SERVICE_PORT', '443')
+        self.url = f"https://{host}:{port}/apis/apps/v1/namespaces/{namespace}/deployments/{deployment}/scale"
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f"Bearer {token}"
+        self.session.verify = os.path.join(SERVICE_ACCOUNT_DIR, 'ca.crt')
+
+    def get_replicas(self):
+        """
+        Returns:
+            int: The desired replica count of the deployment.
+        """
+        response = self.session.get(self.url, timeout=10)
+        response.raise_for_status()
+        return response.json()['spec'].get('replicas', 0)
+
+    def set_replicas(self, replicas):
+        """
+        Args:
+            replicas (int): The new desired replica count of the deployment.
+        """
+        response = self.session.patch(self.url, json={'spec': {'replicas': replicas}},
+                                      headers={'Content-Type': 'application/merge-patch+json'}, timeout=10)
+        response.raise_for_status()
+
+def run(autoscaler, source, scaler, dry_run=False, interval=AUTOSCALER_INTERVAL, iterations=None):
+    """
+    Poll the queue and apply the replica count decided by the autoscaler.
+
+    In dry-run mode the decisions are only logged. Without a scaler (dry run outside a
+    cluster) the current replica count is the last decision, starting from the number
+    of consumers.
+
+    Args:
+        autoscaler (Autoscaler): The controller.
+        source: The queue statistics, with a sample() method (e.g. ManagementApiQueue).
+        scaler: The replica count of the deployment, with get_replicas() and
+            set_replicas() methods (e.g. KubernetesScaler), or None.
+        dry_run (bool): Whether to only log the decisions.
+        interval (float): The seconds between two decisions.
+        iterations (int): The number of decisions to make, or None to run forever.
+    """
+    current = None
+    iteration = 0
+    while iterations is None or iteration < iterations:
+        iteration += 1
+        try:
+            sample = source.sample()
+            if scaler is not None:
+                current = scaler.get_replicas()
+            elif current is None:
+                current = sample['consumers']
+            target, recommendation = autoscaler.decide(sample, current, time.time())
+            rate = autoscaler.tasks_per_second
+            logging.info(f"Queue holds {sample['messages']} tasks for {sample['consumers']} consumers "
+                         f"({'unknown' if rate is None else f'{rate:.3g}'} tasks/s per replica): "
+                         f"recommend {recommendation}, replicas {current} -> {target}")
+            if target != current:
+                if dry_run:
+                    logging.info(f"Dry run: would scale {AUTOSCALER_DEPLOYMENT} from {current} to {target} replicas")
+                else:
+                    scaler.set_replicas(target)
+                    logging.info(f"Scaled {AUTOSCALER_DEPLOYMENT} from {current} to {target} replicas")
+                if scaler is None:
+                    current = target
+        except Exception as e:
+            logging.error(f"Autoscaler iteration failed: {e}")
+        time.sleep(interval)
+
+def main():
+    """
+    Main function to scale the data processors with the depth of the task queue.
+    """
+    if not AUTOSCALER_DRY_RUN:
+        scaler = KubernetesScaler()
+    else:
+        try:
+            scaler = KubernetesScaler()
+        except OSError:
+            logging.info("Not running in a Kubernetes pod, tracking the replica count locally.")
+            scaler = None
+
+    logging.info(f"Autoscaler started for {AUTOSCALER_DEPLOYMENT} ({MIN_REPLICAS}-{MAX_REPLICAS} replicas"
+                 f"{', dry run' if AUTOSCALER_DRY_RUN else ''})")
+    run(Autoscaler(), ManagementApiQueue(), scaler, AUTOSCALER_DRY_RUN)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# blob_store.py
+import os
+import time
+import hashlib
+import logging
+import tempfile
+
+# Configure logging to output to the console with a basic format
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Shared directory holding large result payloads (empty disables the claim-check)
+BLOB_STORE_DIR = os.environ.get('BLOB_STORE_DIR', '')
+
+# Payloads larger than this many bytes are stored as blobs instead of travelling in the message
+BLOB_THRESHOLD_BYTES = int(os.environ.get('BLOB_THRESHOLD_BYTES', str(1024 * 1024)))
+
+# Age (in seconds) after which a blob nobody has claimed is removed by garbage collection
+BLOB_MAX_AGE = float(os.environ.get('BLOB_MAX_AGE', str(24 * 3600)))
+
+# Extension of the blob files
+BLOB_EXTENSION = '.blob'
+
+def _blob_path(reference, store_dir):
+    """
+    Get the path of a blob, rejecting references that would leave the store.
+
+    Args:
+        reference (str): The blob reference.
+        store_dir (str): The root directory of the store.
+
+    Returns:
+        str: The path of the blob file.
+    """
+    if os.path.basename(reference) != reference:
+        raise Exception(f"Invalid blob reference: {reference}")
+    return os.path.join(store_dir, reference + BLOB_EXTENSION)
+
+def put_blob(body, store_dir=None):
+    """
+    Write a payload to the blob store and return the claim-check headers describing it.
+
+    The blob is named after the SHA-256 of its content and written to a temporary file
+    renamed into place, so readers never see a partial blob.
+
+    Args:
+        body (bytes): The payload.
+        store_dir (str): The root directory of the store (default: BLOB_STORE_DIR).
+
+    Returns:
+        dict: The 'x-blob-ref', 'x-blob-size' and 'x-blob-sha256' headers.
+    """
+    store_dir = store_dir or BLOB_STORE_DIR
+    os.makedirs(store_dir, exist_ok=True)
+    checksum = hashlib.sha256(body).hexdigest()
+    reference = checksum
+
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=store_dir, suffix='.part')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as blob_file:
+            blob_file.write(body)
+        os.replace(temporary_path, _blob_path(reference, store_dir))
+    except Exception:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    logging.debug(f"Stored blob {reference[:12]} ({len(body)} bytes)")
+    return {'x-blob-ref': reference, 'x-blob-size': len(body), 'x-blob-sha256': checksum}
+
+def get_blob(headers, store_dir=None):
+    """
+    Read the payload referenced by claim-check headers and verify it.
+
+    Args:
+        headers (dict): The message headers produced by put_blob.
+        store_dir (str): The root directory of the store (default: BLOB_STORE_DIR).
+
+    Returns:
+        bytes: The payload.
+
+    Raises:
+        Exception: If the blob is missing or its size or checksum does not match.
+    """
+    path = _blob_path(headers['x-blob-ref'], store_dir or BLOB_STORE_DIR)
+    try:
+        with open(path, 'rb') as blob_file:
+            body = blob_file.read()
+    except FileNotFoundError:
+        raise Exception(f"Blob {headers['x-blob-ref']} not found in the blob store")
+
+    if len(body) != headers['x-blob-size']:
+        raise Exception(f"Blob {headers['x-blob-ref']} has {len(body)} bytes, expected {headers['x-blob-size']}")
+    if hashlib.sha256(body).hexdigest() != headers['x-blob-sha256']:
+        raise Exception(f"Blob {headers['x-blob-ref']} failed its checksum")
+    return body
+
+def delete_blobs(references, store_dir=None):
+    """
+    Delete blobs whose results have been consumed.
+
+    Args:
+        references (iterable): The references of the blobs.
+        store_dir (str): The root directory of the store (default: BLOB_STORE_DIR).
+
+    Returns:
+        int: The number of bytes freed.
+    """
+    store_dir = store_dir or BLOB_STORE_DIR
+    freed_bytes = 0
+    for reference in set(references):
+        path = _blob_path(reference, store_dir)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            freed_bytes += size
+        except FileNotFoundError:
+            pass
+    return freed_bytes
+
+def collect_garbage(max_age=None, store_dir=None):
+    """
+    Remove blobs and partial writes older than the maximum age.
+
+    These are left behind by results that were never consumed, e.g. from an aborted run.
+
+    Args:
+        max_age (float): The age in seconds after which a blob is removed (default: BLOB_MAX_AGE).
+        store_dir (str): The root directory of the store (default: BLOB_STORE_DIR).
+
+    Returns:
+        int: The number of bytes freed.
+    """
+    store_dir = store_dir or BLOB_STORE_DIR
+    max_age = max_age if max_age is not None else BLOB_MAX_AGE
+    if not os.path.isdir(store_dir):
+        return 0
+    cutoff = time.time() - max_age
+    freed_bytes = 0
+    for entry in os.scandir(store_dir):
+        if entry.is_file() and entry.name.endswith((BLOB_EXTENSION, '.part')):
+            stat = entry.stat()
+            if stat.st_mtime < cutoff:
+                try:
+                    os.remove(entry.path)
+                    freed_bytes += stat.st_size
+                except FileNotFoundError:
+                    pass
+    return freed_bytes
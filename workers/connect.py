@@ -1,13 +1,40 @@
 import os
 import time
+import json
 import pika
-import pickle
-import base64
 import logging
+import numpy as np
+import awkward as ak
+from metrics import PUBLISH_SECONDS, BYTES_OUT, MESSAGES_OUT
+
+# Compression codecs are optional: without them payloads are sent uncompressed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 # Configure logging to output to the console with a basic format
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Content type of result messages carrying awkward buffers
+PAYLOAD_CONTENT_TYPE = 'application/x-awkward-buffers'
+
+# Alignment (in bytes) of every buffer packed into a message body
+BUFFER_ALIGNMENT = 8
+
+# Compression codec of message payloads: 'none', 'zstd' or 'lz4'
+PAYLOAD_CODEC = os.environ.get('PAYLOAD_CODEC', 'none')
+
+# Compression level used with zstd
+ZSTD_LEVEL = int(os.environ.get('ZSTD_LEVEL', '3'))
+
+# Heartbeat interval (in seconds) negotiated with the broker
+RABBITMQ_HEARTBEAT = int(os.environ.get('RABBITMQ_HEARTBEAT', '60'))
+
 def connect_to_rabbitmq():
     """
     Connect to RabbitMQ with retry logic.
@@ -32,7 +59,7 @@ def connect_to_rabbitmq():
     parameters = pika.ConnectionParameters(
         host=rabbitmq_host,
         credentials=credentials,
-        heartbeat=600,
+        heartbeat=RABBITMQ_HEARTBEAT,
         blocked_connection_timeout=300
     )
     
@@ -54,46 +81,226 @@ def connect_to_rabbitmq():
     logging.error("Failed to connect to RabbitMQ after multiple attempts.")
     raise Exception("Failed to connect to RabbitMQ after multiple attempts")
 
-def serialize_awkward(data):
+def publish_message(channel, queue, body, properties=None, **kwargs):
+    """
+    Publish a message to a queue, recording its latency and size in the metrics.
+    
+    Args:
+        channel: The RabbitMQ channel.
+        queue (str): The name of the queue.
+        body (bytes or str): The message body.
+        properties (pika.BasicProperties): The message properties.
+        **kwargs: Extra arguments of basic_publish, such as mandatory.
+    """
+    with PUBLISH_SECONDS.time(queue=queue):
+        channel.basic_publish(exchange='', routing_key=queue, body=body, properties=properties, **kwargs)
+    BYTES_OUT.inc(len(body), queue=queue)
+    MESSAGES_OUT.inc(queue=queue)
+
+class Publisher:
     """
-    Serialize an awkward array to a base64-encoded string.
+    Long-lived publisher for a single durable queue.
     
-    This function takes an awkward array, serializes it using pickle, and then encodes
-    the serialized data as a base64 string.
+    The publisher keeps its own connection and channel open between messages, uses
+    publisher confirms so a returned publish means the broker has taken the message,
+    and reconnects automatically when the connection or channel has been lost.
+    """
+    
+    def __init__(self, queue, max_retries=3):
+        """
+        Args:
+            queue (str): The name of the queue to publish to.
+            max_retries (int): Number of reconnect attempts per message before giving up.
+        """
+        self.queue = queue
+        self.max_retries = max_retries
+        self.connection = None
+        self.channel = None
+    
+    def connect(self):
+        """
+        Open the connection and a confirming channel, and declare the queue.
+        """
+        self.connection = connect_to_rabbitmq()
+        self.channel = self.connection.channel()
+        self.channel.queue_declare(queue=self.queue, durable=True)
+        self.channel.confirm_delivery()
+        logging.debug(f"Publisher connected for queue {self.queue}.")
+    
+    def publish(self, body, properties):
+        """
+        Publish a message and wait for the broker to confirm it.
+        
+        Args:
+            body (bytes): The message body.
+            properties (pika.BasicProperties): The message properties.
+        
+        Raises:
+            Exception: If the message could not be published after the maximum number of retries.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self.channel is None or self.channel.is_closed:
+                    self.connect()
+                publish_message(self.channel, self.queue, body, properties, mandatory=True)
+                return
+            except pika.exceptions.AMQPError as e:
+                logging.warning(f"Publish to {self.queue} failed ({e!r}), reconnecting (attempt {attempt + 1})...")
+                self.close()
+        
+        raise Exception(f"Failed to publish to {self.queue} after {self.max_retries} retries")
+    
+    def keepalive(self):
+        """
+        Service the connection so heartbeats keep flowing while no message is published.
+        
+        A lost connection is only dropped here; the next publish reconnects.
+        """
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.process_data_events(time_limit=0)
+        except pika.exceptions.AMQPError as e:
+            logging.warning(f"Publisher connection for {self.queue} lost ({e!r}), reconnecting on next publish.")
+            self.close()
+    
+    def close(self):
+        """
+        Close the connection, ignoring errors from an already broken connection.
+        """
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+        self.connection = None
+        self.channel = None
+
+def compress_payload(body, codec):
+    """
+    Compress a payload with the given codec.
+    
+    Args:
+        body (bytes): The uncompressed payload.
+        codec (str): The codec name ('none', 'zstd' or 'lz4').
+    
+    Returns:
+        tuple: The compressed payload and the codec actually used, which is 'none'
+        if the requested codec is not installed.
+    """
+    if codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body), codec
+    if codec == 'lz4' and lz4 is not None:
+        return lz4.frame.compress(body), codec
+    if codec != 'none':
+        logging.warning(f"Payload codec {codec} is not available, sending the payload uncompressed.")
+    return body, 'none'
+
+def decompress_payload(body, codec):
+    """
+    Decompress a payload compressed by compress_payload.
+    
+    Args:
+        body (bytes): The compressed payload.
+        codec (str): The codec named in the x-codec header.
+    
+    Returns:
+        bytes: The uncompressed payload.
+    
+    Raises:
+        Exception: If the codec is unknown or not installed.
+    """
+    if codec == 'none':
+        return body
+    if codec == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(body)
+    if codec == 'lz4' and lz4 is not None:
+        return lz4.frame.decompress(body)
+    raise Exception(f"Cannot decode payload compressed with {codec}")
+
+def serialize_awkward(data, codec=None):
+    """
+    Serialize an awkward array to a binary message body and AMQP headers.
+    
+    This function packs the awkward array (ak.to_packed, dropping the entries that
+    masks and slices only hide), decomposes it with ak.to_buffers and packs the raw
+    buffers back to back (aligned to 8 bytes) into a single binary body. The form,
+    the array length and the position of each buffer in the body are carried in the
+    message headers, so no text encoding of the payload is needed. The packed body is
+    then compressed with the codec named in the x-codec header.
     
     Args:
         data: The awkward array to serialize.
+        codec (str): The compression codec (default: PAYLOAD_CODEC).
     
     Returns:
-        str: A base64-encoded string representing the serialized awkward array, or None if the input is None.
+        tuple: A tuple containing the message body (bytes) and the headers (dict), or
+        (b'', {}) if the input is None.
     """
     if data is None:
-        logging.debug("No data provided to serialize, returning None.")
-        return None
+        logging.debug("No data provided to serialize, returning an empty payload.")
+        return b'', {}
+    
+    # Decompose the array into its form and flat buffers, packing it first so masked or
+    # sliced results only ship the selected events instead of the buffers they index into
+    start_time = time.perf_counter()
+    form, length, container = ak.to_buffers(ak.to_packed(data))
+    
+    # Pack the buffers into one body and record where each of them starts
+    chunks = []
+    buffer_layout = []
+    offset = 0
+    for key, buffer in container.items():
+        raw = memoryview(np.ascontiguousarray(buffer)).cast('B')
+        padding = -offset % BUFFER_ALIGNMENT
+        if padding:
+            chunks.append(bytes(padding))
+            offset += padding
+        buffer_layout.append([key, offset, raw.nbytes])
+        chunks.append(raw)
+        offset += raw.nbytes
+    body, codec = compress_payload(b''.join(chunks), codec or PAYLOAD_CODEC)
+    elapsed = time.perf_counter() - start_time
     
-    # Serialize the data and encode it as a base64 string
-    serialized_data = base64.b64encode(pickle.dumps(data)).decode('utf-8')
-    logging.debug("Data serialized successfully.")
-    return serialized_data
+    headers = {
+        'x-awkward-form': form.to_json(),
+        'x-awkward-length': int(length),
+        'x-awkward-buffers': json.dumps(buffer_layout),
+        'x-codec': codec,
+    }
+    logging.info(f"Encoded {offset} bytes with {codec} to {len(body)} bytes "
+                 f"(ratio {offset / max(len(body), 1):.2f}, {offset / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+    return body, headers
 
-def deserialize_awkward(data_str):
+def deserialize_awkward(body, headers):
     """
-    Deserialize an awkward array from a base64-encoded string.
+    Deserialize an awkward array from a binary message body and AMQP headers.
     
-    This function takes a base64-encoded string, decodes it, and then deserializes
-    it back into an awkward array using pickle.
+    This function rebuilds the awkward array with ak.from_buffers from the form and
+    buffer layout carried in the headers, after decompressing the body with the codec
+    named in the x-codec header. The buffers are memoryview slices of the (decompressed)
+    body, so the resulting array shares memory with it instead of copying it.
     
     Args:
-        data_str (str): The base64-encoded string to deserialize.
+        body (bytes): The binary message body produced by serialize_awkward.
+        headers (dict): The message headers produced by serialize_awkward.
     
     Returns:
-        The deserialized awkward array, or None if the input is None.
+        The deserialized awkward array, or None if the message carries no array.
     """
-    if data_str is None:
-        logging.debug("No data string provided to deserialize, returning None.")
+    if not headers or 'x-awkward-form' not in headers:
+        logging.debug("No array provided to deserialize, returning None.")
         return None
     
-    # Decode the base64 string and deserialize the data
-    deserialized_data = pickle.loads(base64.b64decode(data_str))
-    logging.debug("Data deserialized successfully.")
-    return deserialized_data
\ No newline at end of file
+    # Decompress the body, then slice each buffer out of it without copying it
+    start_time = time.perf_counter()
+    codec = headers.get('x-codec', 'none')
+    view = memoryview(decompress_payload(body, codec))
+    container = {
+        key: view[offset:offset + nbytes]
+        for key, offset, nbytes in json.loads(headers['x-awkward-buffers'])
+    }
+    deserialized_data = ak.from_buffers(headers['x-awkward-form'], headers['x-awkward-length'], container)
+    elapsed = time.perf_counter() - start_time
+    logging.info(f"Decoded {len(body)} bytes with {codec} to {view.nbytes} bytes "
+                 f"({view.nbytes / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+    return deserialized_data
@@ -1,4 +1,5 @@
 # constants.py
+import os
 import numpy as np
 import logging
 
@@ -9,8 +10,8 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 MeV = 0.001  # 1 MeV = 0.001 GeV
 GeV = 1.0    # 1 GeV = 1.0 GeV (base unit)
 
-# ATLAS Open Data directory URL
-PATH = "https://atlas-opendata.web.cern.ch/atlas-opendata/samples/2020/4lep/"
+# ATLAS Open Data directory URL, or a local directory with the same layout (e.g. synthetic data)
+PATH = os.environ.get('ATLAS_DATA_PATH', "https://atlas-opendata.web.cern.ch/atlas-opendata/samples/2020/4lep/")
 
 # Variables to extract from the ROOT files
 VARIABLES = ['lep_pt', 'lep_eta', 'lep_phi', 'lep_E', 'lep_charge', 'lep_type']
@@ -58,4 +59,4 @@ def setup_histogram_bins(xmin=80*GeV, xmax=250*GeV, step_size=5*GeV):
     bin_centres = np.arange(start=xmin+step_size/2, stop=xmax+step_size/2, step=step_size)
     
     logging.debug(f"Histogram bins set up with xmin={xmin}, xmax={xmax}, step_size={step_size}.")
-    return bin_edges, bin_centres
\ No newline at end of file
+    return bin_edges, bin_centres
\ No newline at end of file
@@ -4,46 +4,394 @@ import sys
 import time
 import json
 import pika
+import bisect
+import uproot
 import infofile
-from connect import connect_to_rabbitmq
-from constants import SAMPLES, PATH, TASK_QUEUE
+from concurrent.futures import ThreadPoolExecutor
+from connect import connect_to_rabbitmq, publish_message
+from metrics import CACHE_REQUESTS, start_metrics_server
+from task_stats import TASK_STATS_PATH, load_task_stats, seconds_per_byte
+from constants import SAMPLES, PATH, VARIABLES, TASK_QUEUE, RESULT_QUEUE
 import requests
 import logging
 
 # Configure logging to output to the console with a basic format
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def check_file_exists(file_path):
+# Number of entries per task (0 publishes one task per file)
+SHARD_SIZE = int(os.environ.get('SHARD_SIZE', '250000'))
+
+# Maximum number of files probed at the same time
+PROBE_CONCURRENCY = int(os.environ.get('PROBE_CONCURRENCY', '8'))
+
+# Local catalog of probed file sizes and entry layouts, reused by later launches
+CATALOG_PATH = os.environ.get('CATALOG_PATH', '/app/output/catalog.json')
+
+# Seconds a catalog entry is trusted without probing its file again (0 probes every file on every launch)
+CATALOG_MAX_AGE = float(os.environ.get('CATALOG_MAX_AGE', '86400'))
+
+def create_session(pool_size):
     """
-    Check if a file exists at a given URL.
+    Create an HTTP session whose connection pool can serve pool_size concurrent requests.
     
     Args:
-        file_path (str): The URL of the file to check.
+        pool_size (int): The maximum number of pooled connections per host.
     
     Returns:
-        bool: True if the file exists, False otherwise.
+        requests.Session: The HTTP session.
     """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def probe_file(file_path, session=None):
+    """
+    Check if a file exists at a given URL or local path and get its size and version.
+    
+    The version is the modification time of a local file, or the ETag (else the
+    Last-Modified header) of a remote one, so a regenerated file gets a new one.
+    
+    Args:
+        file_path (str): The URL or local path of the file to check.
+        session (requests.Session): The HTTP session to use, or None for a one-off request.
+    
+    Returns:
+        tuple: True if the file exists (False otherwise), its size in bytes (or None if
+        unknown) and its version (or None if unknown).
+    """
+    # Local files (ATLAS_DATA_PATH pointing to a directory) are checked on disk
+    if not file_path.startswith(('http://', 'https://')):
+        if os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            return True, stat.st_size, stat.st_mtime
+        return False, None, None
+    
     try:
         # Send a HEAD request to check if the file exists
-        response = requests.head(file_path)
-        return response.status_code == 200
+        response = (session or requests).head(file_path, allow_redirects=True, timeout=30)
+        if response.status_code != 200:
+            return False, None, None
+        size = response.headers.get('Content-Length')
+        modified = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        return True, int(size) if size is not None else None, modified
     except Exception as e:
         logging.error(f"Error checking file existence at {file_path}: {e}")
-        return False
+        return False, None, None
+
+def get_entry_layout(file_path):
+    """
+    Get the number of entries and the basket boundaries of a sample's tree.
+    
+    The tree metadata is read from the file itself. If the file cannot be opened the
+    entry count is unknown, and the file is processed as one task over the requested
+    fraction of its actual tree: sharding on the infofile event count would fix the
+    end of the last shard and silently drop the entries of a longer tree.
+    
+    Args:
+        file_path (str): The URL of the ROOT file.
+    
+    Returns:
+        tuple: The number of entries (or None if unknown) and the sorted list of
+        basket boundaries (empty if unknown).
+    """
+    try:
+        with uproot.open(file_path) as root_file:
+            tree = root_file["mini"]
+            return tree.num_entries, list(tree[VARIABLES[0]].entry_offsets)
+    except Exception as e:
+        logging.warning(f"Could not read the entry layout of {file_path}, processing it as one task: {e}")
+    return None, []
+
+def plan_shards(num_entries, shard_size, basket_offsets=()):
+    """
+    Split an entry range into shards of roughly shard_size entries.
+    
+    Shard boundaries are moved forward to the next basket boundary where those are
+    known, so no basket has to be decompressed by two processors.
+    
+    Args:
+        num_entries (int): The number of entries to split.
+        shard_size (int): The target number of entries per shard (0 disables sharding).
+        basket_offsets (list): Sorted entry numbers at which baskets start.
+    
+    Returns:
+        list: A list of (entry_start, entry_stop) tuples covering [0, num_entries).
+    """
+    boundaries = [0]
+    if shard_size > 0:
+        while boundaries[-1] + shard_size < num_entries:
+            stop = boundaries[-1] + shard_size
+            if basket_offsets:
+                index = bisect.bisect_left(basket_offsets, stop)
+                stop = basket_offsets[index] if index < len(basket_offsets) else num_entries
+            if stop >= num_entries:
+                break
+            boundaries.append(stop)
+    boundaries.append(num_entries)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def estimate_task_bytes(description, entry_start, entry_stop):
+    """
+    Estimate the number of file bytes a task reads from the share of entries it covers.
+    
+    Args:
+        description (dict): The description of the file.
+        entry_start (int): First entry of the task, or None for the whole file.
+        entry_stop (int): Entry the task stops before, or None for the whole file.
+    
+    Returns:
+        int: The estimated number of bytes, or None if the file size is unknown.
+    """
+    size, num_entries = description['size'], description['num_entries']
+    if size is None or not num_entries or entry_start is None:
+        return size
+    return int(size * (entry_stop - entry_start) / num_entries)
+
+def mean_bytes_per_entry(descriptions):
+    """
+    Average the file size per entry over the described files.
+    
+    Args:
+        descriptions (dict): The descriptions of the files, None for missing files.
+    
+    Returns:
+        float: The mean number of bytes per entry, or 0 if no file has both a size and an entry count.
+    """
+    known = [d for d in descriptions.values() if d is not None and d['size'] and d['num_entries']]
+    if not known:
+        return 0
+    return sum(d['size'] for d in known) / sum(d['num_entries'] for d in known)
+
+def estimate_task_cost(sample_name, estimated_bytes, entries, bytes_per_entry, stats):
+    """
+    Estimate the processing time of a task, used to publish the most expensive tasks first.
+    
+    The cost is the number of bytes the task reads (estimated from its entries when the
+    file size is unknown) times the historical processing seconds per byte of the sample.
+    
+    Args:
+        sample_name (str): The name of the sample.
+        estimated_bytes (int): The estimated number of bytes read by the task, or None.
+        entries (int): The number of entries of the task.
+        bytes_per_entry (float): The mean file size per entry.
+        stats (dict): The historical processing costs.
+    
+    Returns:
+        float: The estimated cost (seconds, or bytes without any history).
+    """
+    if estimated_bytes is None:
+        estimated_bytes = entries * bytes_per_entry
+    return estimated_bytes * seconds_per_byte(stats, sample_name)
+
+def describe_file(file_path, session=None, cached=None):
+    """
+    Probe a file and read the entry layout of its tree.
+    
+    The tree is not read again when the cached description was made for the same
+    size and version of the file.
+    
+    Args:
+        file_path (str): The URL of the ROOT file.
+        session (requests.Session): The HTTP session to use for the probe.
+        cached (dict): The catalog description of the file, or None.
+    
+    Returns:
+        dict: The file size, version, number of entries and basket boundaries (the
+        cached description itself if it still applies), or None if the file does not exist.
+    """
+    exists, size, modified = probe_file(file_path, session)
+    if not exists:
+        return None
+    if (cached is not None and (size, modified) != (None, None)
+            and (cached.get('size'), cached.get('modified')) == (size, modified)):
+        return cached
+    num_entries, basket_offsets = get_entry_layout(file_path)
+    return {'size': size, 'modified': modified, 'num_entries': num_entries, 'basket_offsets': basket_offsets}
+
+def load_catalog(catalog_path):
+    """
+    Load the catalog of previously probed files.
+    
+    Args:
+        catalog_path (str): The path of the catalog file.
+    
+    Returns:
+        dict: The file descriptions keyed by URL (empty if there is no catalog).
+    """
+    try:
+        with open(catalog_path) as catalog_file:
+            return json.load(catalog_file)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable catalog {catalog_path}: {e}")
+        return {}
+
+def save_catalog(catalog_path, catalog):
+    """
+    Save the catalog of probed files, replacing the previous one atomically.
+    
+    Args:
+        catalog_path (str): The path of the catalog file.
+        catalog (dict): The file descriptions keyed by URL.
+    """
+    try:
+        os.makedirs(os.path.dirname(catalog_path) or '.', exist_ok=True)
+        with open(catalog_path + '.tmp', 'w') as catalog_file:
+            json.dump(catalog, catalog_file)
+        os.replace(catalog_path + '.tmp', catalog_path)
+    except Exception as e:
+        logging.warning(f"Could not save catalog {catalog_path}: {e}")
+
+def describe_files(files, catalog, concurrency=8, max_age=0):
+    """
+    Describe a set of files, probing them concurrently.
+    
+    Files probed less than max_age seconds ago are described from the catalog without
+    any request. The other files are probed, but the tree of a cataloged file is only
+    read again when its size or version changed, e.g. after it was regenerated.
+    Descriptions whose entry layout was read from the file itself are added to the catalog.
+    
+    Args:
+        files (list): The URLs of the files.
+        catalog (dict): The catalog of previously probed files, updated in place.
+        concurrency (int): The maximum number of files probed at the same time.
+        max_age (float): The seconds a catalog entry is trusted without a probe (0 probes every file).
+    
+    Returns:
+        dict: The description of every file keyed by URL (None for missing files).
+    """
+    now = time.time()
+    descriptions = {file_path: catalog[file_path] for file_path in files
+                    if file_path in catalog and now - catalog[file_path].get('probed_at', 0) < max_age}
+    hits = len(descriptions)
+    stale = [file_path for file_path in files if file_path not in descriptions]
+    if stale:
+        with create_session(concurrency) as session, ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = executor.map(lambda file_path: describe_file(file_path, session, catalog.get(file_path)), stale)
+            for file_path, description in zip(stale, results):
+                descriptions[file_path] = description
+                if description is not None:
+                    description['probed_at'] = now
+                if description is not None and description is catalog.get(file_path):
+                    hits += 1
+                elif description is not None and description['basket_offsets']:
+                    catalog[file_path] = description
+                else:
+                    catalog.pop(file_path, None)
+    CACHE_REQUESTS.inc(hits, cache='catalog', outcome='hit')
+    CACHE_REQUESTS.inc(len(files) - hits, cache='catalog', outcome='miss')
+    
+    logging.info(f"Described {len(files)} files ({hits} from the catalog, {len(stale)} probed)")
+    return descriptions
+
+def sample_file_path(sample_type, sample_name):
+    """
+    Build the URL of a sample's ROOT file.
+    
+    Args:
+        sample_type (str): The type of sample ('data' or 'MC').
+        sample_name (str): The name of the sample.
+    
+    Returns:
+        str: The URL of the file.
+    """
+    if sample_type == 'data':
+        prefix = "Data/"
+    else:
+        prefix = "MC/mc_" + str(infofile.infos[sample_name]["DSID"]) + "."
+    return PATH + prefix + sample_name + ".4lep.root"
+
+def plan_tasks(fraction):
+    """
+    Describe every sample file and plan its tasks.
+    
+    Args:
+        fraction (float): Fraction of each file to process.
+    
+    Returns:
+        tuple: The tasks as (estimated cost, task) tuples in descending order of cost, and
+        the error results (headers) of the samples whose file does not exist.
+    """
+    # Describe every sample file, probing the ones not recently cataloged concurrently
+    files = [(sample_type, sample_name, sample_file_path(sample_type, sample_name))
+             for sample_type, sample_info in SAMPLES.items() for sample_name in sample_info['list']]
+    catalog = load_catalog(CATALOG_PATH)
+    descriptions = describe_files([file_path for _, _, file_path in files], catalog, PROBE_CONCURRENCY, CATALOG_MAX_AGE)
+    save_catalog(CATALOG_PATH, catalog)
+    
+    # Historical processing costs and the size per entry of files whose size is unknown
+    stats = load_task_stats(TASK_STATS_PATH)
+    bytes_per_entry = mean_bytes_per_entry(descriptions)
+    
+    # Create the tasks for each sample, with their estimated cost
+    tasks = []
+    missing = []
+    for sample_type, sample_name, file_path in files:
+        description = descriptions[file_path]
+        
+        # Skip the sample if the file does not exist, reporting it so the analysis does not wait for it
+        if description is None:
+            logging.warning(f"File not found: {file_path}")
+            missing.append({
+                'sample_type': sample_type,
+                'sample_name': sample_name,
+                'shard_index': 0,
+                'shard_count': 1,
+                'error': f"File not found: {file_path}"
+            })
+            continue
+        
+        # Split the requested fraction of the file into entry-range shards
+        num_entries = description['num_entries']
+        if num_entries is None:
+            shards = [(None, None)]
+        else:
+            shards = plan_shards(int(num_entries * fraction), SHARD_SIZE, description['basket_offsets'])
+        
+        for shard_index, (entry_start, entry_stop) in enumerate(shards):
+            # Create a task dictionary for the shard
+            task = {
+                'sample_type': sample_type,
+                'sample_name': sample_name,
+                'fraction': fraction,
+                'entry_start': entry_start,
+                'entry_stop': entry_stop,
+                'shard_index': shard_index,
+                'shard_count': len(shards),
+                'estimated_bytes': estimate_task_bytes(description, entry_start, entry_stop),
+                'file_size': description['size'],
+                'file_version': description.get('modified')
+            }
+            if entry_start is None:
+                entries = infofile.infos.get(sample_name, {}).get('events', 0) * fraction
+            else:
+                entries = entry_stop - entry_start
+            tasks.append((estimate_task_cost(sample_name, task['estimated_bytes'], entries, bytes_per_entry, stats), task))
+    
+    # Longest first, so no large task starts last and stretches the run
+    tasks.sort(key=lambda cost_and_task: cost_and_task[0], reverse=True)
+    return tasks, missing
 
 def main():
     """
     Main function to distribute processing tasks to the RabbitMQ queue.
     
-    This function connects to RabbitMQ, creates tasks for each sample, and sends them to the task queue.
-    It skips samples whose files do not exist and logs the progress.
+    This function connects to RabbitMQ, creates tasks for each sample, and sends them to the task queue
+    in descending order of estimated cost. It skips samples whose files do not exist and logs the progress.
     """
+    # Serve the metrics for scraping
+    start_metrics_server()
+    
     # Connect to RabbitMQ
     connection = connect_to_rabbitmq()
     channel = connection.channel()
     
-    # Declare the task queue as durable to ensure message persistence
+    # Declare the task and result queues as durable to ensure message persistence
     channel.queue_declare(queue=TASK_QUEUE, durable=True)
+    channel.queue_declare(queue=RESULT_QUEUE, durable=True)
     
     # Set message persistence properties
     properties = pika.BasicProperties(
@@ -51,51 +399,37 @@ def main():
     )
     
     # Get analysis parameters from environment variables
-    lumi = float(os.environ.get('LUMI', '10'))
     fraction = float(os.environ.get('FRACTION', '1.0'))
     
-    logging.info(f"Starting data loader with lumi={lumi}, fraction={fraction}")
+    logging.info(f"Starting data loader with fraction={fraction}")
     
-    # Create and send tasks for each sample
-    task_count = 0
-    for sample_type, sample_info in SAMPLES.items():
-        for sample_name in sample_info['list']:
-            # Create the file path based on the sample type
-            if sample_type == 'data':
-                prefix = "Data/"
-                file_path = PATH + prefix + sample_name + ".4lep.root"
-            else:
-                prefix = "MC/mc_" + str(infofile.infos[sample_name]["DSID"]) + "."
-                file_path = PATH + prefix + sample_name + ".4lep.root"
-            
-            # Skip the sample if the file does not exist
-            if not check_file_exists(file_path):
-                logging.warning(f"File not found: {file_path}")
-                continue
-            
-            # Create a task dictionary for the sample
-            task = {
-                'sample_type': sample_type,
-                'sample_name': sample_name,
-                'lumi': lumi,
-                'fraction': fraction
-            }
-            
-            # Send the task to the task queue
-            channel.basic_publish(
-                exchange='',
-                routing_key=TASK_QUEUE,
-                body=json.dumps(task),
-                properties=properties
+    # Describe the sample files and plan their tasks
+    tasks, missing = plan_tasks(fraction)
+    
+    # Tell the analysis worker not to wait for missing samples
+    for headers in missing:
+        publish_message(
+            channel,
+            RESULT_QUEUE,
+            b'',
+            pika.BasicProperties(
+                delivery_mode=2,  # Make message persistent
+                headers=headers
             )
-            
-            logging.info(f"Sent task for {sample_type} - {sample_name}")
-            task_count += 1
+        )
+    
+    # Send the tasks in their planned order
+    for cost, task in tasks:
+        publish_message(channel, TASK_QUEUE, json.dumps(task), properties)
+        
+        logging.info(f"Sent task for {task['sample_type']} - {task['sample_name']} "
+                     f"(shard {task['shard_index'] + 1}/{task['shard_count']}, "
+                     f"entries {task['entry_start']}-{task['entry_stop']}, estimated cost {cost:.3g})")
     
-    logging.info(f"Sent {task_count} tasks to the queue")
+    logging.info(f"Sent {len(tasks)} tasks to the queue")
     
     # Close the RabbitMQ connection
     connection.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,29 +1,118 @@
 import os
 import sys
+import time
 import json
 import pika
+import math
+import inspect
+import functools
+import threading
+import collections
 import uproot
 import awkward as ak
 import vector
 import numpy as np
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # Add the common directory to the Python path to access shared modules
 sys.path.append('/app')
 import infofile
-from connect import connect_to_rabbitmq, serialize_awkward
-from constants import PATH, VARIABLES, WEIGHT_VARIABLES, TASK_QUEUE, RESULT_QUEUE, MeV, GeV
+import file_cache
+from file_cache import FILE_CACHE_DIR
+from skim_cache import SKIM_CACHE_DIR, skim_key, load_skim, save_skim
+from blob_store import BLOB_STORE_DIR, BLOB_THRESHOLD_BYTES, put_blob
+from connect import connect_to_rabbitmq, serialize_awkward, Publisher, PAYLOAD_CONTENT_TYPE, RABBITMQ_HEARTBEAT
+from constants import PATH, VARIABLES, WEIGHT_VARIABLES, TASK_QUEUE, RESULT_QUEUE, MeV, GeV, setup_histogram_bins
+from histograms import empty_histograms, fill_histograms, histograms_to_awkward
+from kernels import HAS_NUMBA, select_and_mass
+from profiling import TaskProfile, current_rss, memory_limit, resource_usage, to_microseconds, from_microseconds
+from metrics import (TASKS_IN_FLIGHT, TASK_SECONDS, EVENTS_PROCESSED, EVENTS_SELECTED, STAGE_SECONDS,
+                     BYTES_IN, MESSAGES_IN, start_metrics_server)
 
 # Configure logging to output to the console with a basic format
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def load_file(sample_type, sample_name):
+# Result mode: 'events' ships every selected event, 'histogram' ships per-sample mass histograms
+PROCESSING_MODE = os.environ.get('PROCESSING_MODE', 'events')
+
+# Size of a chunk in memory, in bytes (0 derives it from the container memory limit)
+CHUNK_BYTES = int(os.environ.get('CHUNK_BYTES', '0'))
+
+# Share of the memory left free at the start of a task that the chunks in flight may use
+CHUNK_MEMORY_FRACTION = float(os.environ.get('CHUNK_MEMORY_FRACTION', '0.5'))
+
+# Peak memory of processing a chunk (cut masks, vector and awkward intermediates) over the
+# size of its arrays as read, measured at 2-2.3 on the open-data branches
+CHUNK_MEMORY_OVERHEAD = 3.0
+
+# Smallest number of entries per chunk, so tiny budgets still make progress
+MIN_STEP_SIZE = 1000
+
+# Weight of the latest chunk in the moving average of the bytes per entry
+BYTES_PER_ENTRY_SMOOTHING = 0.5
+
+# CPU budget of this worker: threads processing chunks, and threads decompressing and interpreting baskets
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '1'))
+CHUNK_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+UPROOT_EXECUTOR = uproot.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+# Times a file is fetched from the file cache before reading it remotely, if other replicas keep evicting it
+FILE_CACHE_ATTEMPTS = 3
+
+# Read the selection branches first and the other branches only for baskets with selected events
+LAZY_BRANCHES = os.environ.get('LAZY_BRANCHES', '0') == '1'
+
+# Branches needed to compute the selection in two-phase mode
+SELECTION_VARIABLES = ['lep_type', 'lep_charge']
+
+# Lossy payload mode: ship the mass and weights as float32
+PAYLOAD_FLOAT32 = os.environ.get('PAYLOAD_FLOAT32', '0') == '1'
+
+# Headers identifying the shard a result belongs to, kept in error results
+RESULT_KEYS = ['sample_type', 'sample_name', 'shard_index', 'shard_count']
+
+# Tasks the broker may deliver ahead of their acknowledgement, each processed in its own thread.
+# With more than one, the download of the next file overlaps the processing of the current one.
+TASK_PREFETCH = int(os.environ.get('TASK_PREFETCH', '2'))
+TASK_EXECUTOR = ThreadPoolExecutor(max_workers=TASK_PREFETCH)
+
+# Use the fused numba kernel for the cuts and the invariant mass when numba is installed
+USE_COMPILED_KERNEL = os.environ.get('COMPILED_KERNEL', '0') == '1' and HAS_NUMBA
+if os.environ.get('COMPILED_KERNEL', '0') == '1' and not HAS_NUMBA:
+    logging.warning("COMPILED_KERNEL is set but numba is not installed, using the awkward/vector path.")
+
+class TimedExecutor(uproot.source.futures.Executor):
+    """
+    Wrapper of an uproot executor adding the run time of every task to a stage of a task profile.
+    """
+    
+    def __init__(self, executor, profile, stage):
+        """
+        Args:
+            executor (uproot.source.futures.Executor): The executor running the tasks.
+            profile (TaskProfile): The profile of the task being processed.
+            stage (str): The stage the run time is added to.
+        """
+        self.executor = executor
+        self.profile = profile
+        self.stage = stage
+    
+    def submit(self, task, /, *args, **kwargs):
+        def timed_task(*args, **kwargs):
+            with self.profile.timed(self.stage):
+                return task(*args, **kwargs)
+        return self.executor.submit(timed_task, *args, **kwargs)
+
+def load_file(sample_type, sample_name, file_size=None, file_version=None):
     """
     Load a ROOT file and return the tree.
     
     Args:
         sample_type (str): The type of sample ('data' or 'MC').
         sample_name (str): The name of the sample.
+        file_size (int): The size of the file probed by the loader, or None if unknown.
+        file_version (float): The modification time of the file probed by the loader, or None if unknown.
     
     Returns:
         uproot.TTree: The ROOT tree from the file.
@@ -36,6 +125,25 @@ def load_file(sample_type, sample_name):
         prefix = "MC/mc_" + str(infofile.infos[sample_name]["DSID"]) + "."
         file_path = PATH + prefix + sample_name + ".4lep.root"
     
+    # Read remote files through the shared file cache when it is enabled, keyed by the
+    # version the task was planned for. Another replica may evict the cached file before
+    # it is opened, in which case it is fetched again.
+    if FILE_CACHE_DIR and file_path.startswith(('http://', 'https://')):
+        for attempt in range(FILE_CACHE_ATTEMPTS):
+            try:
+                cached_path = file_cache.fetch(file_path, size=file_size, version=file_version)
+            except ValueError:
+                # The file changed since the task was planned, so it no longer matches the task
+                raise
+            except Exception as e:
+                logging.warning(f"File cache unavailable for {file_path}, reading it remotely: {e}")
+                break
+            try:
+                logging.debug(f"Loading file: {cached_path}")
+                return uproot.open(cached_path + ":mini")
+            except FileNotFoundError:
+                logging.info(f"Cached copy of {file_path} was evicted before it was opened, fetching it again")
+    
     logging.debug(f"Loading file: {file_path}")
     return uproot.open(file_path + ":mini")
 
@@ -86,62 +194,359 @@ def calc_mass(lep_pt, lep_eta, lep_phi, lep_E):
     logging.debug("Calculated invariant mass.")
     return invariant_mass
 
-def calc_weight(weight_variables, sample, events, lumi=10):
+def calc_scale_factors(weight_variables, events):
     """
-    Calculate event weights for MC samples.
+    Calculate the per-event product of the MC weight and scale factors.
+    
+    This is the event weight without the per-sample normalisation, which does not
+    depend on lumi or on the infofile.
     
     Args:
         weight_variables (list): List of weight variables.
-        sample (str): The name of the sample.
         events (ak.Array): Array of events.
-        lumi (float): Integrated luminosity in fb^-1.
     
     Returns:
-        ak.Array: Array of total event weights.
+        ak.Array: Array of per-event scale-factor products.
     """
-    info = infofile.infos[sample]
-    xsec_weight = (lumi * 1000 * info["xsec"]) / (info["sumw"] * info["red_eff"])  # *1000 to go from fb-1 to pb-1
-    total_weight = xsec_weight
+    scale_factors = 1.0
     for variable in weight_variables:
-        total_weight = total_weight * events[variable]
-    logging.debug("Calculated event weights.")
-    return total_weight
+        scale_factors = scale_factors * events[variable]
+    logging.debug("Calculated event scale factors.")
+    return scale_factors
 
-def process_data(tree, sample_name, is_mc=False, lumi=10, fraction=1.0):
+def selection_mask(data):
     """
-    Process data from a ROOT file.
+    Compute the mask of events passing the lepton type and charge cuts.
+    
+    Args:
+        data (ak.Array): Events with at least the lep_type and lep_charge fields.
+    
+    Returns:
+        np.array: Boolean array, True for the events to keep.
+    """
+    return ak.to_numpy(~cut_lep_type(data['lep_type']) & ~cut_lep_charge(data['lep_charge']))
+
+def basket_ranges(entry_offsets, entries):
+    """
+    Get the entry ranges of the baskets that contain any of the given entries.
+    
+    Args:
+        entry_offsets (np.array): The basket boundaries of a branch.
+        entries (np.array): Sorted entry numbers.
+    
+    Returns:
+        list: A list of [entry_start, entry_stop] ranges, adjacent baskets merged.
+    """
+    ranges = []
+    for basket in np.unique(np.searchsorted(entry_offsets, entries, side='right') - 1):
+        start, stop = int(entry_offsets[basket]), int(entry_offsets[basket + 1])
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = stop
+        else:
+            ranges.append([start, stop])
+    return ranges
+
+def decompressed_bytes(branch, ranges):
+    """
+    Estimate the number of bytes decompressed to read entry ranges of a branch.
+    
+    The estimate only uses the branch metadata: the compressed size of every basket
+    overlapping the ranges, scaled by the compression ratio of the branch.
+    
+    Args:
+        branch (uproot.TBranch): The branch.
+        ranges (list): A list of [entry_start, entry_stop] ranges.
+    
+    Returns:
+        int: The estimated number of uncompressed bytes.
+    """
+    entry_offsets = branch.entry_offsets
+    compressed = 0
+    for basket in range(branch.num_baskets):
+        if any(entry_offsets[basket] < stop and start < entry_offsets[basket + 1] for start, stop in ranges):
+            compressed += branch.basket_compressed_bytes(basket)
+    return int(compressed * branch.compression_ratio)
+
+def read_arrays(tree, branches, entry_start, entry_stop, profile):
+    """
+    Read an entry range of some branches, timing the read, decompression and interpretation.
+    
+    Args:
+        tree (uproot.TTree): The ROOT tree to read.
+        branches (list): The branches to read.
+        entry_start (int): First entry to read.
+        entry_stop (int): Entry to stop before.
+        profile (TaskProfile): The profile of the task being processed.
+    
+    Returns:
+        ak.Array: The branches as an awkward array.
+    """
+    with profile.timed('read'):
+        return tree.arrays(branches, library="ak", entry_start=entry_start, entry_stop=entry_stop,
+                           decompression_executor=TimedExecutor(UPROOT_EXECUTOR, profile, 'decompress'),
+                           interpretation_executor=TimedExecutor(UPROOT_EXECUTOR, profile, 'interpret'))
+
+def read_preselected(tree, branches, entry_start, entry_stop, read_stats, profile):
+    """
+    Read a chunk in two phases, decompressing the kinematics only where events pass the cuts.
+    
+    The selection branches are read first for the whole chunk and the cut mask is
+    computed. The other branches are then read only for the baskets that contain at
+    least one selected event.
+    
+    Args:
+        tree (uproot.TTree): The ROOT tree to read.
+        branches (list): The branches to read.
+        entry_start (int): First entry of the chunk.
+        entry_stop (int): Entry the chunk stops before.
+        read_stats (dict): Running estimates of the bytes decompressed by an eager read
+            ('eager_bytes') and by this read ('lazy_bytes'), updated in place.
+        profile (TaskProfile): The profile of the task being processed.
+    
+    Returns:
+        ak.Array: The selected events with all requested branches.
+    """
+    # Phase 1: selection branches only
+    selection = read_arrays(tree, SELECTION_VARIABLES, entry_start, entry_stop, profile)
+    with profile.timed('cuts'):
+        mask = selection_mask(selection)
+    other_branches = [branch for branch in branches if branch not in SELECTION_VARIABLES]
+    
+    # Phase 2: the other branches, for the baskets holding selected events only
+    selected_entries = np.nonzero(mask)[0] + entry_start
+    ranges = [[max(start, entry_start), min(stop, entry_stop)]
+              for start, stop in basket_ranges(np.asarray(tree[other_branches[0]].entry_offsets), selected_entries)]
+    parts = []
+    for start, stop in ranges:
+        part = read_arrays(tree, other_branches, start, stop, profile)
+        parts.append(part[mask[start - entry_start:stop - entry_start]])
+    if parts:
+        others = ak.concatenate(parts)
+    else:
+        others = read_arrays(tree, other_branches, entry_start, entry_start, profile)
+    
+    # Account for the bytes decompressed, compared with reading every branch for the whole chunk
+    chunk = [[entry_start, entry_stop]]
+    for branch in branches:
+        read_stats['eager_bytes'] += decompressed_bytes(tree[branch], chunk)
+        read_stats['lazy_bytes'] += decompressed_bytes(tree[branch], chunk if branch in SELECTION_VARIABLES else ranges)
+    
+    logging.debug(f"Two-phase read kept {len(selected_entries)} of {entry_stop - entry_start} entries.")
+    return ak.zip({branch: selection[branch][mask] if branch in SELECTION_VARIABLES else others[branch]
+                   for branch in branches}, depth_limit=1)
+
+def process_chunk(tree, branches, is_mc, entry_start, entry_stop, profile):
+    """
+    Read one chunk of a tree, apply the cuts and calculate mass and weights.
     
     Args:
         tree (uproot.TTree): The ROOT tree to process.
-        sample_name (str): The name of the sample.
+        branches (list): The branches to read.
         is_mc (bool): Whether the sample is MC or data.
-        lumi (float): Integrated luminosity in fb^-1.
-        fraction (float): Fraction of events to process.
+        entry_start (int): First entry of the chunk.
+        entry_stop (int): Entry the chunk stops before.
+        profile (TaskProfile): The profile of the task being processed.
     
     Returns:
-        ak.Array: Processed data as an awkward array.
+        tuple: The processed chunk (ak.Array) and its read statistics (dict), including
+        the in-memory bytes per entry of the arrays read.
     """
-    sample_data = []
+    read_stats = {'eager_bytes': 0, 'lazy_bytes': 0}
+    profile.count('entries_in', entry_stop - entry_start)
+    if LAZY_BRANCHES:
+        data = read_preselected(tree, branches, entry_start, entry_stop, read_stats, profile)
+    else:
+        data = read_arrays(tree, branches, entry_start, entry_stop, profile)
+    read_stats['bytes_per_entry'] = data.nbytes / max(1, entry_stop - entry_start)
     
-    # Iterate through the tree in chunks
-    for data in tree.iterate(VARIABLES + (WEIGHT_VARIABLES if is_mc else []), 
-                            library="ak", 
-                            entry_stop=tree.num_entries * fraction,
-                            step_size=1000000):
+    if USE_COMPILED_KERNEL:
+        # Apply cuts and calculate invariant mass in a single compiled pass, timed as the cuts
+        with profile.timed('cuts'):
+            mask, mass = select_and_mass(data)
+            data = data[mask]
+            data['mass'] = mass
+    else:
         # Apply cuts
-        lep_type = data['lep_type']
-        data = data[~cut_lep_type(lep_type)]
-        lep_charge = data['lep_charge']
-        data = data[~cut_lep_charge(lep_charge)]
+        with profile.timed('cuts'):
+            lep_type = data['lep_type']
+            data = data[~cut_lep_type(lep_type)]
+            lep_charge = data['lep_charge']
+            data = data[~cut_lep_charge(lep_charge)]
         
         # Calculate invariant mass
-        data['mass'] = calc_mass(data['lep_pt'], data['lep_eta'], data['lep_phi'], data['lep_E'])
+        with profile.timed('mass'):
+            data['mass'] = calc_mass(data['lep_pt'], data['lep_eta'], data['lep_phi'], data['lep_E'])
+    
+    # Calculate the scale-factor weights for MC samples, the lumi/xsec normalisation is applied by the analysis
+    if is_mc:
+        with profile.timed('weights'):
+            data['scaleFactorWeight'] = calc_scale_factors(WEIGHT_VARIABLES, data)
+    
+    return data, read_stats
+
+class ChunkMemory:
+    """
+    Memory budget shared by the chunks of every task running in this process.
+    
+    The headroom under the container limit (cgroup memory.max) is measured when a task
+    starts with no other task running, and the processed chunks kept by all running
+    tasks are taken off it. Without CHUNK_BYTES, each chunk gets CHUNK_MEMORY_FRACTION
+    of what is left, shared by the MAX_WORKERS chunks of every running task, so tasks
+    running at the same time (TASK_PREFETCH, or the threads of pipeline.py) never each
+    claim the same free memory.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running_tasks = 0
+        self.baseline_rss = 0
+        self.kept_bytes = 0
+    
+    def start_task(self):
+        """
+        Register a task whose chunks take part in the budget.
+        """
+        with self.lock:
+            if not self.running_tasks:
+                self.baseline_rss = current_rss()
+                self.kept_bytes = 0
+            self.running_tasks += 1
+    
+    def keep(self, nbytes):
+        """
+        Take a processed chunk kept by a running task off the budget.
         
-        # Calculate weights for MC samples
-        if is_mc:
-            data['totalWeight'] = calc_weight(WEIGHT_VARIABLES, sample_name, data, lumi)
+        Args:
+            nbytes (int): The in-memory size of the processed chunk.
+        """
+        with self.lock:
+            self.kept_bytes += nbytes
+    
+    def finish_task(self, kept_bytes):
+        """
+        Release the processed chunks of a task that has finished reading.
+        
+        Args:
+            kept_bytes (int): The in-memory size of the processed chunks of the task.
+        """
+        with self.lock:
+            self.running_tasks -= 1
+            self.kept_bytes -= kept_bytes
+    
+    def chunk_budget(self):
+        """
+        Get the memory a chunk may use while it is processed.
         
-        sample_data.append(data)
+        Returns:
+            int: The budget in bytes.
+        """
+        if CHUNK_BYTES:
+            return CHUNK_BYTES
+        with self.lock:
+            available = max(0, memory_limit() - self.baseline_rss - self.kept_bytes)
+            chunks_in_flight = MAX_WORKERS * max(1, self.running_tasks)
+        return int(available * CHUNK_MEMORY_FRACTION / chunks_in_flight)
+
+# Chunk memory budget of the tasks of this process
+CHUNK_MEMORY = ChunkMemory()
+
+def chunk_step_size(chunk_bytes, bytes_per_entry, max_step_size):
+    """
+    Get the number of entries of a chunk fitting a memory budget.
+    
+    Args:
+        chunk_bytes (int): The memory budget of the chunk.
+        bytes_per_entry (float): The in-memory size of an entry as read.
+        max_step_size (int): The largest number of entries wanted in the chunk.
+    
+    Returns:
+        int: The number of entries, at least MIN_STEP_SIZE (or max_step_size if smaller).
+    """
+    fitting = int(chunk_bytes / max(1.0, bytes_per_entry * CHUNK_MEMORY_OVERHEAD))
+    return min(max_step_size, max(MIN_STEP_SIZE, fitting))
+
+def process_data(tree, sample_name, is_mc=False, fraction=1.0, entry_start=None, entry_stop=None, profile=None):
+    """
+    Process data from a ROOT file.
+    
+    The entry range is split into chunks processed by up to MAX_WORKERS threads, and
+    the chunks are merged back in entry order. Chunks are sized to a memory budget
+    (CHUNK_MEMORY, shared with the other running tasks) from the bytes per entry of the branches, and the estimate is
+    refined with every processed chunk. MC events carry their scale-factor
+    weight without the lumi/xsec normalisation, which the analysis applies per sample.
+    
+    Args:
+        tree (uproot.TTree): The ROOT tree to process.
+        sample_name (str): The name of the sample.
+        is_mc (bool): Whether the sample is MC or data.
+        fraction (float): Fraction of events to process (used when no entry range is given).
+        entry_start (int): First entry to process, or None to start at the beginning.
+        entry_stop (int): Entry to stop before, or None to stop after the requested fraction.
+        profile (TaskProfile): The profile collecting stage timings and counters, or None.
+    
+    Returns:
+        ak.Array: Processed data as an awkward array.
+    """
+    branches = VARIABLES + (WEIGHT_VARIABLES if is_mc else [])
+    profile = profile or TaskProfile()
+    
+    # Without an explicit shard, process the requested fraction of the tree
+    if entry_start is None:
+        entry_start = 0
+    if entry_stop is None:
+        entry_stop = int(tree.num_entries * fraction)
+    
+    # Estimate the bytes per entry from the branch metadata until a chunk has been measured
+    bytes_per_entry = sum(tree[branch].uncompressed_bytes for branch in branches) / max(1, tree.num_entries)
+    max_step_size = max(1, math.ceil((entry_stop - entry_start) / MAX_WORKERS))  # Give every worker thread a share
+    
+    # Process up to MAX_WORKERS chunks in parallel, sizing each new chunk with the memory left
+    # (which shrinks as selected events accumulate) and the bytes per entry measured on the
+    # previous chunks, and keep the chunks in entry order
+    pending = collections.deque()
+    results = []
+    step_sizes = []
+    peak_rss = current_rss()
+    kept_bytes = 0
+    exhausted = False
+    chunk_start = entry_start
+    CHUNK_MEMORY.start_task()
+    try:
+        while chunk_start < entry_stop or pending:
+            while chunk_start < entry_stop and len(pending) < MAX_WORKERS:
+                chunk_bytes = CHUNK_MEMORY.chunk_budget()
+                step_size = chunk_step_size(chunk_bytes, bytes_per_entry, max_step_size)
+                exhausted = exhausted or chunk_bytes < MIN_STEP_SIZE * bytes_per_entry * CHUNK_MEMORY_OVERHEAD
+                chunk_stop = min(chunk_start + step_size, entry_stop)
+                pending.append(CHUNK_EXECUTOR.submit(process_chunk, tree, branches, is_mc, chunk_start, chunk_stop, profile))
+                step_sizes.append(chunk_stop - chunk_start)
+                chunk_start = chunk_stop
+            data, read_stats = pending.popleft().result()
+            results.append((data, read_stats))
+            kept_bytes += data.nbytes
+            CHUNK_MEMORY.keep(data.nbytes)
+            bytes_per_entry = (BYTES_PER_ENTRY_SMOOTHING * read_stats['bytes_per_entry']
+                               + (1 - BYTES_PER_ENTRY_SMOOTHING) * bytes_per_entry)
+            peak_rss = max(peak_rss, current_rss())
+    finally:
+        CHUNK_MEMORY.finish_task(kept_bytes)
+    sample_data = [data for data, _ in results]
+    profile.count('bytes_read', tree.file.source.num_requested_bytes)
+    
+    logging.info(f"Read {sample_name} in {len(step_sizes)} chunks of {min(step_sizes, default=0)}-{max(step_sizes, default=0)} "
+                 f"entries ({bytes_per_entry:.0f} bytes per entry), "
+                 f"RSS up to {peak_rss / 1e6:.0f} MB (process peak {resource_usage()[1] / 1e6:.0f} MB) "
+                 f"of a {memory_limit() / 1e6:.0f} MB limit")
+    if exhausted:
+        logging.warning(f"The selected events of {sample_name} left too little memory for the chunks; "
+                        f"lower SHARD_SIZE or use PROCESSING_MODE=histogram")
+    
+    if LAZY_BRANCHES:
+        eager_bytes = sum(read_stats['eager_bytes'] for _, read_stats in results)
+        lazy_bytes = sum(read_stats['lazy_bytes'] for _, read_stats in results)
+        if eager_bytes:
+            logging.info(f"Two-phase read of {sample_name} decompressed ~{lazy_bytes} bytes "
+                         f"instead of ~{eager_bytes} ({100 * lazy_bytes / eager_bytes:.1f}%)")
     
     # Concatenate all data chunks
     if sample_data:
@@ -151,104 +556,322 @@ def process_data(tree, sample_name, is_mc=False, lumi=10, fraction=1.0):
         logging.warning(f"No data processed for sample: {sample_name}")
         return None
 
-def callback(ch, method, properties, body):
+def histogram_data(data, is_mc=False):
     """
-    Callback function to process a task from the queue.
+    Reduce processed events to mass histograms over the analysis binning.
     
     Args:
-        ch: The RabbitMQ channel.
-        method: The delivery method.
-        properties: The message properties.
-        body: The message body.
+        data (ak.Array): Processed data as returned by process_data, or None.
+        is_mc (bool): Whether the sample is MC (weighted) or data.
+    
+    Returns:
+        ak.Array: The counts, sum of weights and sum of squared weights per bin.
+    """
+    bin_edges, _ = setup_histogram_bins()
+    if data is None:
+        histograms = empty_histograms(bin_edges)
+    else:
+        histograms = fill_histograms(data['mass'], bin_edges, data['scaleFactorWeight'] if is_mc else None)
+    logging.debug("Reduced processed data to histograms.")
+    return histograms_to_awkward(histograms)
+
+def downcast_float32(data, fields):
     """
+    Store the given fields of processed events as float32.
+    
+    Args:
+        data (ak.Array): Processed data as returned by process_data.
+        fields (list): The fields to downcast; fields missing from the data are skipped.
+    
+    Returns:
+        ak.Array: The data with the fields stored as float32.
+    """
+    for field in fields:
+        if field in data.fields:
+            data[field] = ak.values_astype(data[field], np.float32)
+    return data
+
+def publish_result(publisher, body, headers):
+    """
+    Publish a result message to the result queue.
+    
+    Args:
+        publisher (Publisher): The long-lived publisher for the result queue.
+        body (bytes): The serialized result.
+        headers (dict): The result metadata and payload description.
+    """
+    # Set message persistence
+    properties = pika.BasicProperties(
+        delivery_mode=2,  # Make message persistent
+        content_type=PAYLOAD_CONTENT_TYPE,
+        headers=headers
+    )
+    
+    publisher.publish(body, properties)
+
+def task_skim_key(task):
+    """
+    Build the skim cache key of a task.
+    
+    The key covers the data location (PATH) and the sample, the size and version of
+    the file probed by the loader, the source of the cut, mass and scale-factor
+    functions, whether the compiled kernel is used (its mass is float64 where the
+    vectorised path gives float32), the branches read and the requested entry range,
+    so changing any of them (including regenerating the file at the same path)
+    produces a new skim.
+    Skims hold no lumi/xsec normalisation, so neither is part of the key.
+    
+    Args:
+        task (dict): The task.
+    
+    Returns:
+        str: The skim cache key, or None if the task does not identify its file.
+    """
+    if task.get('file_size') is None and task.get('file_version') is None:
+        return None
+    is_mc = task['sample_type'] != 'data'
+    return skim_key(
+        data_path=PATH,
+        sample_type=task['sample_type'],
+        sample_name=task['sample_name'],
+        file_size=task.get('file_size'),
+        file_version=task.get('file_version'),
+        definition=[inspect.getsource(function) for function in (cut_lep_type, cut_lep_charge, calc_mass, calc_scale_factors)],
+        compiled_kernel=USE_COMPILED_KERNEL,
+        variables=VARIABLES + (WEIGHT_VARIABLES if is_mc else []),
+        fraction=task['fraction'],
+        entry_start=task.get('entry_start'),
+        entry_stop=task.get('entry_stop'),
+    )
+
+def handle_task(body):
+    """
+    Process a task and build its result message.
+    
+    This runs in a task thread and never touches the RabbitMQ connections.
+    
+    Args:
+        body: The message body of the task.
+    
+    Returns:
+        tuple: The result body (bytes) and headers (dict), with an 'error' header and
+        an empty body if the task failed, or None headers if the task is unreadable.
+        Both carry the stage timings and counters of the task profile.
+    """
+    start_time = time.time()
+    profile = TaskProfile()
     try:
         # Parse the task from the message body
         task = json.loads(body.decode())
-        logging.info(f"Processing {task['sample_type']} - {task['sample_name']}")
+        logging.info(f"Processing {task['sample_type']} - {task['sample_name']} "
+                     f"(entries {task.get('entry_start')}-{task.get('entry_stop')})")
         
-        # Load the ROOT file
-        tree = load_file(task['sample_type'], task['sample_name'])
-        
-        # Process the data
+        # Serve the task from the skim cache when the same selection was already run
         is_mc = task['sample_type'] != 'data'
-        processed_data = process_data(
-            tree, 
-            task['sample_name'], 
-            is_mc, 
-            task['lumi'], 
-            task['fraction']
-        )
+        key = task_skim_key(task) if SKIM_CACHE_DIR else None
+        found, processed_data = False, None
+        if key:
+            with profile.timed('skim'):
+                found, processed_data = load_skim(key)
+        
+        if not found:
+            # Load the ROOT file
+            with profile.timed('open'):
+                tree = load_file(task['sample_type'], task['sample_name'], task.get('file_size'), task.get('file_version'))
+            
+            # Process the data
+            processed_data = process_data(
+                tree, 
+                task['sample_name'], 
+                is_mc, 
+                task['fraction'],
+                task.get('entry_start'),
+                task.get('entry_stop'),
+                profile
+            )
+            
+            # Keep the skim for later runs
+            if key:
+                try:
+                    with profile.timed('skim'):
+                        save_skim(key, processed_data)
+                except OSError as e:
+                    logging.warning(f"Failed to store skim for {task['sample_name']}: {e}")
+        profile.count('entries_out', 0 if processed_data is None else len(processed_data))
         
-        # Create the result dictionary
-        result = {
+        with profile.timed('serialize'):
+            # Reduce the events to histograms when running in histogram mode
+            if PROCESSING_MODE == 'histogram':
+                processed_data = histogram_data(processed_data, is_mc)
+            
+            # Halve the size of the mass and weight columns in lossy payload mode
+            if PAYLOAD_FLOAT32 and PROCESSING_MODE == 'events' and processed_data is not None:
+                processed_data = downcast_float32(processed_data, ['mass', 'scaleFactorWeight'])
+            
+            # Serialize the result into a binary body, describing it in the headers
+            result_body, headers = serialize_awkward(processed_data)
+        headers.update({
             'sample_type': task['sample_type'],
             'sample_name': task['sample_name'],
-            'data': serialize_awkward(processed_data),
-            'error': None
-        }
-        
-        # Send the result to the result queue
-        connection = connect_to_rabbitmq()
-        channel = connection.channel()
-        channel.queue_declare(queue=RESULT_QUEUE, durable=True)
+            'result_kind': PROCESSING_MODE,
+            'shard_index': task.get('shard_index', 0),
+            'shard_count': task.get('shard_count', 1),
+            'processing_us': to_microseconds(time.time() - start_time),
+        })
         
-        # Set message persistence
-        properties = pika.BasicProperties(
-            delivery_mode=2,  # Make message persistent
-        )
+        # Report the task size with its processing time, for the loader's cost estimates
+        if task.get('estimated_bytes') is not None:
+            headers['estimated_bytes'] = task['estimated_bytes']
         
-        channel.basic_publish(
-            exchange='',
-            routing_key=RESULT_QUEUE,
-            body=json.dumps(result),
-            properties=properties
-        )
+        # Move large payloads to the blob store and send only a claim-check reference
+        if BLOB_STORE_DIR and len(result_body) > BLOB_THRESHOLD_BYTES:
+            with profile.timed('store'):
+                headers.update(put_blob(result_body))
+            result_body = b''
         
-        connection.close()
+        # Report where the task spent its time, and the entries, bytes and memory it used
+        headers.update(profile.headers())
         
         logging.info(f"Processed {task['sample_type']} - {task['sample_name']}")
-        
-        # Acknowledge the message
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return result_body, headers
         
     except Exception as e:
         logging.error(f"Error processing task: {e}")
-        # Acknowledge the message even on error to avoid reprocessing
-        ch.basic_ack(delivery_tag=method.delivery_tag)
         
-        # Send an error result
+        # Build an error result
         try:
             task = json.loads(body.decode())
-            result = {
+            headers = {
                 'sample_type': task['sample_type'],
                 'sample_name': task['sample_name'],
-                'data': None,
+                'shard_index': task.get('shard_index', 0),
+                'shard_count': task.get('shard_count', 1),
                 'error': str(e)
             }
-            
-            connection = connect_to_rabbitmq()
-            channel = connection.channel()
-            channel.queue_declare(queue=RESULT_QUEUE, durable=True)
-            
-            properties = pika.BasicProperties(
-                delivery_mode=2,  # Make message persistent
-            )
-            
-            channel.basic_publish(
-                exchange='',
-                routing_key=RESULT_QUEUE,
-                body=json.dumps(result),
-                properties=properties
-            )
-            
-            connection.close()
+            headers.update(profile.headers())
+        except Exception as e:
+            logging.error(f"Failed to build error result: {e}")
+            headers = None
+        return b'', headers
+
+def record_task_metrics(headers, seconds):
+    """
+    Add the profile of a finished task to the worker metrics.
+    
+    Args:
+        headers (dict): The result headers built by handle_task, or None.
+        seconds (float): The processing time of the task.
+    """
+    headers = headers or {}
+    TASK_SECONDS.observe(seconds, outcome='error' if not headers or 'error' in headers else 'ok')
+    EVENTS_PROCESSED.inc(headers.get('entries_in', 0))
+    EVENTS_SELECTED.inc(headers.get('entries_out', 0))
+    BYTES_IN.inc(headers.get('bytes_read', 0), source='file')
+    for stage, stage_us in (headers.get('stage_us') or {}).items():
+        STAGE_SECONDS.inc(from_microseconds(stage_us), stage=stage)
+
+def process_task(body):
+    """
+    Process a task with handle_task, counting it in the worker metrics.
+    
+    Args:
+        body: The message body of the task.
+    
+    Returns:
+        tuple: The result body and headers returned by handle_task.
+    """
+    start_time = time.perf_counter()
+    with TASKS_IN_FLIGHT.track():
+        result_body, headers = handle_task(body)
+    record_task_metrics(headers, time.perf_counter() - start_time)
+    return result_body, headers
+
+def finish_task(ch, delivery_tag, publisher, result_body, headers):
+    """
+    Publish the result of a task and acknowledge it.
+    
+    This runs on the connection thread, scheduled with add_callback_threadsafe. If the
+    result cannot be published, a small error result is published in its place so the
+    analysis can close the shard; if that fails too (the broker is unreachable), the
+    task is requeued instead of acknowledged, so its result is never lost.
+    
+    Args:
+        ch: The RabbitMQ channel the task was delivered on.
+        delivery_tag (int): The delivery tag of the task.
+        publisher (Publisher): The long-lived publisher for the result queue.
+        result_body (bytes): The serialized result.
+        headers (dict): The result metadata and payload description, or None to only acknowledge.
+    """
+    if headers is not None:
+        try:
+            # Send the result to the result queue, stamped so the analysis can measure the transit time
+            headers['published_at_us'] = to_microseconds(time.time())
+            publish_result(publisher, result_body, headers)
         except Exception as e:
-            logging.error(f"Failed to send error result: {e}")
+            logging.error(f"Failed to send result for {headers.get('sample_name')}: {e}")
+            try:
+                error_headers = {key: headers[key] for key in RESULT_KEYS if key in headers}
+                error_headers['error'] = f"Failed to publish the result: {e}"
+                publish_result(publisher, b'', error_headers)
+            except Exception as e:
+                logging.error(f"Failed to send error result for {headers.get('sample_name')}, requeueing the task: {e}")
+                ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+                return
+    
+    # Acknowledge the task once its result (or error result) is on the result queue
+    ch.basic_ack(delivery_tag=delivery_tag)
+
+def run_task(connection, ch, delivery_tag, body, publisher):
+    """
+    Process a task in a task thread and hand its result back to the connection thread.
+    
+    Args:
+        connection (pika.BlockingConnection): The connection the task was delivered on.
+        ch: The RabbitMQ channel the task was delivered on.
+        delivery_tag (int): The delivery tag of the task.
+        body: The message body of the task.
+        publisher (Publisher): The long-lived publisher for the result queue.
+    """
+    result_body, headers = process_task(body)
+    connection.add_callback_threadsafe(
+        functools.partial(finish_task, ch, delivery_tag, publisher, result_body, headers))
+
+def callback(ch, method, properties, body, publisher=None):
+    """
+    Callback function to hand a task from the queue to a task thread.
+    
+    The connection thread returns immediately, so it keeps sending heartbeats while
+    the task is processed.
+    
+    Args:
+        ch: The RabbitMQ channel.
+        method: The delivery method.
+        properties: The message properties.
+        body: The message body.
+        publisher (Publisher): The long-lived publisher for the result queue.
+    """
+    MESSAGES_IN.inc(queue=TASK_QUEUE)
+    BYTES_IN.inc(len(body), source=TASK_QUEUE)
+    TASK_EXECUTOR.submit(run_task, ch.connection, ch, method.delivery_tag, body, publisher)
+
+def keep_publisher_alive(connection, publisher):
+    """
+    Service the publisher connection periodically from the connection thread.
+    
+    Args:
+        connection (pika.BlockingConnection): The consumer connection.
+        publisher (Publisher): The long-lived publisher for the result queue.
+    """
+    publisher.keepalive()
+    connection.call_later(RABBITMQ_HEARTBEAT / 2, functools.partial(keep_publisher_alive, connection, publisher))
 
 def main():
     """
     Main function to process tasks from the queue.
     """
+    # Serve the metrics for scraping
+    start_metrics_server()
+    
     # Connect to RabbitMQ
     connection = connect_to_rabbitmq()
     channel = connection.channel()
@@ -257,15 +880,23 @@ def main():
     channel.queue_declare(queue=TASK_QUEUE, durable=True)
     
     # Set prefetch count to limit the number of unacknowledged messages
-    channel.basic_qos(prefetch_count=1)
+    channel.basic_qos(prefetch_count=TASK_PREFETCH)
+    
+    # Reuse one confirming publisher connection for all results, owned by the connection thread
+    publisher = Publisher(RESULT_QUEUE)
+    keep_publisher_alive(connection, publisher)
     
     # Set up the consumer with the callback function
-    channel.basic_consume(queue=TASK_QUEUE, on_message_callback=callback)
+    channel.basic_consume(queue=TASK_QUEUE, on_message_callback=functools.partial(callback, publisher=publisher))
     
     logging.info("Data processor worker started. Waiting for tasks...")
     
     # Start consuming messages
-    channel.start_consuming()
+    try:
+        channel.start_consuming()
+    finally:
+        TASK_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        publisher.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
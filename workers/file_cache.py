@@ -0,0 +1,223 @@
+# file_cache.py
+import os
+import time
+import fcntl
+import hashlib
+import logging
+import tempfile
+import threading
+import requests
+from metrics import CACHE_REQUESTS
+
+# Configure logging to output to the console with a basic format
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Directory of the shared file cache (empty disables caching)
+FILE_CACHE_DIR = os.environ.get('FILE_CACHE_DIR', '')
+
+# Size budget of the file cache in megabytes
+FILE_CACHE_SIZE_MB = float(os.environ.get('FILE_CACHE_SIZE_MB', '4096'))
+
+# Size of the chunks streamed from the remote server
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Hit/miss counters of this process
+cache_stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'bytes_downloaded': 0, 'evictions': 0}
+_stats_lock = threading.Lock()
+
+def _count(**increments):
+    """
+    Increment the cache counters of this process.
+
+    Args:
+        **increments: The amount to add to each counter.
+    """
+    with _stats_lock:
+        for name, value in increments.items():
+            cache_stats[name] += value
+
+def _locked(path):
+    """
+    Open a lock file and take an exclusive lock on it.
+
+    The lock is released when the returned file object is closed, so this is used
+    as a context manager. The lock works across processes sharing the cache volume.
+
+    Args:
+        path (str): The path of the lock file.
+
+    Returns:
+        file: The open lock file.
+    """
+    lock_file = open(path, 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+def _cache_layout(cache_dir):
+    """
+    Create the cache directories if needed.
+
+    The cache is content-addressed: 'objects' holds each file once under the SHA-256
+    of its content (keeping the file extension), 'refs' maps the SHA-256 of a URL and
+    its version to the object name, and 'locks' holds the lock files used to coordinate replicas
+    sharing the volume.
+
+    Args:
+        cache_dir (str): The root directory of the cache.
+
+    Returns:
+        tuple: The paths of the objects, refs and locks directories.
+    """
+    directories = tuple(os.path.join(cache_dir, name) for name in ('objects', 'refs', 'locks'))
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    return directories
+
+def _lookup(objects_dir, ref_path):
+    """
+    Resolve a URL reference to a cached object.
+
+    Args:
+        objects_dir (str): The objects directory.
+        ref_path (str): The path of the reference file of the URL.
+
+    Returns:
+        str: The path of the cached object, or None if the URL is not cached.
+    """
+    try:
+        with open(ref_path) as ref_file:
+            object_path = os.path.join(objects_dir, ref_file.read().strip())
+    except FileNotFoundError:
+        return None
+    return object_path if os.path.exists(object_path) else None
+
+def _object_name(url, content_hash):
+    """
+    Name a cached object after its content hash and the extension of its URL.
+
+    Args:
+        url (str): The URL of the file.
+        content_hash (str): The SHA-256 of the file content.
+
+    Returns:
+        str: The file name of the object.
+    """
+    return content_hash + os.path.splitext(url.split('?')[0])[1]
+
+def _download(url, objects_dir):
+    """
+    Download a URL into the objects directory under the hash of its content.
+
+    The file is streamed to a temporary file in the same directory and renamed into
+    place, so readers never see a partially written object.
+
+    Args:
+        url (str): The URL to download.
+        objects_dir (str): The objects directory.
+
+    Returns:
+        tuple: The object name and the size of the file in bytes.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=objects_dir, suffix='.part')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as output, requests.get(url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                output.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        object_name = _object_name(url, digest.hexdigest())
+        os.replace(temporary_path, os.path.join(objects_dir, object_name))
+    except Exception:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return object_name, size
+
+def evict(cache_dir, max_bytes):
+    """
+    Remove the least recently used objects until the cache fits its size budget.
+
+    Objects are ordered by modification time, which is refreshed on every hit.
+    Files already opened by a reader stay readable until closed.
+
+    Args:
+        cache_dir (str): The root directory of the cache.
+        max_bytes (int): The size budget of the cache in bytes.
+    """
+    objects_dir, _, locks_dir = _cache_layout(cache_dir)
+    with _locked(os.path.join(locks_dir, 'evict.lock')):
+        objects = []
+        for entry in os.scandir(objects_dir):
+            if entry.is_file() and not entry.name.endswith('.part'):
+                stat = entry.stat()
+                objects.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in objects)
+        for _, size, path in sorted(objects):
+            if total_bytes <= max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+            _count(evictions=1)
+            logging.info(f"Evicted {path} ({size} bytes) from the file cache")
+
+def fetch(url, cache_dir=None, max_bytes=None, size=None, version=None):
+    """
+    Return a local path holding the content of a URL, downloading it on a miss.
+
+    Replicas sharing the cache directory take a per-URL lock, so a file requested by
+    several of them at once is downloaded only once. The expected size and version of
+    the file are part of the reference key, so a file regenerated at the same URL is
+    downloaded again instead of being served from the copy of its previous version.
+
+    Args:
+        url (str): The URL of the file.
+        cache_dir (str): The root directory of the cache (default: FILE_CACHE_DIR).
+        max_bytes (int): The size budget of the cache in bytes (default: FILE_CACHE_SIZE_MB).
+        size (int): The expected size of the file in bytes, or None if unknown.
+        version (float): The expected modification time of the file, or None if unknown.
+
+    Returns:
+        str: The path of the cached file.
+
+    Raises:
+        ValueError: If the downloaded file does not have the expected size.
+    """
+    cache_dir = cache_dir or FILE_CACHE_DIR
+    max_bytes = max_bytes if max_bytes is not None else int(FILE_CACHE_SIZE_MB * 1024 * 1024)
+    objects_dir, refs_dir, locks_dir = _cache_layout(cache_dir)
+    identity = url if size is None and version is None else f"{url}\n{size}\n{version}"
+    url_key = hashlib.sha256(identity.encode()).hexdigest()
+    ref_path = os.path.join(refs_dir, url_key)
+
+    with _locked(os.path.join(locks_dir, url_key + '.lock')):
+        object_path = _lookup(objects_dir, ref_path)
+        if object_path is not None:
+            # Refresh the LRU position of the object
+            os.utime(object_path)
+            size = os.path.getsize(object_path)
+            _count(hits=1, bytes_saved=size)
+            CACHE_REQUESTS.inc(cache='file', outcome='hit')
+            logging.info(f"File cache hit for {url} ({size} bytes)")
+            return object_path
+
+        start_time = time.time()
+        object_name, downloaded = _download(url, objects_dir)
+        _count(misses=1, bytes_downloaded=downloaded)
+        CACHE_REQUESTS.inc(cache='file', outcome='miss')
+        if size is not None and downloaded != size:
+            # The file changed since it was probed, so the copy must not be kept under this version
+            raise ValueError(f"{url} is {downloaded} bytes instead of the expected {size}, it changed since it was probed")
+        with open(ref_path + '.part', 'w') as ref_file:
+            ref_file.write(object_name)
+        os.replace(ref_path + '.part', ref_path)
+        logging.info(f"File cache miss for {url}: downloaded {downloaded} bytes in {time.time() - start_time:.1f}s")
+
+    evict(cache_dir, max_bytes)
+    object_path = _lookup(objects_dir, ref_path)
+    if object_path is None:
+        # The budget is smaller than the file itself
+        raise Exception(f"File cache budget of {max_bytes} bytes cannot hold {url} ({downloaded} bytes)")
+    return object_path
@@ -0,0 +1,159 @@
+# histograms.py
+import json
+import numpy as np
+import awkward as ak
+import logging
+
+# Configure logging to output to the console with a basic format
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Fields filled for every histogram
+HISTOGRAM_FIELDS = ['counts', 'sumw', 'sumw2']
+
+def empty_histograms(bin_edges):
+    """
+    Create empty histograms for the given bin edges.
+
+    Args:
+        bin_edges (np.array): The edges of the histogram bins.
+
+    Returns:
+        dict: A dictionary with zero-filled 'counts', 'sumw' and 'sumw2' arrays.
+    """
+    n_bins = len(bin_edges) - 1
+    return {field: np.zeros(n_bins) for field in HISTOGRAM_FIELDS}
+
+def fill_histograms(mass, bin_edges, weights=None):
+    """
+    Fill the counts, sum of weights and sum of squared weights histograms.
+
+    Args:
+        mass (ak.Array): Array of invariant masses.
+        bin_edges (np.array): The edges of the histogram bins.
+        weights (ak.Array): Array of event weights, or None for unweighted data.
+
+    Returns:
+        dict: A dictionary with the 'counts', 'sumw' and 'sumw2' arrays.
+    """
+    mass = ak.to_numpy(mass)
+    counts, _ = np.histogram(mass, bins=bin_edges)
+    counts = counts.astype(np.float64)
+
+    # Unweighted data has sumw = sumw2 = counts
+    if weights is None:
+        return {'counts': counts, 'sumw': counts.copy(), 'sumw2': counts.copy()}
+
+    weights = ak.to_numpy(weights).astype(np.float64)
+    sumw, _ = np.histogram(mass, bins=bin_edges, weights=weights)
+    sumw2, _ = np.histogram(mass, bins=bin_edges, weights=weights**2)
+    logging.debug("Histograms filled successfully.")
+    return {'counts': counts, 'sumw': sumw, 'sumw2': sumw2}
+
+def add_histograms(total, histograms):
+    """
+    Add histograms into a running total.
+
+    Args:
+        total (dict): The running total, or None to start a new one.
+        histograms (dict): The histograms to add.
+
+    Returns:
+        dict: The updated running total.
+    """
+    if total is None:
+        return {field: np.array(histograms[field], dtype=np.float64) for field in HISTOGRAM_FIELDS}
+    for field in HISTOGRAM_FIELDS:
+        total[field] += histograms[field]
+    return total
+
+def histograms_to_awkward(histograms):
+    """
+    Convert histograms to an awkward record array (one record per bin) for transport.
+
+    Args:
+        histograms (dict): A dictionary with the 'counts', 'sumw' and 'sumw2' arrays.
+
+    Returns:
+        ak.Array: The histograms as an awkward record array.
+    """
+    return ak.zip({field: histograms[field] for field in HISTOGRAM_FIELDS})
+
+def histograms_from_awkward(array):
+    """
+    Convert an awkward record array produced by histograms_to_awkward back to histograms.
+
+    Args:
+        array (ak.Array): The histograms as an awkward record array.
+
+    Returns:
+        dict: A dictionary with the 'counts', 'sumw' and 'sumw2' arrays.
+    """
+    return {field: ak.to_numpy(array[field]) for field in HISTOGRAM_FIELDS}
+
+def xsec_weight(info, lumi):
+    """
+    Calculate the normalisation of an MC sample to an integrated luminosity.
+
+    Args:
+        info (dict): The infofile entry of the sample.
+        lumi (float): Integrated luminosity in fb^-1.
+
+    Returns:
+        float: The weight lumi * xsec / (sumw * red_eff), applied to every event of the sample.
+    """
+    return (lumi * 1000 * info["xsec"]) / (info["sumw"] * info["red_eff"])  # *1000 to go from fb-1 to pb-1
+
+def scale_histograms(histograms, factor):
+    """
+    Scale weighted histograms by a constant per-event weight.
+
+    Args:
+        histograms (dict): A dictionary with the 'counts', 'sumw' and 'sumw2' arrays.
+        factor (float): The weight applied to every event.
+
+    Returns:
+        dict: New histograms with sumw scaled by the factor and sumw2 by its square.
+    """
+    return {
+        'counts': np.array(histograms['counts'], dtype=np.float64),
+        'sumw': np.asarray(histograms['sumw']) * factor,
+        'sumw2': np.asarray(histograms['sumw2']) * factor**2,
+    }
+
+def save_histogram_store(path, bin_edges, sample_histograms):
+    """
+    Save per-sample histograms to a JSON histogram store.
+
+    Args:
+        path (str): The path of the store.
+        bin_edges (np.array): The edges of the histogram bins.
+        sample_histograms (dict): Histograms per sample name.
+    """
+    store = {
+        'bin_edges': np.asarray(bin_edges).tolist(),
+        'samples': {
+            name: {field: np.asarray(histograms[field]).tolist() for field in HISTOGRAM_FIELDS}
+            for name, histograms in sample_histograms.items()
+        },
+    }
+    with open(path, 'w') as store_file:
+        json.dump(store, store_file)
+    logging.info(f"Saved histograms of {len(sample_histograms)} samples to {path}")
+
+def load_histogram_store(path):
+    """
+    Load per-sample histograms from a JSON histogram store.
+
+    Args:
+        path (str): The path of the store.
+
+    Returns:
+        tuple: The bin edges (np.array) and the histograms per sample name (dict).
+    """
+    with open(path) as store_file:
+        store = json.load(store_file)
+    sample_histograms = {
+        name: {field: np.array(histograms[field]) for field in HISTOGRAM_FIELDS}
+        for name, histograms in store['samples'].items()
+    }
+    return np.array(store['bin_edges']), sample_histograms
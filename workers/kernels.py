@@ -0,0 +1,116 @@
+# kernels.py
+import numpy as np
+import awkward as ak
+import logging
+from constants import MeV
+
+# Configure logging to output to the console with a basic format
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# numba is optional: without it the awkward/vector path is used
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    numba = None
+    HAS_NUMBA = False
+
+def _jit(function):
+    """
+    Compile a function with numba when it is available.
+
+    Args:
+        function: The function to compile.
+
+    Returns:
+        The compiled function, or the function itself without numba.
+    """
+    if HAS_NUMBA:
+        return numba.njit(cache=True, nogil=True)(function)
+    return function
+
+@_jit
+def _select_and_mass_kernel(offsets, lep_type, lep_charge, lep_pt, lep_eta, lep_phi, lep_E):
+    """
+    Apply the lepton type and charge cuts and compute the 4-lepton invariant mass in one pass.
+
+    Args:
+        offsets (np.array): Offsets of the events into the flat lepton arrays.
+        lep_type (np.array): Flat array of lepton types.
+        lep_charge (np.array): Flat array of lepton charges.
+        lep_pt (np.array): Flat array of lepton transverse momenta.
+        lep_eta (np.array): Flat array of lepton pseudorapidities.
+        lep_phi (np.array): Flat array of lepton azimuthal angles.
+        lep_E (np.array): Flat array of lepton energies.
+
+    Returns:
+        tuple: The selection mask over events and the invariant masses of the selected events.
+    """
+    n_events = len(offsets) - 1
+    mask = np.zeros(n_events, dtype=np.bool_)
+    mass = np.empty(n_events, dtype=np.float64)
+    n_selected = 0
+    for i in range(n_events):
+        start = offsets[i]
+        if offsets[i + 1] - start < 4:
+            continue
+
+        # Same cuts as cut_lep_type and cut_lep_charge on the first four leptons
+        sum_lep_type = lep_type[start] + lep_type[start + 1] + lep_type[start + 2] + lep_type[start + 3]
+        if sum_lep_type != 44 and sum_lep_type != 48 and sum_lep_type != 52:
+            continue
+        sum_lep_charge = lep_charge[start] + lep_charge[start + 1] + lep_charge[start + 2] + lep_charge[start + 3]
+        if sum_lep_charge != 0:
+            continue
+
+        # Sum the four Lorentz vectors in Cartesian coordinates
+        px = 0.0
+        py = 0.0
+        pz = 0.0
+        energy = 0.0
+        for j in range(start, start + 4):
+            pt = np.float64(lep_pt[j])
+            px += pt * np.cos(lep_phi[j])
+            py += pt * np.sin(lep_phi[j])
+            pz += pt * np.sinh(lep_eta[j])
+            energy += lep_E[j]
+
+        # Signed mass, as computed by vector for space-like sums
+        m2 = energy * energy - (px * px + py * py + pz * pz)
+        mask[i] = True
+        mass[n_selected] = np.copysign(np.sqrt(np.abs(m2)), m2) * MeV
+        n_selected += 1
+    return mask, mass[:n_selected]
+
+def _jagged_buffers(array):
+    """
+    Get the offsets and flat content of a jagged array without copying it.
+
+    Args:
+        array (ak.Array): A jagged (var * number) awkward array.
+
+    Returns:
+        tuple: The offsets and the flat content as numpy arrays.
+    """
+    layout = ak.to_packed(array).layout
+    return np.asarray(layout.offsets), np.asarray(layout.content.data)
+
+def select_and_mass(data):
+    """
+    Apply the lepton type and charge cuts and compute the invariant mass with the compiled kernel.
+
+    All lepton branches are expected to share the same multiplicity per event, so the
+    offsets of lep_type are used for every branch.
+
+    Args:
+        data (ak.Array): A chunk of events with the lep_* fields.
+
+    Returns:
+        tuple: The selection mask over events (np.array of bool) and the invariant masses
+        of the selected events (np.array).
+    """
+    offsets, lep_type = _jagged_buffers(data['lep_type'])
+    buffers = [_jagged_buffers(data[field])[1] for field in ['lep_charge', 'lep_pt', 'lep_eta', 'lep_phi', 'lep_E']]
+    mask, mass = _select_and_mass_kernel(offsets, lep_type, *buffers)
+    logging.debug("Applied fused selection and mass kernel.")
+    return mask, mass
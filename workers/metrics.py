@@ -0,0 +1,261 @@
+# metrics.py
+import os
+import time
+import bisect
+import logging
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Configure logging to output to the console with a basic format
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Port of the Prometheus /metrics endpoint of every worker (0 disables it)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '8000'))
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Content type of the Prometheus text exposition format
+EXPOSITION_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Every metric of this process, in registration order
+REGISTRY = []
+
+class Metric:
+    """
+    A named metric with one value per combination of label values.
+
+    Updating a metric only takes a lock and a dictionary update; the text exposition
+    is built when the endpoint is scraped, so unscraped metrics cost almost nothing.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        Args:
+            name (str): The metric name.
+            documentation (str): The help text of the metric.
+            labels (tuple): The label names, whose values are given on every update.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _label_text(self, key, extra=None):
+        pairs = list(zip(self.labels, key)) + ([extra] if extra else [])
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{label}="{value}"' for label, value in pairs) + '}'
+
+    def samples(self):
+        """
+        Build the sample lines of the metric.
+
+        Returns:
+            list: The lines of the text exposition format, without the HELP and TYPE lines.
+        """
+        with self.lock:
+            return [f"{self.name}{self._label_text(key)} {value}" for key, value in self.values.items()]
+
+class Counter(Metric):
+    """
+    A monotonically increasing count, such as events processed or bytes read.
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """
+        Increase the count.
+
+        Args:
+            amount (float): The increment.
+            **labels: The label values.
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+    A value going up and down, such as the number of tasks in flight.
+    """
+
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        """
+        Increase the value.
+
+        Args:
+            amount (float): The increment.
+            **labels: The label values.
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """
+        Decrease the value.
+
+        Args:
+            amount (float): The decrement.
+            **labels: The label values.
+        """
+        self.inc(-amount, **labels)
+
+    @contextlib.contextmanager
+    def track(self, **labels):
+        """
+        Count the enclosed block as in progress.
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class Histogram(Metric):
+    """
+    A distribution of observed values, such as task latencies, over fixed buckets.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            name (str): The metric name.
+            documentation (str): The help text of the metric.
+            labels (tuple): The label names, whose values are given on every update.
+            buckets (tuple): The increasing upper bounds of the buckets.
+        """
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """
+        Add an observation to its bucket.
+
+        Args:
+            value (float): The observed value.
+            **labels: The label values.
+        """
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observe the duration of the enclosed block.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def samples(self):
+        """
+        Build the cumulative bucket counts, sum and count of every label combination.
+
+        Returns:
+            list: The lines of the text exposition format.
+        """
+        lines = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{self.name}_bucket{self._label_text(key, ('le', le))} {cumulative}")
+                lines.append(f"{self.name}_sum{self._label_text(key)} {total}")
+                lines.append(f"{self.name}_count{self._label_text(key)} {cumulative}")
+        return lines
+
+def render():
+    """
+    Build the text exposition of every registered metric.
+
+    Returns:
+        bytes: The metrics in the Prometheus text format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return ('\n'.join(lines) + '\n').encode()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serve the metrics on /metrics.
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', EXPOSITION_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep scrapes out of the worker logs
+        pass
+
+# The running metrics server of this process, if any
+_server = None
+
+def start_metrics_server(port=None):
+    """
+    Serve the metrics over HTTP from a daemon thread.
+
+    Starting the server again in the same process is a no-op, so several workers run in
+    one process (as in pipeline.py) share one endpoint. A port already in use only logs
+    a warning.
+
+    Args:
+        port (int): The port to listen on (default: METRICS_PORT, 0 disables the server).
+    """
+    global _server
+    port = METRICS_PORT if port is None else port
+    if _server is not None or not port:
+        return
+    try:
+        _server = ThreadingHTTPServer(('', port), MetricsHandler)
+    except OSError as e:
+        logging.warning(f"Metrics endpoint not started on port {port}: {e}")
+        return
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://0.0.0.0:{port}/metrics")
+
+# Metrics of the workers
+TASKS_IN_FLIGHT = Gauge('atlas_tasks_in_flight', "Tasks being processed by this data processor")
+TASK_SECONDS = Histogram('atlas_task_seconds', "Processing time of a task", ['outcome'])
+EVENTS_PROCESSED = Counter('atlas_events_processed_total', "Events read by the data processor, before the cuts")
+EVENTS_SELECTED = Counter('atlas_events_selected_total', "Events passing the cuts")
+STAGE_SECONDS = Counter('atlas_stage_seconds_total', "Time spent by the data processor in each stage", ['stage'])
+BYTES_IN = Counter('atlas_bytes_in_total', "Bytes read from the input files or received from a queue", ['source'])
+BYTES_OUT = Counter('atlas_bytes_out_total', "Bytes published to a queue", ['queue'])
+MESSAGES_IN = Counter('atlas_messages_consumed_total', "Messages consumed from a queue", ['queue'])
+MESSAGES_OUT = Counter('atlas_messages_published_total', "Messages published to a queue", ['queue'])
+PUBLISH_SECONDS = Histogram('atlas_publish_seconds', "Time to publish a message to the broker (including the confirm)", ['queue'])
+CACHE_REQUESTS = Counter('atlas_cache_requests_total', "Lookups in the file, skim and catalog caches", ['cache', 'outcome'])
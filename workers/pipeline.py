@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import multiprocessing
+import pika
+
+# Add the common directory to the Python path to access shared modules
+sys.path.append('/app')
+from connect import connect_to_rabbitmq, publish_message
+from metrics import start_metrics_server
+from constants import SAMPLES, TASK_QUEUE, RESULT_QUEUE, setup_histogram_bins
+from histograms import save_histogram_store
+from data_loader import plan_tasks
+from data_processor import process_task
+from analysis import new_state, aggregate_result, finish_run, combine_samples, prepare_plot_data, HISTOGRAM_STORE
+from visualization import plot_mass_histogram
+
+# Configure logging to output to the console with a basic format
+import logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Executor backend running the tasks: 'inprocess', 'multiprocessing' or 'rabbitmq'
+PIPELINE_BACKEND = os.environ.get('PIPELINE_BACKEND', 'inprocess')
+
+# Number of tasks processed at the same time by the inprocess and multiprocessing backends
+PIPELINE_WORKERS = int(os.environ.get('PIPELINE_WORKERS', '1'))
+
+# Seconds the rabbitmq backend waits for the next result before giving up on the shards still missing
+PIPELINE_RESULT_TIMEOUT = float(os.environ.get('PIPELINE_RESULT_TIMEOUT', '600'))
+
+def run_in_process(task_bodies, workers):
+    """
+    Run tasks in threads of this process, passing them through in-memory queues.
+
+    Args:
+        task_bodies (list): The serialized tasks.
+        workers (int): The number of worker threads.
+
+    Yields:
+        tuple: The result body and headers of each task, in completion order.
+    """
+    task_queue = queue.Queue()
+    result_queue = queue.Queue()
+    for body in task_bodies:
+        task_queue.put(body)
+
+    def worker():
+        while True:
+            try:
+                body = task_queue.get_nowait()
+            except queue.Empty:
+                return
+            result_queue.put(process_task(body))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for _ in task_bodies:
+        yield result_queue.get()
+    for thread in threads:
+        thread.join()
+
+def run_multiprocessing(task_bodies, workers):
+    """
+    Run tasks in a pool of worker processes.
+
+    Each process also runs MAX_WORKERS chunk threads, so MAX_WORKERS=1 is usually the
+    right setting with this backend.
+
+    Args:
+        task_bodies (list): The serialized tasks.
+        workers (int): The number of worker processes.
+
+    Yields:
+        tuple: The result body and headers of each task, in completion order.
+    """
+    with multiprocessing.get_context('spawn').Pool(processes=workers) as pool:
+        yield from pool.imap_unordered(process_task, task_bodies)
+
+def run_rabbitmq(task_bodies, workers):
+    """
+    Run tasks on the data-processor workers through RabbitMQ.
+
+    The tasks are published to the task queue and the results consumed from the result
+    queue, so no separate data-loader or analysis worker must be running. The run ends
+    when every shard has a result; results of other runs and repeated shards are dropped.
+    If no result arrives for PIPELINE_RESULT_TIMEOUT seconds, an error result is yielded
+    for each shard still missing, as a task the processor cannot read or report produces
+    no result.
+
+    Args:
+        task_bodies (list): The serialized tasks.
+        workers (int): Unused, the number of data-processor replicas sets the concurrency.
+
+    Yields:
+        tuple: The result body and headers of each task, in completion order.
+    """
+    connection = connect_to_rabbitmq()
+    channel = connection.channel()
+    channel.queue_declare(queue=TASK_QUEUE, durable=True)
+    channel.queue_declare(queue=RESULT_QUEUE, durable=True)
+
+    pending = {}
+    for body in task_bodies:
+        task = json.loads(body)
+        pending[(task['sample_name'], task.get('shard_index', 0))] = task
+        publish_message(channel, TASK_QUEUE, body, pika.BasicProperties(delivery_mode=2))  # Make message persistent
+
+    for method, properties, body in channel.consume(RESULT_QUEUE, inactivity_timeout=PIPELINE_RESULT_TIMEOUT):
+        if method is None:
+            logging.error(f"No result within {PIPELINE_RESULT_TIMEOUT:g}s, {len(pending)} shards missing")
+            break
+        headers = properties.headers or {}
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        key = (headers.get('sample_name'), headers.get('shard_index', 0))
+        if pending.pop(key, None) is None:
+            logging.warning(f"Dropping a result for no pending shard: {key[0]} shard {key[1]}")
+            continue
+        yield body, headers
+        if not pending:
+            break
+    channel.cancel()
+    connection.close()
+
+    # Report the shards without a result so the aggregation does not wait for them
+    for (sample_name, shard_index), task in pending.items():
+        yield b'', {
+            'sample_type': task['sample_type'],
+            'sample_name': sample_name,
+            'shard_index': shard_index,
+            'shard_count': task.get('shard_count', 1),
+            'error': f"No result within {PIPELINE_RESULT_TIMEOUT:g}s"
+        }
+
+# Executor backends, each mapping serialized tasks to (result body, headers) tuples
+BACKENDS = {
+    'inprocess': run_in_process,
+    'multiprocessing': run_multiprocessing,
+    'rabbitmq': run_rabbitmq,
+}
+
+def run_pipeline(backend, workers, lumi=10, fraction=1.0):
+    """
+    Run the task planning, processing, aggregation and plotting of the workers as one pipeline.
+
+    Args:
+        backend (str): The executor backend running the tasks (a key of BACKENDS).
+        workers (int): The number of tasks processed at the same time.
+        lumi (float): Integrated luminosity in fb^-1.
+        fraction (float): Fraction of each file to process.
+
+    Returns:
+        dict: The backend, the number of tasks, the time spent in each phase, the plot
+        path and the signal significance.
+    """
+    timings = {}
+    start_time = time.perf_counter()
+
+    # Plan the tasks as the data loader does
+    tasks, missing = plan_tasks(fraction)
+    timings['plan'] = time.perf_counter() - start_time
+
+    # Process the tasks with the backend, aggregating the results as they complete
+    bin_edges, bin_centres = setup_histogram_bins()
+    state = new_state(bin_edges)
+    for headers in missing:
+        aggregate_result(state, headers, b'')
+    task_bodies = [json.dumps(task).encode() for _, task in tasks]
+    for body, headers in BACKENDS[backend](task_bodies, workers):
+        if headers is not None:
+            aggregate_result(state, headers, body)
+    finish_run(state)
+    timings['process'] = time.perf_counter() - start_time - timings['plan']
+
+    # Keep the histograms for re-weighting, normalise them and plot
+    try:
+        save_histogram_store(HISTOGRAM_STORE, bin_edges, state['sample_histograms'])
+    except OSError as e:
+        logging.warning(f"Failed to save the histogram store {HISTOGRAM_STORE}: {e}")
+    all_histograms = combine_samples(state['sample_histograms'], SAMPLES, lumi)
+    plot_data = prepare_plot_data(all_histograms, SAMPLES, bin_edges, bin_centres)
+    result = plot_mass_histogram(plot_data, bin_edges, bin_centres, step_size=5, lumi=lumi, fraction=fraction)
+    timings['plot'] = time.perf_counter() - start_time - timings['plan'] - timings['process']
+
+    logging.info(f"Pipeline ran {len(tasks)} tasks with the {backend} backend in "
+                 f"{time.perf_counter() - start_time:.2f}s (plan {timings['plan']:.2f}s, "
+                 f"process {timings['process']:.2f}s, plot {timings['plot']:.2f}s)")
+    return {
+        'backend': backend,
+        'tasks': len(tasks),
+        'timings': timings,
+        'plot_path': result['plot_path'],
+        'significance': result['significance'],
+    }
+
+def main():
+    """
+    Main function to run the whole pipeline in one process, with the backend given as
+    first argument or in PIPELINE_BACKEND.
+    """
+    backend = sys.argv[1] if len(sys.argv) > 1 else PIPELINE_BACKEND
+    if backend not in BACKENDS:
+        raise Exception(f"Unknown pipeline backend {backend}, expected one of {', '.join(BACKENDS)}")
+    
+    # Serve the metrics for scraping
+    start_metrics_server()
+
+    # Get analysis parameters from environment variables
+    lumi = float(os.environ.get('LUMI', '10'))
+    fraction = float(os.environ.get('FRACTION', '1.0'))
+
+    result = run_pipeline(backend, PIPELINE_WORKERS, lumi, fraction)
+    logging.info(f"Plot saved to {result['plot_path']}, signal significance {result['significance']:.3f}")
+
+if __name__ == "__main__":
+    main()
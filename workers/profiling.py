@@ -0,0 +1,223 @@
+# profiling.py
+import os
+import csv
+import time
+import logging
+import resource
+import threading
+import contextlib
+
+# Configure logging to output to the console with a basic format
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Stages timed by the data processor, in pipeline order. 'open' includes the download into
+# the file cache, and 'read' the basket requests and the 'decompress' and 'interpret' parts.
+STAGES = ['skim', 'open', 'read', 'decompress', 'interpret', 'cuts', 'mass', 'weights', 'serialize', 'store']
+
+# Stages timed inside 'read', left out of the stage total
+READ_PARTS = ['decompress', 'interpret']
+
+# Counters reported by the data processor next to the stage timings
+COUNTERS = ['entries_in', 'entries_out', 'bytes_read', 'cpu_seconds', 'peak_rss_bytes']
+
+# Times travel in the result headers as integer microseconds, as AMQP field tables
+# (pika) cannot carry floats and their decimals only hold 32-bit values
+MICROSECONDS = 1000000
+
+# Memory limit files of cgroup v2 and v1, the first one present applies
+CGROUP_MEMORY_LIMIT_FILES = ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']
+
+# Columns of the per-run performance table
+TABLE_COLUMNS = (['sample_type', 'sample_name', 'shard_index', 'processing_seconds', 'transit_seconds']
+                 + [f'{stage}_seconds' for stage in STAGES] + COUNTERS + ['payload_bytes', 'error'])
+
+class TaskProfile:
+    """
+    Stage timings and counters of one task, shared by the threads processing its chunks.
+
+    Stage times are summed over threads, so with MAX_WORKERS > 1 the stages of a task
+    can add up to more than its wall time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage_seconds = {}
+        self.counters = {}
+        self.start_cpu_seconds = resource_usage()[0]
+
+    def add(self, stage, seconds):
+        """
+        Add time spent in a stage.
+
+        Args:
+            stage (str): The name of the stage (one of STAGES).
+            seconds (float): The time spent.
+        """
+        with self.lock:
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+
+    def count(self, counter, value):
+        """
+        Add to a counter.
+
+        Args:
+            counter (str): The name of the counter (one of COUNTERS).
+            value (int): The amount to add.
+        """
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """
+        Time the enclosed block as part of a stage.
+
+        Args:
+            stage (str): The name of the stage (one of STAGES).
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_time)
+
+    def headers(self):
+        """
+        Describe the profile as result message headers.
+
+        The CPU time is that of the whole process since the profile was created, so it
+        includes the tasks running at the same time when TASK_PREFETCH > 1. Times are
+        integer microseconds (see to_microseconds).
+
+        Returns:
+            dict: The 'stage_us' table, the counters and the CPU time ('cpu_us').
+        """
+        cpu_seconds, peak_rss_bytes = resource_usage()
+        with self.lock:
+            headers = {'stage_us': {stage: to_microseconds(seconds) for stage, seconds in self.stage_seconds.items()}}
+            headers.update(self.counters)
+        headers['cpu_us'] = to_microseconds(cpu_seconds - self.start_cpu_seconds)
+        headers['peak_rss_bytes'] = peak_rss_bytes
+        return headers
+
+def to_microseconds(seconds):
+    """
+    Encode a time for the result headers.
+
+    Args:
+        seconds (float): The time in seconds.
+
+    Returns:
+        int: The time in whole microseconds.
+    """
+    return int(round(seconds * MICROSECONDS))
+
+def from_microseconds(microseconds):
+    """
+    Decode a time from the result headers.
+
+    Args:
+        microseconds (int): The time in microseconds, or None.
+
+    Returns:
+        float: The time in seconds, or None.
+    """
+    return None if microseconds is None else microseconds / MICROSECONDS
+
+def resource_usage():
+    """
+    Get the CPU time and peak resident memory of this process.
+
+    Returns:
+        tuple: The user + system CPU seconds and the peak RSS in bytes.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024  # ru_maxrss is in kilobytes on Linux
+
+def current_rss():
+    """
+    Get the current resident memory of this process.
+
+    Returns:
+        int: The RSS in bytes, or 0 where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def memory_limit():
+    """
+    Get the memory limit of the container this process runs in.
+
+    The cgroup limit is read first; without one (or with 'max', or the near-infinite
+    value cgroup v1 reports when unlimited) the physical memory of the host applies.
+
+    Returns:
+        int: The memory limit in bytes.
+    """
+    physical = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for path in CGROUP_MEMORY_LIMIT_FILES:
+        try:
+            with open(path) as limit_file:
+                value = limit_file.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < physical:
+            return int(value)
+        break
+    return physical
+
+def performance_row(result, payload_bytes, received_at=None):
+    """
+    Build the performance table row of a result.
+
+    Args:
+        result (dict): The result metadata (the message headers).
+        payload_bytes (int): The size of the result payload.
+        received_at (float): The time.time() the result was received, or None.
+
+    Returns:
+        dict: The row, keyed by TABLE_COLUMNS; values the processor did not report are None.
+    """
+    stage_us = result.get('stage_us') or {}
+    row = {column: result.get(column) for column in TABLE_COLUMNS}
+    row.update({f'{stage}_seconds': from_microseconds(stage_us.get(stage)) for stage in STAGES})
+    row['processing_seconds'] = from_microseconds(result.get('processing_us'))
+    row['cpu_seconds'] = from_microseconds(result.get('cpu_us'))
+    row['payload_bytes'] = payload_bytes
+    if received_at is not None and result.get('published_at_us') is not None:
+        row['transit_seconds'] = received_at - from_microseconds(result['published_at_us'])
+    return row
+
+def write_performance_table(path, rows):
+    """
+    Write the performance rows of a run as CSV, followed by a row of totals.
+
+    The totals sum every numeric column except peak_rss_bytes, which takes the
+    maximum. The share of each stage in the total stage time is logged.
+
+    Args:
+        path (str): The path of the CSV file.
+        rows (list): The rows built by performance_row.
+    """
+    totals = {'sample_type': 'total', 'sample_name': f"{len(rows)} results"}
+    for column in TABLE_COLUMNS[3:-1]:
+        values = [row[column] for row in rows if row.get(column) is not None]
+        if values:
+            totals[column] = max(values) if column == 'peak_rss_bytes' else sum(values)
+    totals['error'] = sum(1 for row in rows if row.get('error'))
+
+    with open(path, 'w', newline='') as table_file:
+        writer = csv.DictWriter(table_file, fieldnames=TABLE_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+        writer.writerow(totals)
+
+    stage_total = sum(totals.get(f'{stage}_seconds', 0.0) for stage in STAGES if stage not in READ_PARTS)
+    if stage_total:
+        shares = ', '.join(f"{stage} {totals[f'{stage}_seconds']:.2f}s ({100 * totals[f'{stage}_seconds'] / stage_total:.0f}%)"
+                           for stage in STAGES if totals.get(f'{stage}_seconds'))
+        logging.info(f"Time by stage over {len(rows)} results: {shares}")
+    logging.info(f"Saved the performance table of {len(rows)} results to {path}")
@@ -0,0 +1,112 @@
+# skim_cache.py
+import os
+import json
+import struct
+import hashlib
+import logging
+import tempfile
+from connect import serialize_awkward, deserialize_awkward, BUFFER_ALIGNMENT
+from metrics import CACHE_REQUESTS
+
+# Configure logging to output to the console with a basic format
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Directory of the persistent skim cache (empty disables it)
+SKIM_CACHE_DIR = os.environ.get('SKIM_CACHE_DIR', '')
+
+# Version of the skim file layout, part of every key
+SKIM_FORMAT_VERSION = 1
+
+# Extension of the skim files
+SKIM_EXTENSION = '.skim'
+
+def skim_key(**parts):
+    """
+    Build the cache key of a skim from everything its content depends on.
+
+    Args:
+        **parts: JSON-serializable values identifying the skim (sample, cut
+            definition, variables, infofile entry, entry range...).
+
+    Returns:
+        str: The SHA-256 of the canonical JSON encoding of the parts.
+    """
+    parts['format_version'] = SKIM_FORMAT_VERSION
+    encoded = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+def _skim_path(key, cache_dir):
+    """
+    Get the path of the skim file of a key.
+
+    Args:
+        key (str): The cache key.
+        cache_dir (str): The root directory of the cache.
+
+    Returns:
+        str: The path of the skim file.
+    """
+    return os.path.join(cache_dir, key[:2], key + SKIM_EXTENSION)
+
+def load_skim(key, cache_dir=None):
+    """
+    Load a skim from the cache.
+
+    A skim file holds the length of its header as an 8-byte little-endian integer,
+    the JSON headers of serialize_awkward, padding to the buffer alignment, and the
+    packed buffers.
+
+    Args:
+        key (str): The cache key.
+        cache_dir (str): The root directory of the cache (default: SKIM_CACHE_DIR).
+
+    Returns:
+        tuple: Whether the skim was found (bool) and the skimmed events (ak.Array, or
+        None for a skim without selected events).
+    """
+    path = _skim_path(key, cache_dir or SKIM_CACHE_DIR)
+    try:
+        with open(path, 'rb') as skim_file:
+            content = skim_file.read()
+    except FileNotFoundError:
+        CACHE_REQUESTS.inc(cache='skim', outcome='miss')
+        return False, None
+
+    CACHE_REQUESTS.inc(cache='skim', outcome='hit')
+    header_size, = struct.unpack_from('<Q', content)
+    headers = json.loads(content[8:8 + header_size])
+    body_start = 8 + header_size + (-(8 + header_size) % BUFFER_ALIGNMENT)
+    logging.info(f"Skim cache hit {key[:12]} ({len(content)} bytes)")
+    return True, deserialize_awkward(memoryview(content)[body_start:], headers)
+
+def save_skim(key, data, cache_dir=None):
+    """
+    Write a skim to the cache.
+
+    The file is written to a temporary file in the same directory and renamed into
+    place, so replicas sharing the directory never read a partial skim.
+
+    Args:
+        key (str): The cache key.
+        data (ak.Array): The skimmed events, or None if no event was selected.
+        cache_dir (str): The root directory of the cache (default: SKIM_CACHE_DIR).
+    """
+    path = _skim_path(key, cache_dir or SKIM_CACHE_DIR)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    body, headers = serialize_awkward(data)
+    header = json.dumps(headers).encode()
+    padding = bytes(-(8 + len(header)) % BUFFER_ALIGNMENT)
+
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as skim_file:
+            skim_file.write(struct.pack('<Q', len(header)))
+            skim_file.write(header)
+            skim_file.write(padding)
+            skim_file.write(body)
+        os.replace(temporary_path, path)
+    except Exception:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    logging.info(f"Skim cache stored {key[:12]} ({len(body)} bytes of events)")
@@ -0,0 +1,70 @@
+# task_stats.py
+import os
+import json
+import logging
+
+# Configure logging to output to the console with a basic format
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Local file of historical processing costs per sample, written by the analysis and read by the loader
+TASK_STATS_PATH = os.environ.get('TASK_STATS_PATH', '/app/output/task_stats.json')
+
+# Weight of the latest run in the moving average of the processing cost
+STATS_SMOOTHING = 0.5
+
+def load_task_stats(path=None):
+    """
+    Load the historical processing costs.
+
+    Args:
+        path (str): The path of the stats file (default: TASK_STATS_PATH).
+
+    Returns:
+        dict: The processing seconds per byte, keyed by sample name (empty if there is no stats file).
+    """
+    path = path or TASK_STATS_PATH
+    try:
+        with open(path) as stats_file:
+            return json.load(stats_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def update_task_stats(measurements, path=None):
+    """
+    Merge the processing costs measured in a run into the stats file.
+
+    Args:
+        measurements (dict): The total processing seconds and bytes per sample name,
+            as {'seconds': float, 'bytes': int} dictionaries.
+        path (str): The path of the stats file (default: TASK_STATS_PATH).
+    """
+    path = path or TASK_STATS_PATH
+    stats = load_task_stats(path)
+    for sample_name, measurement in measurements.items():
+        if not measurement['bytes']:
+            continue
+        seconds_per_byte = measurement['seconds'] / measurement['bytes']
+        previous = stats.get(sample_name)
+        stats[sample_name] = seconds_per_byte if previous is None else (
+            STATS_SMOOTHING * seconds_per_byte + (1 - STATS_SMOOTHING) * previous)
+    with open(path, 'w') as stats_file:
+        json.dump(stats, stats_file, indent=2)
+    logging.info(f"Updated processing costs of {len(measurements)} samples in {path}")
+
+def seconds_per_byte(stats, sample_name):
+    """
+    Get the processing cost of a sample, falling back to the average of all samples.
+
+    Args:
+        stats (dict): The historical processing costs.
+        sample_name (str): The name of the sample.
+
+    Returns:
+        float: The processing seconds per byte, or 1.0 without any history (so costs
+        are plain byte counts).
+    """
+    if sample_name in stats:
+        return stats[sample_name]
+    if stats:
+        return sum(stats.values()) / len(stats)
+    return 1.0
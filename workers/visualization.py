@@ -12,12 +12,16 @@ matplotlib.use('Agg')  # Use a non-interactive backend for matplotlib
 # Add the common directory to the Python path to access shared modules
 sys.path.append('/app')
 from connect import connect_to_rabbitmq
+from metrics import BYTES_IN, MESSAGES_IN, start_metrics_server
 from constants import VISUALIZATION_QUEUE, GeV
 
 # Configure logging to output to the console with a basic format
 import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Directory the plot is written to
+OUTPUT_DIR = os.environ.get('OUTPUT_DIR', '/app/output')
+
 def plot_mass_histogram(plot_data, bin_edges, bin_centres, step_size=5, lumi=10, fraction=1.0):
     """
     Plot a mass histogram and save it to a file.
@@ -36,11 +40,10 @@ def plot_mass_histogram(plot_data, bin_edges, bin_centres, step_size=5, lumi=10,
     # Convert lists back to numpy arrays
     data_x = np.array(plot_data['data_x'])
     data_x_errors = np.array(plot_data['data_x_errors'])
-    signal_x = np.array(plot_data['signal_x'])
-    signal_weights = np.array(plot_data['signal_weights'])
+    signal_heights = np.array(plot_data['signal_heights'])
     signal_color = plot_data['signal_color']
-    mc_x = [np.array(x) for x in plot_data['mc_x']]
-    mc_weights = [np.array(w) for w in plot_data['mc_weights']]
+    mc_heights = [np.array(h) for h in plot_data['mc_heights']]
+    mc_x_err = np.array(plot_data['mc_x_err'])
     mc_colors = plot_data['mc_colors']
     mc_labels = plot_data['mc_labels']
     
@@ -53,15 +56,12 @@ def plot_mass_histogram(plot_data, bin_edges, bin_centres, step_size=5, lumi=10,
                        fmt='ko',  # 'k' means black and 'o' is for circles
                        label='Data')
     
-    # Plot the Monte Carlo bars
-    mc_heights = main_axes.hist(mc_x, bins=bin_edges,
-                                weights=mc_weights, stacked=True,
-                                color=mc_colors, label=mc_labels)
-    
-    mc_x_tot = mc_heights[0][-1]  # Stacked background MC y-axis value
-    
-    # Calculate MC statistical uncertainty: sqrt(sum w^2)
-    mc_x_err = np.sqrt(np.histogram(np.hstack(mc_x), bins=bin_edges, weights=np.hstack(mc_weights)**2)[0])
+    # Plot the Monte Carlo bars, stacking each contribution on top of the previous ones
+    mc_x_tot = np.zeros(len(bin_centres))
+    for heights, color, label in zip(mc_heights, mc_colors, mc_labels):
+        main_axes.stairs(mc_x_tot + heights, bin_edges, baseline=mc_x_tot,
+                         fill=True, color=color, label=label)
+        mc_x_tot = mc_x_tot + heights  # Stacked background MC y-axis value
     
     # Plot the statistical uncertainty
     main_axes.bar(bin_centres,  # x
@@ -71,9 +71,9 @@ def plot_mass_histogram(plot_data, bin_edges, bin_centres, step_size=5, lumi=10,
                   hatch="////", width=step_size, label='Stat. Unc.')
     
     # Plot the signal bar
-    signal_heights = main_axes.hist(signal_x, bins=bin_edges, bottom=mc_x_tot,
-                                    weights=signal_weights, color=signal_color,
-                                    label=r'Signal ($m_H$ = 125 GeV)')
+    main_axes.stairs(mc_x_tot + signal_heights, bin_edges, baseline=mc_x_tot,
+                     fill=True, color=signal_color,
+                     label=r'Signal ($m_H$ = 125 GeV)')
     
     # Set the x-limit of the main axes
     main_axes.set_xlim(left=bin_edges[0], right=bin_edges[-1])
@@ -133,13 +133,12 @@ def plot_mass_histogram(plot_data, bin_edges, bin_centres, step_size=5, lumi=10,
     main_axes.legend(frameon=False)  # No box around the legend
     
     # Save plot
-    output_dir = '/app/output'
-    os.makedirs(output_dir, exist_ok=True)
-    output_path = f"{output_dir}/mass_histogram.png"
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    output_path = f"{OUTPUT_DIR}/mass_histogram.png"
     plt.savefig(output_path, dpi=300, bbox_inches='tight')
     
     # Calculate signal significance
-    signal_tot = signal_heights[0] + mc_x_tot
+    signal_tot = signal_heights + mc_x_tot
     bin_indices = [7, 8, 9]  # Bins around 125 GeV
     N_sig = signal_tot[bin_indices].sum()
     N_bg = mc_x_tot[bin_indices].sum()
@@ -167,6 +166,8 @@ def callback(ch, method, properties, body):
         properties: The message properties.
         body: The message body.
     """
+    MESSAGES_IN.inc(queue=VISUALIZATION_QUEUE)
+    BYTES_IN.inc(len(body), source=VISUALIZATION_QUEUE)
     try:
         # Parse the task from the message body
         task = json.loads(body.decode())
@@ -204,6 +205,9 @@ def main():
     """
     Main function to process visualization tasks from the queue.
     """
+    # Serve the metrics for scraping
+    start_metrics_server()
+    
     # Connect to RabbitMQ
     connection = connect_to_rabbitmq()
     channel = connection.channel()
@@ -223,4 +227,4 @@ def main():
     channel.start_consuming()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()